@@ -0,0 +1,3 @@
+"""
+Tools shared by the job scripts and managers in the sibling job directories.
+"""
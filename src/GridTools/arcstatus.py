@@ -0,0 +1,176 @@
+"""
+Job statuses from a single, cached 'arcstat' call.
+
+'arcstat' is run once over the whole job database and its output parsed into one record
+per job (its ID, name, state, and the specific state and exit code if reported), from
+which the number of jobs in each state is counted. The snapshot is cached next to the
+job database and reused until it is older than a given TTL, or the job database has
+changed since, so that repeated status queries of a large campaign do not each hit the
+CE. Snapshots are written out as the plain-text logfile.txt report or as JSON, counting
+the jobs on each CE separately when they were shared between several.
+"""
+import json
+import os
+import time
+from collections import OrderedDict
+
+
+# States in the order they are reported, any others following
+STATES = ["Running", "Finished", "Finishing", "Failed", "Queuing", "Missing"]
+# State of jobs arcstat finds no information for
+MISSING = "Missing"
+# Fields of a job record, keyed by their label in the arcstat output
+FIELDS = OrderedDict([("Name", "name"), ("State", "state"), ("Specific state", "specific_state"), ("Exit Code", "exit_code")])
+
+
+def get_cache_file(jobs_file):
+    """
+    Returns the path of the snapshot cache of the job database 'jobs_file'.
+    """
+    directory, name = os.path.split(os.path.abspath(str(jobs_file)))
+    return os.path.join(directory, ".%s.arcstat.json" % name)
+
+
+def get_ce(job_id):
+    """
+    Returns the host name of the CE from a job ID, e.g. ce1.dur.scotgrid.ac.uk from
+    gsiftp://ce1.dur.scotgrid.ac.uk:2811/jobs/<id>.
+    """
+    return job_id.split("://", 1)[-1].split("/", 1)[0].split(":", 1)[0]
+
+
+def parse(output):
+    """
+    Returns a list of job record dicts parsed from the output of 'arcstat', which
+    has a block per job, e.g.
+        Job: gsiftp://ce1.dur.scotgrid.ac.uk:2811/jobs/<id>
+         Name: run_sherpa.py.501
+         State: Finished
+         Exit Code: 0
+    and a warning per job it has no information on.
+    """
+    jobs = []
+    job = None
+    for line in output.splitlines():
+        stripped = line.strip()
+        if line.startswith("Job: "):
+            job = {"job_id" : stripped[len("Job: "):].strip(), "state" : None}
+            jobs.append(job)
+        elif "Job information not found" in line and ":" in stripped:
+            # The job ID ends the line, after the last ': '
+            jobs.append({"job_id" : stripped.rsplit(": ", 1)[-1], "state" : MISSING})
+            job = None
+        elif job is not None and ":" in stripped:
+            label, value = stripped.split(":", 1)
+            if label in FIELDS:
+                job[FIELDS[label]] = value.strip()
+        elif not stripped:
+            job = None
+
+    for job in jobs:
+        job["ce"] = get_ce(job["job_id"])
+        if job["state"]:
+            # e.g. 'Running (INLRMS:R)' in older clients
+            job["state"] = job["state"].split()[0]
+        else:
+            job["state"] = MISSING
+    return jobs
+
+
+def count_states(jobs):
+    """
+    Returns an OrderedDict of the number of 'jobs' in each state, listing every state
+    of STATES and then the other states found.
+    """
+    counts = OrderedDict((state, 0) for state in STATES)
+    for job in jobs:
+        counts[job["state"]] = counts.get(job["state"], 0) + 1
+    return counts
+
+
+def count_states_by_ce(jobs):
+    """
+    Returns an OrderedDict of the state counts (see count_states) of the 'jobs' on each CE.
+    """
+    ces = OrderedDict()
+    for job in jobs:
+        ces.setdefault(get_ce(job["job_id"]), []).append(job)
+    return OrderedDict((ce, count_states(ce_jobs)) for ce, ce_jobs in sorted(ces.items()))
+
+
+def query(jobs_file):
+    """
+    Runs 'arcstat' once over 'jobs_file' and returns a snapshot dict of its output.
+    """
+    print("Querying the status of the jobs in %s" % jobs_file)
+    output = os.popen("arcstat -j %s" % jobs_file).read()
+    return {"time" : time.time(), "jobs_file" : str(jobs_file), "output" : output, "jobs" : parse(output)}
+
+
+def get_snapshot(jobs_file="multijobs.dat", ttl=300):
+    """
+    Returns the snapshot of the statuses of the jobs in 'jobs_file', reusing the cached
+    one if it is less than 'ttl' seconds old and newer than the job database, and
+    otherwise querying arcstat and caching the result.
+    """
+    cache_file = get_cache_file(jobs_file)
+    if ttl > 0 and os.path.isfile(cache_file):
+        try:
+            with open(cache_file) as cache:
+                snapshot = json.load(cache)
+        except ValueError:
+            snapshot = None
+        jobs_time = os.path.getmtime(jobs_file) if os.path.isfile(jobs_file) else 0
+        if snapshot and jobs_time < snapshot["time"] and time.time() - snapshot["time"] < ttl:
+            print("Using the job statuses from %.0f(s) ago" % (time.time() - snapshot["time"]))
+            return snapshot
+
+    snapshot = query(jobs_file)
+    with open(cache_file, "w") as cache:
+        json.dump(snapshot, cache)
+    return snapshot
+
+
+def get_summary(snapshot):
+    """
+    Returns a dict of the time, total, per-state counts (overall and on each CE) and
+    job records of 'snapshot'.
+    """
+    return OrderedDict([("time", snapshot["time"]),
+                        ("total", len(snapshot["jobs"])),
+                        ("counts", count_states(snapshot["jobs"])),
+                        ("ces", count_states_by_ce(snapshot["jobs"])),
+                        ("jobs", snapshot["jobs"])])
+
+
+def write_report(snapshot, filename="logfile.txt"):
+    """
+    Writes the arcstat output of 'snapshot' and the number of jobs in each state to
+    the plain-text report 'filename'.
+    """
+    counts = count_states(snapshot["jobs"])
+    with open(filename, "w") as logfile:
+        logfile.write("=" * 80 + "\n")
+        logfile.write("-" * 32 + " JOB INFORMATION " + "-" * 31 + "\n")
+        logfile.write("=" * 80 + "\n")
+        logfile.write(snapshot["output"])
+        logfile.write("\n" + "=" * 80 + "\n")
+        logfile.write("-" * 30 + " SUMMARY INFORMATION " + "-" * 29 + "\n")
+        logfile.write("=" * 80 + "\n")
+        logfile.write("Status as of %s\n" % time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(snapshot["time"])))
+        logfile.write("Total jobs: %s\n" % len(snapshot["jobs"]))
+        for state, count in counts.items():
+            logfile.write("Number of %s jobs: %s\n" % (state.lower(), count))
+
+        ces = count_states_by_ce(snapshot["jobs"])
+        if len(ces) > 1:
+            for ce, ce_counts in ces.items():
+                logfile.write("%s: %s\n" % (ce, ", ".join("%s %s" % (count, state.lower()) for state, count in ce_counts.items() if count)))
+
+
+def write_json(snapshot, filename):
+    """
+    Writes the summary of 'snapshot' with every job record to 'filename' as JSON.
+    """
+    with open(filename, "w") as json_file:
+        json.dump(get_summary(snapshot), json_file, indent = 1)
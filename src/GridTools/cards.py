@@ -0,0 +1,52 @@
+"""
+Renders the per-seed run cards (HEJ YAML configs, Pythia .cmnd files) from templates.
+
+The base cards are read once per node, when the environment is set, and each seed's card
+is produced by applying its substitutions in memory and writing the result atomically,
+in place of a copy followed by a chain of 'sed -i' processes. Substitutions are
+(pattern, replacement) pairs with the meaning of sed's 's/pattern/replacement/g',
+applied in order; '.' does not match a newline, so a pattern never spans lines.
+"""
+import os
+import re
+
+
+class CardTemplate():
+
+
+    def __init__(self, filename):
+        """
+        Reads the base card 'filename'.
+        """
+        self.filename = str(filename)
+        with open(self.filename) as card:
+            self.text = card.read()
+
+
+    def render(self, filename, substitutions):
+        """
+        Writes the card with the (pattern, replacement) 'substitutions' applied to 'filename'.
+        """
+        text = self.text
+        for pattern, replacement in substitutions:
+            # Replacements are taken literally rather than as re templates
+            text = re.sub(pattern, lambda match: replacement, text)
+        write(filename, text)
+
+
+def write(filename, text):
+    """
+    Writes 'text' to 'filename' via a temporary file, so that a partially written card
+    is never visible under its final name.
+    """
+    tmp_filename = "%s.tmp%s" % (filename, os.getpid())
+    with open(tmp_filename, "w") as card:
+        card.write(text)
+    os.rename(tmp_filename, filename)
+
+
+def load_templates(base_dir, names):
+    """
+    Returns a dict of the CardTemplate for each card in 'names' in the directory 'base_dir'.
+    """
+    return dict((name, CardTemplate(os.path.join(str(base_dir), name))) for name in names)
@@ -0,0 +1,472 @@
+#!/usr/bin/env python
+"""
+Indexed SQLite ledger of the jobs of a campaign.
+
+Every submitted job is recorded in jobs.db (next to the ARC job database multijobs.dat)
+with its job ID, job number, the seeds it is expected to run, its CE, submission time,
+last known state, output directory and xRSL description. The table is indexed by job
+number, state, CE and submission time, so that subsets of campaigns of 100k+ jobs are
+selected in well under a second, and the selected job IDs are handed to the ARC tools in
+a file (their '-i' option) rather than acting on the whole of multijobs.dat. A seed is
+found through the job number it was derived from, inverting the pairing function of
+get_unique_seed. Submitting a job number again supersedes its earlier jobs, which are
+kept but left out of selections unless asked for. Pilot jobs are recorded under negative
+job numbers of their own (see get_pilot_numbers).
+Jobs whose submission has an unknown outcome (e.g. 'arcsub' timed out) are recorded in
+the state Unknown under a placeholder ID. 'status' looks for them by job name among
+the jobs of the CE (synced into the ARC job database with 'arcsync'): those found get
+their job ID, the others are marked Absent and only then are they submitted again by
+the managers or 'resubmit'. From the directory of a campaign,
+    python jobdb.py status --state Running --ce ce2.dur.scotgrid.ac.uk
+    python jobdb.py kill --jobs 1-500
+    python jobdb.py clean --state Finished
+    python jobdb.py resubmit --state Failed
+    python jobdb.py list --seed 12345
+query the CE for, kill, clean, resubmit (from the recorded descriptions) or list the
+selected jobs.
+"""
+import argparse
+import math
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from GridTools import arcstatus
+
+
+DATABASE = "jobs.db"
+# Flat ledger written by earlier versions of the submission engine, imported once
+FLAT_LEDGER = "submitted.dat"
+COLUMNS = ["job_id", "job_number", "seeds", "ce", "submit_time", "state", "state_time", "output_dir", "description", "superseded"]
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id      TEXT PRIMARY KEY,
+    job_number  INTEGER NOT NULL,
+    seeds       TEXT,
+    ce          TEXT,
+    submit_time REAL,
+    state       TEXT,
+    state_time  REAL,
+    output_dir  TEXT,
+    description TEXT,
+    superseded  INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS jobs_job_number ON jobs (job_number);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (superseded, state);
+CREATE INDEX IF NOT EXISTS jobs_ce ON jobs (ce, state);
+CREATE INDEX IF NOT EXISTS jobs_submit_time ON jobs (submit_time);
+"""
+# State given to jobs once submitted, until the CE is queried
+SUBMITTED = "Submitted"
+# State of jobs the CE may or may not have accepted, and of those confirmed not to be there
+UNKNOWN = "Unknown"
+ABSENT = "Absent"
+# States the jobs are left in by the ARC tools
+ARC_STATES = {"arckill" : "Killed", "arcclean" : "Cleaned"}
+# Job name in an xRSL description
+JOB_NAME_PATTERN = re.compile(r"\(jobname\s*=\s*'?([^)'\s]+)'?\)")
+
+
+def get_seeds(job_number, runs):
+    """
+    Returns the seeds of runs 0 to runs - 1 of job 'job_number', as get_unique_seed
+    (Cantor's pairing function) gives them.
+    """
+    return [int(0.5 * (int(job_number) + run) * (int(job_number) + run + 1) + run) for run in range(int(runs))]
+
+
+def get_job_number(seed, runs=None):
+    """
+    Returns the job number whose runs include 'seed', inverting Cantor's pairing function.
+    Raises ValueError if 'seed' is negative, or is not among the first 'runs' runs of
+    that job when 'runs' is given.
+    """
+    seed = int(seed)
+    if seed < 0:
+        raise ValueError("Seed %s is negative, no job runs it" % seed)
+    w = int((math.sqrt(8 * seed + 1) - 1) // 2)
+    run = seed - w * (w + 1) // 2
+    if runs is not None and run >= int(runs):
+        raise ValueError("Seed %s would be run %s of job %s, which runs %s seeds" % (seed, run, w - run, runs))
+    return w - run
+
+
+def get_unknown_id(job_number, ce):
+    """
+    Returns a placeholder ID for job 'job_number', whose submission to 'ce' has an
+    unknown outcome, unique to the attempt.
+    """
+    return "unknown://%s/job%s/%.6f" % (ce, job_number, time.time())
+
+
+def get_job_name(description):
+    """
+    Returns the job name of the xRSL 'description', or None if it has none.
+    """
+    match = JOB_NAME_PATTERN.search(description or "")
+    return match.group(1) if match else None
+
+
+def get_pilot_numbers(pilots, filename=DATABASE):
+    """
+    Returns the job numbers of 'pilots' new pilot jobs. Pilots are recorded under negative
+    job numbers, counting down from the last pilot in the job database 'filename', so
+    that they never clash with the job numbers they claim from the work queue, nor with
+    the pilots submitted before them.
+    """
+    last = 0
+    if os.path.isfile(filename):
+        last = min(JobDatabase(filename).get_lowest_job_number(), 0)
+    return list(range(last - 1, last - 1 - int(pilots), -1))
+
+
+def parse_ranges(ranges):
+    """
+    Returns the (first, last) job number pairs of a list like '1-100,205'.
+    """
+    pairs = []
+    for item in str(ranges).split(","):
+        if not item.strip():
+            continue
+        first, _, last = item.partition("-")
+        pairs.append((int(first), int(last or first)))
+    return pairs
+
+
+class JobDatabase():
+
+
+    def __init__(self, filename=DATABASE):
+        """
+        Opens (creating if needed) the job database 'filename'. A new database takes
+        in the jobs of a flat ledger left in the same directory.
+        """
+        self.filename = str(filename)
+        new = not os.path.isfile(self.filename)
+        # Shared by the submission threads, one statement at a time
+        self.connection = sqlite3.connect(self.filename, check_same_thread = False)
+        self.connection.executescript(SCHEMA)
+        self.lock = threading.Lock()
+
+        ledger = os.path.join(os.path.dirname(os.path.abspath(self.filename)), FLAT_LEDGER)
+        if new and os.path.isfile(ledger):
+            self.import_ledger(ledger)
+
+
+    def import_ledger(self, ledger):
+        """
+        Records the jobs of the flat ledger 'ledger' ('job_number job_id ce time' lines).
+        """
+        rows = []
+        with open(ledger) as ledger_file:
+            for line in ledger_file:
+                fields = line.split()
+                if len(fields) == 4:
+                    rows.append({"job_number" : int(fields[0]), "job_id" : fields[1], "ce" : fields[2], "submit_time" : float(fields[3])})
+        self.record_many(rows)
+        print("Imported %s jobs from %s" % (len(rows), ledger))
+
+
+    def record_many(self, rows):
+        """
+        Records the submitted jobs given as dicts of COLUMNS (job_id and job_number
+        required), superseding the earlier jobs of the same job numbers.
+        """
+        with self.lock:
+            with self.connection:
+                self.connection.executemany("UPDATE jobs SET superseded = 1 WHERE job_number = ? AND superseded = 0",
+                                            [(row["job_number"],) for row in rows])
+                self.connection.executemany("INSERT OR REPLACE INTO jobs (%s) VALUES (%s)" % (", ".join(COLUMNS), ", ".join("?" for column in COLUMNS)),
+                                            [tuple(row.get(column, SUBMITTED if column == "state" else 0 if column == "superseded" else None) for column in COLUMNS) for row in rows])
+
+
+    def record(self, job_number, job_id, ce, seeds=None, output_dir=None, description=None, state=SUBMITTED):
+        """
+        Records a submitted job, superseding the earlier jobs of the same job number,
+        whose seeds and output directory it keeps unless given others.
+        """
+        if seeds is None or output_dir is None:
+            with self.lock:
+                earlier = self.connection.execute("SELECT seeds, output_dir FROM jobs WHERE job_number = ? ORDER BY submit_time DESC LIMIT 1",
+                                                  (int(job_number),)).fetchone()
+            if earlier:
+                seeds = seeds or (earlier[0].split() if earlier[0] else None)
+                output_dir = output_dir or earlier[1]
+        self.record_many([{"job_number" : job_number, "job_id" : job_id, "ce" : ce, "submit_time" : time.time(),
+                           "seeds" : " ".join(str(seed) for seed in seeds) if seeds else None,
+                           "output_dir" : output_dir, "description" : description, "state" : state}])
+
+
+    def get_submitted(self):
+        """
+        Returns the set of job numbers with a current job, other than jobs confirmed
+        absent from the CE.
+        """
+        with self.lock:
+            return set(row[0] for row in self.connection.execute("SELECT DISTINCT job_number FROM jobs WHERE superseded = 0 AND state != ?", (ABSENT,)))
+
+
+    def get_lowest_job_number(self):
+        """
+        Returns the lowest job number recorded, or 0 if there are no jobs.
+        """
+        with self.lock:
+            return self.connection.execute("SELECT MIN(job_number) FROM jobs").fetchone()[0] or 0
+
+
+    def get_seed_job_number(self, seed):
+        """
+        Returns the job number whose runs include 'seed', checking it against the seeds
+        recorded for that job, if any. Raises ValueError if no job runs 'seed'.
+        """
+        job_number = get_job_number(seed)
+        with self.lock:
+            rows = self.connection.execute("SELECT seeds FROM jobs WHERE job_number = ? AND seeds IS NOT NULL", (job_number,)).fetchall()
+        if not rows:
+            return job_number
+        return get_job_number(seed, max(len(row[0].split()) for row in rows))
+
+
+    def get_where(self, states=None, ces=None, job_ranges=None, seed=None, superseded=False):
+        """
+        Returns the SQL condition and its parameters selecting the current jobs (or all
+        of them if 'superseded' is set) in any of 'states', on any of 'ces', with a job
+        number in any of the (first, last) 'job_ranges', and running 'seed'. Raises
+        ValueError if no job runs 'seed'.
+        """
+        conditions = [] if superseded else ["superseded = 0"]
+        parameters = []
+        if states:
+            conditions.append("state IN (%s)" % ", ".join("?" for state in states))
+            parameters.extend(states)
+        if ces:
+            conditions.append("ce IN (%s)" % ", ".join("?" for ce in ces))
+            parameters.extend(ces)
+        if job_ranges:
+            conditions.append("(%s)" % " OR ".join("job_number BETWEEN ? AND ?" for job_range in job_ranges))
+            for first, last in job_ranges:
+                parameters.extend([first, last])
+        if seed is not None:
+            conditions.append("job_number = ?")
+            parameters.append(self.get_seed_job_number(seed))
+        return " AND ".join(conditions) or "1", parameters
+
+
+    def select(self, columns=COLUMNS, **filters):
+        """
+        Returns the jobs matching 'filters' (see get_where) as dicts of 'columns',
+        in order of job number.
+        """
+        where, parameters = self.get_where(**filters)
+        with self.lock:
+            cursor = self.connection.execute("SELECT %s FROM jobs WHERE %s ORDER BY job_number" % (", ".join(columns), where), parameters)
+            return [dict(zip(columns, row)) for row in cursor]
+
+
+    def count_states(self, **filters):
+        """
+        Returns an OrderedDict of the number of jobs matching 'filters' in each state,
+        on each CE, as {ce : {state : count}}.
+        """
+        where, parameters = self.get_where(**filters)
+        counts = OrderedDict()
+        with self.lock:
+            cursor = self.connection.execute("SELECT ce, state, COUNT(*) FROM jobs WHERE %s GROUP BY ce, state ORDER BY ce, state" % where, parameters)
+            for ce, state, count in cursor:
+                counts.setdefault(ce, OrderedDict())[state] = count
+        return counts
+
+
+    def update_states(self, jobs, state_time=None):
+        """
+        Sets the last known state of the jobs in 'jobs', a list of records from
+        GridTools.arcstatus.parse, or of (job ID, state) pairs.
+        """
+        state_time = state_time or time.time()
+        rows = [(job["state"], state_time, job["job_id"]) if isinstance(job, dict) else (job[1], state_time, job[0]) for job in jobs]
+        with self.lock:
+            with self.connection:
+                self.connection.executemany("UPDATE jobs SET state = ?, state_time = ? WHERE job_id = ?", rows)
+
+
+    def resolve_unknown(self, jobs, found, state_time=None):
+        """
+        Gives the Unknown 'jobs' (dicts of at least job_id and description) found among
+        'found', the records of GridTools.arcstatus.parse of every job on their CEs,
+        their job ID and state, and marks the others Absent. Returns the number found.
+        """
+        state_time = state_time or time.time()
+        names = dict((job["name"], job) for job in found if job.get("name"))
+        resolved = []
+        absent = []
+        for job in jobs:
+            record = names.get(get_job_name(job["description"]))
+            if record:
+                resolved.append((record["job_id"], record["state"], state_time, job["job_id"]))
+            else:
+                absent.append((ABSENT, state_time, job["job_id"]))
+        with self.lock:
+            with self.connection:
+                self.connection.executemany("UPDATE jobs SET job_id = ?, state = ?, state_time = ? WHERE job_id = ?", resolved)
+                self.connection.executemany("UPDATE jobs SET state = ?, state_time = ? WHERE job_id = ?", absent)
+        return len(resolved)
+
+
+def find_unknown(database, jobs, jobs_file="multijobs.dat"):
+    """
+    Looks for the Unknown 'jobs' among the jobs on their CEs, first adding any the CEs
+    hold that are missing from 'jobs_file' with 'arcsync'.
+    """
+    ces = sorted(set(job["ce"] for job in jobs))
+    print("Looking for %s jobs with unknown submission outcome on %s" % (len(jobs), ", ".join(ces)))
+    os.system("arcsync -f -j %s%s" % (jobs_file, "".join(" -c %s" % ce for ce in ces)))
+    resolved = database.resolve_unknown(jobs, arcstatus.query(jobs_file)["jobs"])
+    print("Found %s of them, %s are absent and may be submitted again" % (resolved, len(jobs) - resolved))
+
+
+def run_arc(command, job_ids, jobs_file="multijobs.dat"):
+    """
+    Runs the ARC tool 'command' (e.g. 'arckill') on 'job_ids' only, passing them in a
+    file, and returns its output.
+    """
+    with tempfile.NamedTemporaryFile(mode = "w", suffix = ".jobids") as id_file:
+        id_file.write("\n".join(job_ids) + "\n")
+        id_file.flush()
+        return os.popen("%s -j %s -i %s" % (command, jobs_file, id_file.name)).read()
+
+
+def run_and_record(database, command, job_ids, jobs_file="multijobs.dat"):
+    """
+    Runs 'arckill' or 'arcclean' on 'job_ids' only, records the state it leaves the jobs
+    in and returns its output.
+    """
+    output = run_arc(command, job_ids, jobs_file)
+    database.update_states([(job_id, ARC_STATES[command]) for job_id in job_ids])
+    return output
+
+
+def kill_or_clean(command, ces=None, jobs_file="multijobs.dat", filename=DATABASE):
+    """
+    Runs 'arckill' or 'arcclean' on the current jobs on any of 'ces' (all of them if none
+    are given) in the job database 'filename', recording their state, for the '-k', '-c'
+    and '-f' options of the managers. Without a job database, the command acts on every
+    job of 'jobs_file' on 'ces' as before.
+    """
+    if not os.path.isfile(filename):
+        os.system("%s -j %s%s" % (command, jobs_file, "".join(" -c %s" % ce for ce in ces or [])))
+        return
+    database = JobDatabase(filename)
+    # Jobs with a placeholder ID are not known to the CE
+    job_ids = [job["job_id"] for job in database.select(["job_id", "state"], ces = ces) if job["state"] not in (UNKNOWN, ABSENT)]
+    print("Selected %s jobs" % len(job_ids))
+    if job_ids:
+        print(run_and_record(database, command, job_ids, jobs_file))
+
+
+def print_counts(counts):
+    """
+    Prints the number of jobs in each state, in total and on each CE.
+    """
+    totals = OrderedDict()
+    for ce, states in counts.items():
+        for state, count in states.items():
+            totals[state] = totals.get(state, 0) + count
+    print("Total jobs: %s" % sum(totals.values()))
+    for state, count in sorted(totals.items()):
+        print("Number of %s jobs: %s" % (state.lower(), count))
+    if len(counts) > 1:
+        for ce, states in counts.items():
+            print("%s: %s" % (ce, ", ".join("%s %s" % (count, state.lower()) for state, count in states.items())))
+
+
+def parse():
+    """
+    Parse command line arguments.
+        command    : status, kill, clean, resubmit or list
+        database   : job database, by default jobs.db
+        jobs_file  : ARC job database, by default multijobs.dat
+        state      : select the jobs in this last known state (may be repeated)
+        ce         : select the jobs on this CE (may be repeated)
+        jobs       : select the job numbers in these ranges, e.g. 1-100,205
+        seed       : select the job running this seed
+        superseded : select superseded jobs as well
+        to         : CE to resubmit to (may be repeated), by default the jobs' own CEs
+        workers    : int number of concurrent submissions when resubmitting
+    """
+    parser = argparse.ArgumentParser(description = "Usage: python jobdb.py {status,kill,clean,resubmit,list} [--state state] [--ce ce] [--jobs ranges] [--seed seed] [--superseded] [--to ce] [--workers workers]")
+    parser.add_argument('command', choices = ["status", "kill", "clean", "resubmit", "list"])
+    parser.add_argument('--database', '-d', type = str, default = DATABASE)
+    parser.add_argument('--jobs_file', '-j', type = str, default = "multijobs.dat")
+    parser.add_argument('--state', action = "append", default = [])
+    parser.add_argument('--ce', action = "append", default = [])
+    parser.add_argument('--jobs', type = str, default = None)
+    parser.add_argument('--seed', type = int, default = None)
+    parser.add_argument('--superseded', action = "store_true")
+    parser.add_argument('--to', action = "append", default = [])
+    parser.add_argument('--workers', type = int, default = 4)
+    return parser.parse_args()
+
+
+def main():
+    """
+    Acts on the jobs of the job database selected on the command line.
+    """
+    args = parse()
+    database = JobDatabase(args.database)
+    if args.seed is not None:
+        try:
+            database.get_seed_job_number(args.seed)
+        except ValueError as error:
+            sys.exit(str(error))
+    filters = {"states" : args.state, "ces" : args.ce, "job_ranges" : parse_ranges(args.jobs) if args.jobs else None,
+               "seed" : args.seed, "superseded" : args.superseded}
+
+    if args.command == "list":
+        for job in database.select(["job_number", "job_id", "ce", "state", "seeds"], **filters):
+            print("%s %s %s %s %s" % (job["job_number"], job["job_id"], job["ce"], job["state"], job["seeds"] or ""))
+        return
+
+    jobs = database.select(["job_id", "job_number", "ce", "state", "description"], **filters)
+    print("Selected %s jobs" % len(jobs))
+    if not jobs:
+        return
+    unknown = [job for job in jobs if job["state"] == UNKNOWN]
+    if unknown and args.command != "status":
+        print("Leaving out %s jobs with unknown submission outcome, run status on them first" % len(unknown))
+    # Jobs with a placeholder ID are only ever resubmitted, once confirmed absent
+    jobs = [job for job in jobs if job["state"] != UNKNOWN and (job["state"] != ABSENT or args.command == "resubmit")]
+    job_ids = [job["job_id"] for job in jobs]
+
+    if args.command == "status":
+        if unknown:
+            find_unknown(database, unknown, args.jobs_file)
+        if job_ids:
+            database.update_states(arcstatus.parse(run_arc("arcstat", job_ids, args.jobs_file)))
+        print_counts(database.count_states(**filters))
+        return
+    if not jobs:
+        return
+    if args.command == "kill":
+        print(run_and_record(database, "arckill", job_ids, args.jobs_file))
+    elif args.command == "clean":
+        print(run_and_record(database, "arcclean", job_ids, args.jobs_file))
+    elif args.command == "resubmit":
+        # Imported here since the submission engine records its jobs in this module
+        from GridTools import submission, xrsl
+        missing = [job["job_number"] for job in jobs if not job["description"]]
+        if missing:
+            print("No description recorded for %s jobs, resubmit them with their manager" % len(missing))
+        descriptions = [(job["job_number"], job["description"]) for job in jobs if job["description"]]
+        ces = args.to or sorted(set(job["ce"] for job in jobs))
+        submitter = submission.Submitter([(ce, 1.0) for ce in ces], args.jobs_file, args.database, workers = args.workers)
+        submitter.run(xrsl.write_all(descriptions), resubmit = True)
+
+
+if __name__ == """__main__""":
+    main()
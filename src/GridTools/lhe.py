@@ -0,0 +1,122 @@
+"""
+Helpers for the Les Houches event files passed between the generator stages.
+
+Event files run to many gigabytes, while what the job scripts need from them lives in a
+few kilobytes at either end: these helpers only touch the header (everything before the
+'<init>' block) and the last lines after the events, rather than rewriting or scanning
+the whole file.
+"""
+import gzip
+import os
+import re
+
+
+HEADER_END = b"<init>"
+BLOCK_SIZE = 64 * 1024
+
+
+def read_header(event_file, max_size=64 * 1024 * 1024):
+    """
+    Returns the bytes of the open 'event_file' from its current position up to (not
+    including) the '<init>' block, reading at most 'max_size' bytes.
+    """
+    header = b""
+    while len(header) < max_size:
+        block = event_file.read(BLOCK_SIZE)
+        if not block:
+            break
+        # Search from just before the new block, as the tag may straddle two blocks
+        start = max(len(header) - len(HEADER_END), 0)
+        header += block
+        end = header.find(HEADER_END, start)
+        if end >= 0:
+            return header[:end]
+    return header
+
+
+def patch_header(filename, old, new):
+    """
+    Replaces every occurrence of 'old' in the header of the event file 'filename' by
+    'new' in place given:
+        filename : path of an uncompressed LHE file
+        old      : bytes to replace, e.g. b'version="1.0"'
+        new      : replacement bytes of the same length as 'old'
+    Only the bytes being replaced are rewritten, so the cost does not grow with the
+    number of events. Returns the number of replacements.
+    """
+    if len(old) != len(new):
+        raise ValueError("Cannot patch %r into %r in place: lengths differ" % (old, new))
+
+    replacements = 0
+    with open(filename, "r+b") as event_file:
+        header = read_header(event_file)
+        offset = header.find(old)
+        while offset >= 0:
+            event_file.seek(offset)
+            event_file.write(new)
+            replacements += 1
+            offset = header.find(old, offset + len(old))
+    return replacements
+
+
+TRIALS_PATTERN = re.compile(br"^# Number of Trials\s+:\s+(\d+)", re.MULTILINE)
+
+
+def search_stream(event_file, pattern, overlap=4096):
+    """
+    Returns the first match of the bytes 'pattern' in the open 'event_file', read block
+    by block from its current position, or None. Matches may span lines, but not more
+    than 'overlap' bytes.
+    """
+    window = b""
+    while True:
+        block = event_file.read(BLOCK_SIZE)
+        window += block
+        match = pattern.search(window)
+        # A match running up to the end of the window may continue in the next block
+        if match and (not block or match.end() < len(window)):
+            return match
+        if not block:
+            return None
+        # Keep the tail from a line start, so that '^' only matches real line starts
+        cut = window.rfind(b"\n", max(len(window) - overlap, 0))
+        window = window[cut:] if cut >= 0 else window[-overlap:]
+
+
+def search_ends(filename, pattern, tail_size=1024 * 1024):
+    """
+    Returns the first match of the bytes 'pattern' in the header or, failing that, in
+    the last 'tail_size' bytes of the uncompressed file 'filename', or None. Only these
+    two regions are read, however large the file.
+    """
+    with open(filename, "rb") as event_file:
+        match = pattern.search(read_header(event_file))
+        if match:
+            return match
+
+        event_file.seek(0, os.SEEK_END)
+        start = max(event_file.tell() - tail_size, 0)
+        event_file.seek(start)
+        tail = event_file.read()
+        if start > 0:
+            # Drop the partial first line
+            tail = tail[tail.find(b"\n"):]
+        return pattern.search(tail)
+
+
+def get_total_trials(filename):
+    """
+    Returns the number of trials Sherpa records ('# Number of Trials : N') in the event
+    file 'filename'. Plain files are only read at the header and trailer, while gzipped
+    files ('.gz') are decompressed as a stream until the field is found.
+    Raises ValueError if the file has no such field.
+    """
+    if filename.endswith(".gz"):
+        with gzip.open(filename, "rb") as event_file:
+            match = search_stream(event_file, TRIALS_PATTERN)
+    else:
+        match = search_ends(filename, TRIALS_PATTERN)
+
+    if match is None:
+        raise ValueError("No '# Number of Trials' field found in %s" % filename)
+    return int(match.group(1))
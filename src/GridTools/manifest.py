@@ -0,0 +1,126 @@
+"""
+Keeps a persistent record of the output files already retrieved from grid storage,
+so that repeated finalises only transfer (and organise) new files.
+"""
+import json
+import os
+
+from GridTools import storage, transfer
+
+
+class Manifest():
+
+
+    def __init__(self, filename):
+        """
+        Loads (or creates) a manifest of retrieved files given:
+            filename : path of the JSON manifest file
+        Each entry records the size, ADLER32 checksum and whether the file has been organised,
+        or has failed to be.
+        """
+        self.filename = str(filename)
+        self.files = {}
+        if os.path.exists(self.filename):
+            with open(self.filename) as manifest_file:
+                self.files = json.load(manifest_file)
+
+
+    def save(self):
+        """
+        Writes the manifest atomically.
+        """
+        tmp_filename = "%s.tmp" % self.filename
+        with open(tmp_filename, "w") as manifest_file:
+            json.dump(self.files, manifest_file, indent=1, sort_keys=True)
+        os.rename(tmp_filename, self.filename)
+
+
+    def add(self, name, path):
+        """
+        Records the retrieved file 'name' stored locally at 'path'.
+        """
+        self.files[name] = {
+            "size"      : os.path.getsize(path),
+            "checksum"  : storage.get_file_checksum(path),
+            "organised" : False,
+        }
+
+
+    def is_retrieved(self, name, size):
+        """
+        Returns True if 'name' has already been retrieved with the given size.
+        """
+        entry = self.files.get(name)
+        return entry is not None and entry["size"] == size
+
+
+    def get_missing(self, listing, local_dir):
+        """
+        Returns the names in a remote listing of (name, size) pairs which have not been
+        retrieved yet. Files already present in 'local_dir' with the right size (e.g. from a
+        finalise before the manifest existed) are recorded rather than transferred again.
+        """
+        missing = []
+        for name, size in listing:
+            if self.is_retrieved(name, size):
+                continue
+            path = os.path.join(local_dir, name)
+            if os.path.exists(path) and os.path.getsize(path) == size:
+                self.add(name, path)
+                continue
+            missing.append(name)
+        return missing
+
+
+    def get_unorganised(self):
+        """
+        Returns the names of retrieved files which have not been organised yet, leaving
+        out those which failed to be until they are retrieved again.
+        """
+        return sorted(name for name, entry in self.files.items() if not entry["organised"] and not entry.get("failed"))
+
+
+    def set_organised(self, names):
+        """
+        Marks the files in 'names' as organised.
+        """
+        for name in names:
+            self.files[name]["organised"] = True
+            self.files[name]["failed"] = False
+
+
+    def set_failed(self, names):
+        """
+        Marks the files in 'names' as having failed to be organised.
+        """
+        for name in names:
+            self.files[name]["failed"] = True
+        if names:
+            print("%s files could not be organised and are recorded as failed in %s:" % (len(names), self.filename))
+            for name in names:
+                print("    %s" % name)
+
+
+def retrieve_new(remote_dir, local_dir, manifest, streams=8, save_every=100):
+    """
+    Copies the files in 'remote_dir' which are not in the manifest to 'local_dir' over
+    'streams' concurrent transfers, recording each one as it arrives. Returns the list
+    of newly retrieved names.
+    """
+    missing = manifest.get_missing(storage.list_dir(remote_dir), local_dir)
+    print("%s new files to retrieve from %s" % (len(missing), remote_dir))
+    transfers = [("%s/%s" % (remote_dir.rstrip("/"), name), os.path.join(local_dir, name)) for name in missing]
+
+    retrieved = []
+    def record(source, destination):
+        name = os.path.basename(destination)
+        manifest.add(name, destination)
+        retrieved.append(name)
+        if len(retrieved) % save_every == 0:
+            manifest.save()
+
+    try:
+        transfer.BulkTransfer(streams).run(transfers, on_success = record)
+    finally:
+        manifest.save()
+    return retrieved
@@ -0,0 +1,104 @@
+"""
+Merges the results of all the runs of a submission on the node before uploading them.
+
+With pre-merging the runs leave their results tarballs in a spool directory instead of
+uploading them. Once every run of the submission has finished, the YODA files of the
+same category and scale variation (the same file name up to the seed) are merged into
+one partial merge (see GridTools.yoda) named after the job number, e.g. HEJ_<seed>.yoda
+into HEJ_job<job_number>.yoda, and a single tarball holding the merged files and the
+runs' cards is uploaded. The mergers sort and merge these files as they do the output
+of single runs, with the same result as merging every run's output.
+"""
+import os
+import re
+import shutil
+import tarfile
+from collections import OrderedDict
+
+from GridTools import storage
+
+
+# Results tarballs are named <prefix><seed>.tar.gz
+TARBALL_PATTERN = re.compile(r"^(.*?)(\d+)\.tar\.gz$")
+
+
+def get_merged_name(name, seed, job_number):
+    """
+    Returns the name of the merged file that the output file 'name' of the run 'seed'
+    goes into: 'name' with the seed replaced by 'job<job_number>'.
+    """
+    return re.sub(r"(?<=[-_])%s(?=[._])" % seed, "job%s" % job_number, name, count = 1)
+
+
+def merge_spool(spool_dir, names, job_number, processes=1):
+    """
+    Merges the results tarballs 'names' in 'spool_dir' and returns the path of the
+    tarball holding the merged YODA files and the other files of every run.
+    """
+    # Imported here since NumPy is only required for merging
+    from GridTools import yoda
+
+    work_dir = os.path.join(spool_dir, "merged")
+    if os.path.exists(work_dir):
+        shutil.rmtree(work_dir)
+    os.makedirs(work_dir)
+
+    groups = OrderedDict()
+    prefix = ""
+    for name in names:
+        prefix, seed = TARBALL_PATTERN.match(name).groups()
+        seed_dir = os.path.join(work_dir, "seed_%s" % seed)
+        with tarfile.open(os.path.join(spool_dir, name), "r:*") as tarball:
+            tarball.extractall(seed_dir)
+        for member in sorted(os.listdir(seed_dir)):
+            if member.endswith((".yoda", ".yoda.gz")):
+                groups.setdefault(get_merged_name(member, seed, job_number), []).append(os.path.join(seed_dir, member))
+
+    for merged_name, paths in groups.items():
+        print("Merging %s yoda files into %s" % (len(paths), merged_name))
+        yoda.merge_files(paths, os.path.join(work_dir, merged_name), processes = processes, partial = True)
+        for path in paths:
+            os.remove(path)
+
+    merged_tarball = os.path.join(spool_dir, "%sjob%s.tar.gz" % (prefix, job_number))
+    with tarfile.open(merged_tarball, "w:gz") as tarball:
+        for name in sorted(os.listdir(work_dir)):
+            tarball.add(os.path.join(work_dir, name), arcname = name)
+    shutil.rmtree(work_dir)
+    return merged_tarball
+
+
+def upload(spool_dir, output_dir, job_number, processes=1, uploader=None):
+    """
+    Merges the results tarballs in 'spool_dir' and uploads the merged tarball to
+    'output_dir', or each tarball as it is if they cannot be merged. The spool is
+    removed once everything has been uploaded, or handed to 'uploader' (a
+    GridTools.upload.Uploader) if one is given. Returns True on success.
+    """
+    names = sorted(name for name in os.listdir(spool_dir) if TARBALL_PATTERN.match(name))
+    if not names:
+        print("No results to upload for job %s" % job_number)
+        return False
+
+    output_dir = str(output_dir).rstrip("/")
+    try:
+        merged_tarball = merge_spool(spool_dir, names, job_number, processes)
+        pairs = [(merged_tarball, "%s/%s" % (output_dir, os.path.basename(merged_tarball)))]
+        print("Merged the results of %s runs into %s" % (len(names), os.path.basename(merged_tarball)))
+    except Exception as error:
+        # e.g. NumPy missing on the node, or runs with different binnings
+        print("Pre-merging failed (%s), uploading the results of each run" % error)
+        pairs = [(os.path.join(spool_dir, name), "%s/%s" % (output_dir, name)) for name in names]
+
+    if uploader is not None:
+        # The uploader spools what it fails to upload, so nothing is left here
+        results = [uploader.save(source, destination) for source, destination in pairs]
+        shutil.rmtree(spool_dir)
+        return all(results)
+
+    results = storage.copy_many(pairs)
+    if not all(results):
+        print("Failed to upload %s" % " ".join(source for (source, destination), result in zip(pairs, results) if not result))
+        return False
+    shutil.rmtree(spool_dir)
+    return True
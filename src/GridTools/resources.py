@@ -0,0 +1,180 @@
+"""
+Sizes the number of concurrent runs to the node a job lands on.
+
+A node offers the CPUs the job may be scheduled on, capped by any cgroup CPU quota the
+batch system sets (cgroup v1 or v2), the memory left by its cgroup limit and the free
+memory of the node, and the free disk of the working directory. Each generator declares
+a Profile of what one run needs, and the number of runs is the most the node fits.
+"""
+import multiprocessing
+import os
+
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+MB = 1024 * 1024
+
+
+class Profile():
+
+
+    def __init__(self, memory, disk, disk_per_event=0.0):
+        """
+        Describes the resources one run of a generator needs given:
+            memory         : peak memory of a run in MB
+            disk           : disk used by a run in MB, besides its event files
+            disk_per_event : disk used by the event files of a run in kB per event
+        """
+        self.memory = float(memory)
+        self.disk = float(disk)
+        self.disk_per_event = float(disk_per_event)
+
+
+    def get_memory(self):
+        """
+        Returns the memory needed by one run in bytes.
+        """
+        return self.memory * MB
+
+
+    def get_disk(self, events):
+        """
+        Returns the disk needed by one run of 'events' events in bytes.
+        """
+        return self.disk * MB + self.disk_per_event * 1024 * int(events)
+
+
+def read_value(filename):
+    """
+    Returns the stripped contents of 'filename', or None if it cannot be read.
+    """
+    try:
+        with open(filename) as value_file:
+            return value_file.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def get_cgroup_dirs(controller):
+    """
+    Returns (version, directory) pairs for the cgroup of this process holding
+    'controller' and each of its ancestors, since a limit may be set on any of them.
+    """
+    dirs = []
+    for line in (read_value("/proc/self/cgroup") or "").splitlines():
+        fields = line.split(":", 2)
+        if len(fields) != 3:
+            continue
+        hierarchy, controllers, path = fields
+        if hierarchy == "0" and controllers == "":
+            version, root = 2, CGROUP_ROOT
+        elif controller in controllers.split(","):
+            version, root = 1, os.path.join(CGROUP_ROOT, controllers)
+        else:
+            continue
+
+        # Inside a container the path may not exist, leaving the namespace root
+        path = path.strip("/")
+        while True:
+            directory = os.path.join(root, path)
+            if os.path.isdir(directory):
+                dirs.append((version, directory))
+            if not path:
+                break
+            path = os.path.dirname(path)
+    return dirs
+
+
+def get_cpu_quota():
+    """
+    Returns the tightest cgroup CPU quota in CPUs, or None if there is none.
+    """
+    quotas = []
+    for version, directory in get_cgroup_dirs("cpu"):
+        if version == 2:
+            # Format is 'quota period', with quota 'max' if unlimited
+            fields = (read_value(os.path.join(directory, "cpu.max")) or "max").split()
+            if fields[0] != "max" and len(fields) == 2:
+                quotas.append(float(fields[0]) / float(fields[1]))
+        else:
+            quota = read_value(os.path.join(directory, "cpu.cfs_quota_us"))
+            period = read_value(os.path.join(directory, "cpu.cfs_period_us"))
+            if quota and period and int(quota) > 0:
+                quotas.append(float(quota) / float(period))
+    if not quotas:
+        return None
+    return min(quotas)
+
+
+def get_cpu_count():
+    """
+    Returns the number of CPUs this process may use.
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = multiprocessing.cpu_count()
+
+    quota = get_cpu_quota()
+    if quota is not None:
+        cpus = min(cpus, max(int(quota), 1))
+    return cpus
+
+
+def get_memory_limit():
+    """
+    Returns the memory in bytes available to this process: the smaller of the tightest
+    cgroup memory limit and the memory available on the node, or None if neither is known.
+    """
+    limits = []
+    for version, directory in get_cgroup_dirs("memory"):
+        if version == 2:
+            value = read_value(os.path.join(directory, "memory.max"))
+        else:
+            value = read_value(os.path.join(directory, "memory.limit_in_bytes"))
+        if value and value.isdigit():
+            limits.append(int(value))
+
+    for line in (read_value("/proc/meminfo") or "").splitlines():
+        # Format is 'MemAvailable:   1234 kB'
+        fields = line.split()
+        if len(fields) >= 2 and fields[0] == "MemAvailable:":
+            limits.append(int(fields[1]) * 1024)
+
+    if not limits:
+        return None
+    return min(limits)
+
+
+def get_free_disk(path="."):
+    """
+    Returns the free disk in bytes of the filesystem holding 'path'.
+    """
+    stats = os.statvfs(path)
+    return stats.f_bavail * stats.f_frsize
+
+
+def get_concurrency(profile, events, requested=0):
+    """
+    Returns the number of concurrent runs of 'events' events each to start on this node
+    given the generator's resource 'profile': 'requested' runs if the node fits them,
+    otherwise (or if 'requested' is 0) as many as the node fits, and at least one.
+    """
+    cpus = get_cpu_count()
+    memory = get_memory_limit()
+    disk = get_free_disk()
+    print("Node resources: %s usable CPU(s), %s MB memory, %s MB free disk" % (cpus, memory // MB if memory is not None else "unknown", disk // MB))
+
+    limits = [("CPUs", cpus), ("disk", int(disk // profile.get_disk(events)))]
+    if memory is not None:
+        limits.append(("memory", int(memory // profile.get_memory())))
+    capacity, limit = min((number, name) for name, number in limits)
+    capacity = max(capacity, 1)
+
+    requested = int(requested)
+    if requested and requested <= capacity:
+        return requested
+    if requested:
+        print("Reducing the number of runs from %s to %s, limited by %s" % (requested, capacity, limit))
+    else:
+        print("Running %s runs, limited by %s" % (capacity, limit))
+    return capacity
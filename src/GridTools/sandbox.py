@@ -0,0 +1,87 @@
+"""
+Isolated working directories for the runs of a job on a node.
+
+Each run executes in its own directory under RUNS_DIR, named after its seed, instead of
+all runs sharing the job's working directory: the read-only run cards are symlinked in
+rather than copied, while the inputs the generator writes to (Sherpa's Results.db and
+Process/) are copied so that no run modifies the shared copy, every file a run writes
+stays in its directory, so the glob patterns used when
+packing results only see that run's files, and the directory is removed when the run
+ends. The tool directories stay in the job's working directory, which the environment
+variables set by set_env point at with absolute paths.
+"""
+import os
+import shutil
+
+
+RUNS_DIR = "runs"
+# Inputs written to by the generator, which each run needs a copy of
+WRITTEN_INPUTS = ("Results.db", "Process")
+
+
+class Sandbox():
+
+
+    def __init__(self, name, root=RUNS_DIR):
+        """
+        Initialises the sandbox 'name' in the directory 'root'.
+        """
+        self.path = os.path.abspath(os.path.join(str(root), str(name)))
+        self.previous_dir = None
+
+
+    def __enter__(self):
+        """
+        Creates the sandbox (replacing any left by an earlier attempt at the same run)
+        and makes it the working directory.
+        """
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        os.makedirs(self.path)
+        self.previous_dir = os.getcwd()
+        os.chdir(self.path)
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """
+        Restores the working directory and removes the sandbox with everything in it.
+        """
+        os.chdir(self.previous_dir)
+        shutil.rmtree(self.path, ignore_errors = True)
+        return False
+
+
+def link_inputs(paths, directory=".", written=WRITTEN_INPUTS):
+    """
+    Symlinks each of the input files or directories in 'paths' into 'directory' under
+    its base name, in place of copying it, except for those named in 'written' which
+    the generator writes to and are copied instead.
+    """
+    for path in paths:
+        if not os.path.exists(path):
+            print("Input %s not found, not linking it" % path)
+            continue
+        name = os.path.basename(os.path.normpath(path))
+        destination = os.path.join(directory, name)
+        if name not in written:
+            os.symlink(os.path.abspath(path), destination)
+        elif os.path.isdir(path):
+            shutil.copytree(path, destination, symlinks = True)
+        else:
+            shutil.copy2(path, destination)
+
+
+def run_job(job, run_number, events):
+    """
+    Runs 'job.run_job(run_number, events)' in the sandbox of its seed.
+    """
+    with Sandbox("seed_%s" % job.get_unique_seed(run_number)):
+        job.run_job(run_number, events)
+
+
+def clean(root=RUNS_DIR):
+    """
+    Removes the sandboxes left by runs that did not exit cleanly.
+    """
+    shutil.rmtree(str(root), ignore_errors = True)
@@ -0,0 +1,104 @@
+"""
+Runs the generator stages of a job as subprocesses.
+
+Commands are split like a shell would split them but run without one, so that arguments
+such as EVENT_OUTPUT=LHEfix[SherpaLHE_1] are passed through as they are and each
+process can be signalled directly. A stage fails if it exits with a non-zero status,
+exceeds its wall-time limit (it is then killed) or does not produce its outputs; the
+job scripts then abandon the remaining stages of that seed rather than running them on
+missing input and uploading empty results.
+"""
+import glob
+import os
+import shlex
+import subprocess
+import time
+
+
+def wait(process, timeout=None, poll_interval=1.0):
+    """
+    Waits for 'process' to exit, killing it once it has run for 'timeout' seconds.
+    Returns its exit code, or None if it was killed.
+    """
+    t0 = time.time()
+    while process.poll() is None:
+        if timeout and time.time() - t0 > timeout:
+            process.kill()
+            process.wait()
+            return None
+        time.sleep(poll_interval)
+    return process.returncode
+
+
+def get_missing_outputs(outputs):
+    """
+    Returns the glob patterns in 'outputs' which match no non-empty file.
+    """
+    return [pattern for pattern in outputs
+            if not any(os.path.getsize(path) > 0 for path in glob.glob(pattern))]
+
+
+def run_stage(name, cmd, outputs=(), timeout=None, poll_interval=1.0):
+    """
+    Runs one stage of a job given:
+        name    : str name of the stage for the log
+        cmd     : command line of the stage
+        outputs : glob patterns which must each match a non-empty file afterwards
+        timeout : optional wall-time limit in seconds, after which the stage is killed
+    Returns True if the stage succeeded.
+    """
+    print("Starting %s run at:" % name)
+    os.system("date")
+    code = wait(subprocess.Popen(shlex.split(cmd)), timeout, poll_interval)
+    print("%s finished running at:" % name)
+    os.system("date")
+
+    if code is None:
+        print("%s killed after exceeding its limit of %s(s), abandoning this seed" % (name, timeout))
+        return False
+    if code != 0:
+        print("%s failed with exit code %s, abandoning this seed" % (name, code))
+        return False
+    missing = get_missing_outputs(outputs)
+    if missing:
+        print("%s produced no %s, abandoning this seed" % (name, " ".join(missing)))
+        return False
+    return True
+
+
+def run_concurrently(commands, outputs=(), timeout=None, poll_interval=1.0):
+    """
+    Starts all 'commands' at once and waits for them to finish, as needed for stages
+    connected by named pipes. If any command fails, or they are still running after
+    'timeout' seconds, the others are killed, since a stage blocked on a pipe whose
+    other end is gone would otherwise wait forever. Returns True if every command
+    succeeded and the 'outputs' glob patterns each match a non-empty file.
+    """
+    processes = [subprocess.Popen(shlex.split(cmd)) for cmd in commands]
+    running = list(zip(commands, processes))
+    succeeded = True
+    t0 = time.time()
+    while running and succeeded:
+        time.sleep(poll_interval)
+        for cmd, process in list(running):
+            code = process.poll()
+            if code is None:
+                continue
+            running.remove((cmd, process))
+            if code != 0:
+                print("Stage '%s' failed with exit code %s" % (cmd, code))
+                succeeded = False
+        if running and timeout and time.time() - t0 > timeout:
+            print("Stages exceeded their limit of %s(s)" % timeout)
+            succeeded = False
+
+    for cmd, process in running:
+        print("Killing stage '%s'" % cmd)
+        process.kill()
+        process.wait()
+
+    missing = get_missing_outputs(outputs)
+    if succeeded and missing:
+        print("Stages produced no %s" % " ".join(missing))
+        succeeded = False
+    return succeeded
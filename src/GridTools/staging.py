@@ -0,0 +1,95 @@
+"""
+Staging of job inputs by the ARC CE.
+
+Managers may declare the tool tarballs and a tarball of the run cards as xRSL
+'inputFiles': the CE then downloads them into the session directory of each job before
+it starts, serving repeated requests for the same URL from the site's shared cache.
+The job scripts look for these pre-staged files in their working directory and only
+download what is missing.
+
+The cards tarball is uploaded once per submission under a name containing its checksum,
+so that the CE cache (keyed by URL) never serves stale cards.
+"""
+import os
+import tarfile
+
+from GridTools import storage
+
+
+CARDS_TARBALL = "cards.tar.gz"
+CARDS_DIR = "cards"
+
+
+def make_cards_tarball(base_dir, cards, tarball):
+    """
+    Packs the run cards found in 'base_dir' into 'tarball' given:
+        base_dir : base directory containing the run configuration files
+        cards    : list of file or directory names in 'base_dir'
+        tarball  : path of the gzipped tarball to write
+    """
+    with tarfile.open(tarball, "w:gz") as cards_tarball:
+        for card in cards:
+            path = os.path.join(str(base_dir), card)
+            if not os.path.exists(path):
+                print("Card %s not found, not staging it" % path)
+                continue
+            cards_tarball.add(path, arcname = card)
+
+
+def stage_cards(base_dir, cards, remote_dir):
+    """
+    Uploads a tarball of the run cards in 'base_dir' to 'remote_dir', unless an identical
+    one is there already, and returns its URL.
+    """
+    tmp_tarball = "%s.tmp%s" % (CARDS_TARBALL, os.getpid())
+    make_cards_tarball(base_dir, cards, tmp_tarball)
+    try:
+        checksum = storage.get_file_checksum(tmp_tarball)
+        url = "%s/cards-%s.tar.gz" % (remote_dir.rstrip("/"), checksum)
+        if storage.get_checksum(url) is None:
+            print("Staging run cards to %s" % url)
+            if not storage.copy(tmp_tarball, url):
+                raise IOError("Failed to upload run cards to %s" % url)
+    finally:
+        os.remove(tmp_tarball)
+    return url
+
+
+def get_input_files(bundle_urls, cards_url=None):
+    """
+    Returns the xRSL 'inputFiles' relation staging each tool tarball in 'bundle_urls'
+    under its base name and the cards tarball at 'cards_url' (if any) as CARDS_TARBALL.
+    """
+    inputs = [(os.path.basename(url), url) for url in bundle_urls]
+    if cards_url is not None:
+        inputs.append((CARDS_TARBALL, cards_url))
+    if not inputs:
+        return ""
+    return "(inputFiles = %s)\n" % " ".join("('%s' '%s')" % (name, url) for name, url in inputs)
+
+
+def get_staged(url):
+    """
+    Returns the local path of the file 'url' if it was staged into the working directory
+    by the CE, otherwise None.
+    """
+    name = os.path.basename(url)
+    if os.path.isfile(name):
+        return name
+    return None
+
+
+def get_base_dir(base_dir):
+    """
+    Unpacks the staged cards tarball (if any) and returns the absolute path of the
+    directory to read the run cards from: the unpacked cards, or 'base_dir' if nothing
+    was staged.
+    """
+    if not os.path.isfile(CARDS_TARBALL):
+        return os.path.abspath(str(base_dir))
+
+    print("Using staged run cards")
+    with tarfile.open(CARDS_TARBALL, "r:gz") as cards_tarball:
+        cards_tarball.extractall(CARDS_DIR)
+    os.remove(CARDS_TARBALL)
+    return os.path.abspath(CARDS_DIR)
@@ -0,0 +1,407 @@
+"""
+Storage backends shared by the job scripts and mergers.
+
+Each backend provides the same interface:
+    list_dir(url)             : list of (name, size) pairs for the files in a directory
+    copy(source, destination) : copies a single file, returning True on success
+    copy_many(pairs)          : copies a batch of (source, destination) pairs, returning
+                                a list of bools
+    get_checksum(url)         : ADLER32 checksum of a file as a hex string, or None
+    open_read(url)            : file-like object streaming the contents of a file
+    list_names(url)           : names of all the entries (including directories) in a directory
+    make_dir(url)             : creates a directory atomically, returning False if it exists
+Plain paths and file:// URLs are served by LocalBackend, so that the whole pipeline may
+be run against a local directory without a grid. Grid URLs use the gfal2 Python bindings
+when they are available, keeping one session per thread open so that transfers share
+connections, and fall back to the gfal command line tools otherwise.
+"""
+import errno
+import os
+import shutil
+import subprocess
+import threading
+import zlib
+
+
+def get_local_path(url):
+    """
+    Returns the filesystem path for a plain path or file:// URL, otherwise None.
+    """
+    if url.startswith("file://"):
+        return url[len("file://"):]
+    if "://" not in url:
+        return url
+    return None
+
+
+def get_file_checksum(filename):
+    """
+    Returns the ADLER32 checksum of a local file as a hex string, matching 'gfal-sum'.
+    """
+    checksum = 1
+    with open(filename, "rb") as local_file:
+        while True:
+            block = local_file.read(1024 * 1024)
+            if not block:
+                break
+            checksum = zlib.adler32(block, checksum)
+    return "%08x" % (checksum & 0xffffffff)
+
+
+def get_url(path):
+    """
+    Returns a URL usable by gfal for a plain path or any URL.
+    """
+    if "://" in path:
+        return path
+    return "file://%s" % os.path.abspath(path)
+
+
+class LocalBackend():
+
+
+    def list_dir(self, url):
+        """
+        Returns a list of (name, size) pairs for the files in the directory 'url'.
+        """
+        path = get_local_path(url)
+        names = sorted(os.listdir(path))
+        return [(name, os.path.getsize(os.path.join(path, name))) for name in names
+                if os.path.isfile(os.path.join(path, name))]
+
+
+    def copy(self, source, destination):
+        """
+        Copies 'source' to 'destination', creating its parent directory if needed,
+        returning True on success.
+        """
+        try:
+            parent = os.path.dirname(get_local_path(destination))
+            if parent and not os.path.isdir(parent):
+                os.makedirs(parent)
+            shutil.copyfile(get_local_path(source), get_local_path(destination))
+        except (IOError, OSError) as error:
+            print("Error copying %s: %s" % (source, error))
+            return False
+        return True
+
+
+    def copy_many(self, pairs):
+        """
+        Copies a batch of (source, destination) pairs.
+        """
+        return [self.copy(source, destination) for source, destination in pairs]
+
+
+    def get_checksum(self, url):
+        """
+        Returns the ADLER32 checksum of the file 'url'.
+        """
+        try:
+            return get_file_checksum(get_local_path(url))
+        except (IOError, OSError):
+            return None
+
+
+    def open_read(self, url):
+        """
+        Opens the file 'url' for streaming.
+        """
+        return open(get_local_path(url), "rb")
+
+
+    def list_names(self, url):
+        """
+        Returns the names of all the entries in the directory 'url'.
+        """
+        return sorted(os.listdir(get_local_path(url)))
+
+
+    def make_dir(self, url):
+        """
+        Creates the directory 'url', returning False if it already exists.
+        """
+        try:
+            os.mkdir(get_local_path(url))
+        except OSError as error:
+            if error.errno != errno.EEXIST:
+                print("Error creating %s: %s" % (url, error))
+            return False
+        return True
+
+
+
+class GfalCliBackend():
+
+
+    def list_dir(self, url):
+        """
+        Returns a list of (name, size) pairs for the files in the directory 'url'
+        using 'gfal-ls -l'.
+        """
+        listing = []
+        for line in os.popen("gfal-ls -l %s" % url).read().splitlines():
+            # Format follows 'ls -l': mode links owner group size month day time name
+            fields = line.split()
+            if len(fields) < 9 or fields[0].startswith("d"):
+                continue
+            listing.append((fields[-1], int(fields[4])))
+        return listing
+
+
+    def copy(self, source, destination):
+        """
+        Copies 'source' to 'destination' with gfal-copy, returning True on success.
+        """
+        cmd = "gfal-copy -f -p %s %s" % (source, destination)
+        return os.system(cmd) == 0
+
+
+    def copy_many(self, pairs):
+        """
+        Copies a batch of (source, destination) pairs, one gfal-copy per file.
+        """
+        return [self.copy(source, destination) for source, destination in pairs]
+
+
+    def get_checksum(self, url):
+        """
+        Returns the ADLER32 checksum of the file 'url' using 'gfal-sum'.
+        """
+        # Output is 'url checksum'
+        fields = os.popen("gfal-sum %s ADLER32" % url).read().split()
+        if len(fields) < 2:
+            return None
+        return fields[-1].lower()
+
+
+    def open_read(self, url):
+        """
+        Opens the file 'url' for streaming through 'gfal-cat'.
+        """
+        return subprocess.Popen(["gfal-cat", url], stdout = subprocess.PIPE).stdout
+
+
+    def list_names(self, url):
+        """
+        Returns the names of all the entries in the directory 'url' using 'gfal-ls'.
+        """
+        return sorted(os.popen("gfal-ls %s" % url).read().split())
+
+
+    def make_dir(self, url):
+        """
+        Creates the directory 'url' with 'gfal-mkdir', which fails if it already exists.
+        """
+        cmd = "gfal-mkdir %s 2> /dev/null" % url
+        return os.system(cmd) == 0
+
+
+
+class Gfal2Backend():
+
+
+    def __init__(self, timeout=600):
+        """
+        Initialises a backend using the gfal2 Python bindings given:
+            timeout : int timeout in seconds for each transfer
+        """
+        import gfal2
+        self.gfal2 = gfal2
+        self.timeout = int(timeout)
+        self.local = threading.local()
+
+
+    def get_context(self):
+        """
+        Returns the gfal2 context of the calling thread, creating it on first use
+        (or after a fork, since contexts are not shared between processes).
+        """
+        if getattr(self.local, "pid", None) != os.getpid():
+            self.local.context = self.gfal2.creat_context()
+            self.local.pid = os.getpid()
+        return self.local.context
+
+
+    def get_parameters(self):
+        """
+        Returns transfer parameters overwriting existing destinations.
+        """
+        parameters = self.get_context().transfer_parameters()
+        parameters.overwrite = True
+        parameters.create_parent = True
+        parameters.timeout = self.timeout
+        return parameters
+
+
+    def list_dir(self, url):
+        """
+        Returns a list of (name, size) pairs for the files in the directory 'url'.
+        """
+        context = self.get_context()
+        url = url.rstrip("/")
+        listing = []
+        directory = context.opendir(url)
+        while True:
+            entry, info = directory.readpp()
+            if entry is None:
+                break
+            if entry.d_name in (".", "..") or (info.st_mode & 0o170000) == 0o040000:
+                continue
+            listing.append((entry.d_name, int(info.st_size)))
+        return sorted(listing)
+
+
+    def copy(self, source, destination):
+        """
+        Copies 'source' to 'destination', returning True on success.
+        """
+        try:
+            self.get_context().filecopy(self.get_parameters(), get_url(source), get_url(destination))
+        except self.gfal2.GError as error:
+            print("Error copying %s: %s" % (source, error))
+            return False
+        return True
+
+
+    def copy_many(self, pairs):
+        """
+        Copies a batch of (source, destination) pairs in one bulk gfal2 request.
+        """
+        if not pairs:
+            return []
+        sources = [get_url(source) for source, destination in pairs]
+        destinations = [get_url(destination) for source, destination in pairs]
+        try:
+            errors = self.get_context().filecopy(self.get_parameters(), sources, destinations)
+        except self.gfal2.GError as error:
+            print("Error in bulk copy: %s" % error)
+            return [False] * len(pairs)
+        for source, error in zip(sources, errors):
+            if error is not None:
+                print("Error copying %s: %s" % (source, error))
+        return [error is None for error in errors]
+
+
+    def get_checksum(self, url):
+        """
+        Returns the ADLER32 checksum of the file 'url'.
+        """
+        try:
+            return self.get_context().checksum(get_url(url), "ADLER32").lower()
+        except self.gfal2.GError as error:
+            print("Error getting checksum of %s: %s" % (url, error))
+            return None
+
+
+    def open_read(self, url):
+        """
+        Opens the file 'url' for streaming.
+        """
+        return self.get_context().open(get_url(url), "r")
+
+
+    def list_names(self, url):
+        """
+        Returns the names of all the entries in the directory 'url'.
+        """
+        names = self.get_context().listdir(url.rstrip("/"))
+        return sorted(name for name in names if name not in (".", ".."))
+
+
+    def make_dir(self, url):
+        """
+        Creates the directory 'url', returning False if it already exists.
+        """
+        try:
+            self.get_context().mkdir(get_url(url), 0o755)
+        except self.gfal2.GError as error:
+            if error.code != errno.EEXIST:
+                print("Error creating %s: %s" % (url, error))
+            return False
+        return True
+
+
+_backends = {}
+
+
+def get_backend(url):
+    """
+    Returns the (shared) backend serving 'url'.
+    """
+    if get_local_path(url) is not None:
+        name = "local"
+    else:
+        name = "grid"
+
+    if name not in _backends:
+        if name == "local":
+            _backends[name] = LocalBackend()
+        else:
+            try:
+                _backends[name] = Gfal2Backend()
+            except ImportError:
+                _backends[name] = GfalCliBackend()
+    return _backends[name]
+
+
+def get_pair_backend(source, destination):
+    """
+    Returns the backend for a transfer, chosen by its remote end (if any).
+    """
+    if get_local_path(source) is None:
+        return get_backend(source)
+    return get_backend(destination)
+
+
+def list_dir(url):
+    """
+    Returns a list of (name, size) pairs for the files in the directory 'url'.
+    """
+    return get_backend(url).list_dir(url)
+
+
+def copy(source, destination):
+    """
+    Copies 'source' to 'destination', returning True on success.
+    """
+    return get_pair_backend(source, destination).copy(source, destination)
+
+
+def get_checksum(url):
+    """
+    Returns the ADLER32 checksum of the file 'url' as a hex string, or None.
+    """
+    return get_backend(url).get_checksum(url)
+
+
+def open_read(url):
+    """
+    Opens the file 'url' for streaming, returning an object with a read(size) method.
+    """
+    return get_backend(url).open_read(url)
+
+
+def list_names(url):
+    """
+    Returns the names of all the entries (including directories) in the directory 'url'.
+    """
+    return get_backend(url).list_names(url)
+
+
+def make_dir(url):
+    """
+    Creates the directory 'url' atomically, returning False if it already exists, so that
+    exactly one of several concurrent callers succeeds.
+    """
+    return get_backend(url).make_dir(url)
+
+
+def copy_many(pairs):
+    """
+    Copies a batch of (source, destination) pairs sharing the same backend,
+    returning a list of bools.
+    """
+    if not pairs:
+        return []
+    return get_pair_backend(*pairs[0]).copy_many(pairs)
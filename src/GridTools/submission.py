@@ -0,0 +1,393 @@
+"""
+Submits job descriptions to a CE over a bounded pool of concurrent 'arcsub' calls.
+
+Each call submits a batch of descriptions, so that the handshake with the CE is paid
+once per batch rather than once per job. Jobs may be shared between several CEs with
+weights: the depth of each CE's queue is polled with 'arcinfo' and each batch goes to
+the CE with the fewest waiting jobs (counting those sent to it since the last poll)
+per unit of weight, with the CE of each job recorded in the job database.
+
+Submissions to each CE are started no faster than an adaptive rate: the rate grows
+while the CE answers quickly, falls when submissions fail and is halved whenever the CE
+takes longer than a target time to answer, so that a busy CE is given room rather than
+flooded.
+Failed submissions are retried with randomised exponential backoff. Every submitted job
+is recorded in the job database (jobs.db, see GridTools.jobdb) with its CE, seeds and
+description as soon as the CE accepts it and only then is its description removed, so
+that running the submission again skips the jobs already submitted and picks up the
+ones that failed.
+Jobs whose fate cannot be told from the output of 'arcsub', including every job of a
+call killed after the timeout (the CE may have accepted them), are never retried: they
+are recorded in the job database as unknown and reported, and are only submitted again
+once 'python jobdb.py status' has found them absent from the CE.
+"""
+import os
+import random
+import re
+import subprocess
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from GridTools import jobdb, stages
+
+
+# arcsub reports each accepted job as 'Job submitted with jobid: <job ID>'
+JOB_ID_PATTERN = re.compile(r"Job submitted with jobid:\s*(\S+)")
+# and lists the jobs it did not submit in its summary by 'Name: <jobname>'
+NOT_SUBMITTED_PATTERN = re.compile(r"The following \d+ were not submitted")
+JOB_NAME_PATTERN = re.compile(r"Name:\s*(\S+)")
+# arcinfo reports the queue depth of the service and of each of its shares
+WAITING_PATTERN = re.compile(r"Waiting jobs:\s*(\d+)")
+
+
+def run_command(cmd, timeout=None):
+    """
+    Runs the command list 'cmd', killing it after 'timeout' seconds, and returns its
+    exit code (None if it was killed) and its combined output.
+    """
+    with tempfile.TemporaryFile(mode = "w+") as output:
+        code = stages.wait(subprocess.Popen(cmd, stdout = output, stderr = subprocess.STDOUT), timeout, 0.2)
+        output.seek(0)
+        return code, output.read()
+
+
+def get_queue_depth(ce, timeout=60):
+    """
+    Returns the number of jobs waiting at the computing element 'ce', taking the
+    largest count 'arcinfo' reports (the service's total if it gives one), or None if
+    it reports none.
+    """
+    code, text = run_command(["arcinfo", "-l", "-c", ce], timeout)
+    depths = [int(depth) for depth in WAITING_PATTERN.findall(text)]
+    if not depths:
+        return None
+    return max(depths)
+
+
+class RateLimiter():
+
+
+    def __init__(self, rate=2.0, min_rate=0.1, max_rate=20.0, target_time=10.0):
+        """
+        Initialises a limit on the rate at which submissions start given:
+            rate        : float initial number of submissions per second
+            min_rate    : float lowest rate it may fall to
+            max_rate    : float highest rate it may rise to
+            target_time : float response time in seconds above which the CE is taken
+                          to be struggling
+        """
+        self.rate = float(rate)
+        self.min_rate = float(min_rate)
+        self.max_rate = float(max_rate)
+        self.target_time = float(target_time)
+        self.next_time = 0.0
+        self.lock = threading.Lock()
+
+
+    def wait(self):
+        """
+        Blocks until the next submission may start.
+        """
+        with self.lock:
+            now = time.time()
+            start = max(now, self.next_time)
+            self.next_time = start + 1.0 / self.rate
+        time.sleep(start - now)
+
+
+    def update(self, elapsed, success):
+        """
+        Adapts the rate to a submission which took 'elapsed' seconds: halved after a
+        slow response, cut by a fifth after a quick failure (which may be down to the
+        job rather than the CE), and otherwise raised by a tenth.
+        """
+        with self.lock:
+            if elapsed > self.target_time:
+                self.rate = max(self.min_rate, self.rate / 2.0)
+            elif not success:
+                self.rate = max(self.min_rate, self.rate * 0.8)
+            else:
+                self.rate = min(self.max_rate, self.rate * 1.1)
+
+
+class LoadBalancer():
+
+
+    def __init__(self, ces, poll_interval=120.0):
+        """
+        Initialises the routing of jobs between CEs given:
+            ces           : list of (computing element, weight) pairs, a CE with twice
+                            the weight being sent twice as many jobs for the same queue
+            poll_interval : float seconds between polls of the queue depths
+        """
+        self.weights = OrderedDict((str(ce), float(weight)) for ce, weight in ces)
+        self.poll_interval = float(poll_interval)
+        self.waiting = dict((ce, 0) for ce in self.weights)
+        self.routed = dict((ce, 0) for ce in self.weights)
+        self.polled = None
+        self.polling = False
+        self.lock = threading.Lock()
+
+
+    def poll(self):
+        """
+        Updates the queue depth of every CE, keeping the last known one of a CE that
+        does not answer. 'arcinfo' may take up to a minute per CE, so it runs without
+        the lock and the other workers keep routing on the last known depths meanwhile.
+        """
+        with self.lock:
+            # The jobs routed from now on may not show in the depths polled
+            routed = dict(self.routed)
+
+        depths = dict((ce, get_queue_depth(ce)) for ce in self.weights)
+
+        with self.lock:
+            for ce, depth in depths.items():
+                if depth is None:
+                    print("No queue information from %s" % ce)
+                else:
+                    self.waiting[ce] = depth
+                    self.routed[ce] -= routed[ce]
+            self.polled = time.time()
+            print("Jobs waiting: %s" % ", ".join("%s %s" % (ce, self.waiting[ce]) for ce in self.weights))
+
+
+    def get_load(self, ce):
+        """
+        Returns the number of jobs waiting at 'ce' per unit of its weight.
+        """
+        return (self.waiting[ce] + self.routed[ce]) / self.weights[ce]
+
+
+    def choose(self, jobs):
+        """
+        Returns the least loaded CE for a batch of 'jobs' jobs and counts them against it.
+        Jobs which then fail to submit stay counted until the next poll, steering the
+        following batches away from a failing CE. The depths are polled again by the
+        first worker to find them out of date.
+        """
+        with self.lock:
+            poll = (len(self.weights) > 1 and not self.polling and
+                    (self.polled is None or time.time() - self.polled > self.poll_interval))
+            if poll:
+                self.polling = True
+        if poll:
+            try:
+                self.poll()
+            finally:
+                with self.lock:
+                    self.polling = False
+
+        with self.lock:
+            ce = min(self.weights, key = self.get_load)
+            self.routed[ce] += jobs
+            return ce
+
+
+class Submitter():
+
+
+    def __init__(self, ces, jobs_file="multijobs.dat", database=jobdb.DATABASE, workers=4, batch_size=1, retries=3, backoff=5.0, timeout=300, rate=2.0,
+                 runs=None, output_dir=None):
+        """
+        Initialises a submission engine given:
+            ces        : list of (computing element, weight) pairs to share the jobs
+                         between, or a single computing element
+            jobs_file  : ARC job database the submitted jobs are added to
+            database   : job database (or its file) recording the submitted jobs
+            workers    : int number of concurrent 'arcsub' calls
+            batch_size : int number of jobs submitted by each 'arcsub' call
+            retries    : int number of retries of each failed submission
+            backoff    : float base delay in seconds before the first retry, doubling
+                         (with random jitter) for each subsequent retry
+            timeout    : int seconds after which an 'arcsub' call is killed
+            rate       : float initial number of 'arcsub' calls started per CE per second
+            runs       : int number of seeds run by each job, recorded with the job,
+                         or None if not known in advance (e.g. for pilots)
+            output_dir : directory the jobs upload their results to
+        """
+        if isinstance(ces, str):
+            ces = [(ces, 1.0)]
+        self.balancer = LoadBalancer(ces)
+        self.jobs_file = str(jobs_file)
+        self.database = database if isinstance(database, jobdb.JobDatabase) else jobdb.JobDatabase(database)
+        self.runs = runs
+        self.output_dir = output_dir
+        self.workers = max(1, int(workers))
+        self.batch_size = max(1, int(batch_size))
+        self.retries = int(retries)
+        self.backoff = float(backoff)
+        self.timeout = timeout
+        self.limiters = dict((ce, RateLimiter(rate)) for ce in self.balancer.weights)
+        self.lock = threading.Lock()
+
+
+    def submit_batch(self, ce, batch):
+        """
+        Submits the (job number, description file) pairs in 'batch' to 'ce' with one
+        'arcsub' call. Returns a dict mapping the job number of each submitted job to its job ID
+        and the list of job numbers whose fate is unknown, which are not to be retried.
+        A call killed after the timeout leaves the fate of the whole batch unknown,
+        unless it had already reported a job ID for every description.
+        """
+        cmd = ["arcsub", "--direct", "-c", ce, "-j", self.jobs_file] + [job_file for job_number, job_file in batch]
+        code, text = run_command(cmd, self.timeout)
+        names = ", ".join(job_file for job_number, job_file in batch)
+        job_ids = JOB_ID_PATTERN.findall(text)
+        if code is None:
+            if len(job_ids) == len(batch):
+                return dict(zip([job_number for job_number, job_file in batch], job_ids)), []
+            # Any of them may still have been accepted, and the reported job IDs cannot be
+            # told apart without arcsub's summary, so a retry of any could duplicate it
+            print("Submission of %s to %s killed after %s(s) with %s of %s jobs reported, check %s before submitting them again"
+                  % (names, ce, self.timeout, len(job_ids), len(batch), self.jobs_file))
+            return {}, [job_number for job_number, job_file in batch]
+
+        if not job_ids:
+            print("Submission of %s to %s failed: %s" % (names, ce, text.strip().replace("\n", " ")))
+            return {}, []
+
+        # arcsub reports the jobs in the order of their descriptions, and names (by
+        # their jobname '<executable>.<job number>') those it did not submit
+        failed = set()
+        summary = NOT_SUBMITTED_PATTERN.search(text)
+        if summary:
+            failed = set(name.rsplit(".", 1)[-1] for name in JOB_NAME_PATTERN.findall(text[summary.end():]))
+        accepted = [job_number for job_number, job_file in batch if str(job_number) not in failed]
+        if len(accepted) != len(job_ids) or len(accepted) + len(failed) != len(batch):
+            print("Cannot tell which of %s were submitted, check %s before submitting them again: %s" % (names, self.jobs_file, text.strip().replace("\n", " ")))
+            return {}, [job_number for job_number, job_file in batch]
+        if failed:
+            print("Submission of job%s failed" % ", job".join(sorted(failed)))
+        return dict(zip(accepted, job_ids)), []
+
+
+    def submit_with_retries(self, batch, report):
+        """
+        Submits the (job number, description file) pairs in 'batch', retrying those
+        that failed up to self.retries times, recording each job in the job database and
+        removing its description once submitted. Jobs whose fate is unknown are recorded
+        as such, keeping their description, and not retried. Each attempt goes to the
+        least loaded CE at the time. Returns the job numbers not submitted.
+        """
+        job_files = dict(batch)
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                with self.lock:
+                    report["retries"] += 1
+                time.sleep(self.backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+            ce = self.balancer.choose(len(batch))
+            self.limiters[ce].wait()
+            t0 = time.time()
+            job_ids, unknown = self.submit_batch(ce, batch)
+            elapsed = time.time() - t0
+            # Judge the CE by its response time per job, the batch sharing the handshake,
+            # and by whether it took any of them, since single jobs may fail on their own
+            self.limiters[ce].update(elapsed / len(batch), bool(job_ids))
+            for job_number, job_id in sorted(job_ids.items()):
+                self.record(job_number, job_id, ce, job_files[job_number])
+                os.remove(job_files[job_number])
+            for job_number in unknown:
+                self.record(job_number, jobdb.get_unknown_id(job_number, ce), ce, job_files[job_number], jobdb.UNKNOWN)
+            with self.lock:
+                report["response_time"] += elapsed
+                report["calls"] += 1
+                report["submitted"] += len(job_ids)
+                report["ces"][ce] = report["ces"].get(ce, 0) + len(job_ids)
+                report["unknown"].extend(unknown)
+            batch = [(job_number, job_file) for job_number, job_file in batch
+                     if job_number not in job_ids and job_number not in unknown]
+            if not batch:
+                break
+        return [job_number for job_number, job_file in batch]
+
+
+    def record(self, job_number, job_id, ce, job_file, state=jobdb.SUBMITTED):
+        """
+        Records a job submitted to 'ce' from the description 'job_file' in the job database.
+        """
+        with open(job_file) as description:
+            self.database.record(job_number, job_id, ce, jobdb.get_seeds(job_number, self.runs) if self.runs else None,
+                                 self.output_dir, description.read(), state)
+
+
+    def run(self, job_files, resubmit=False):
+        """
+        Submits the (job number, description file) pairs in 'job_files', skipping job
+        numbers already in the job database unless 'resubmit' is set, in which case
+        their earlier jobs are superseded, and returns a report dict.
+        """
+        submitted = set() if resubmit else self.database.get_submitted()
+        pending = [(job_number, job_file) for job_number, job_file in job_files if job_number not in submitted]
+        report = {"submitted" : 0, "skipped" : len(job_files) - len(pending), "failed" : [], "unknown" : [], "ces" : {},
+                  "retries" : 0, "calls" : 0, "response_time" : 0.0, "time" : 0.0}
+        if report["skipped"]:
+            print("Skipping %s jobs already in %s" % (report["skipped"], self.database.filename))
+            for job_number, job_file in job_files:
+                if job_number in submitted and os.path.isfile(job_file):
+                    os.remove(job_file)
+
+        tasks = queue.Queue(4 * self.workers)
+        workers = []
+        for idx in range(self.workers):
+            worker = threading.Thread(target = self.work, args = (tasks, report))
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+
+        t0 = time.time()
+        for idx in range(0, len(pending), self.batch_size):
+            tasks.put(pending[idx:idx + self.batch_size])
+        for worker in workers:
+            tasks.put(None)
+        for worker in workers:
+            worker.join()
+        report["time"] = time.time() - t0
+        report["failed"].sort()
+        report["unknown"].sort()
+
+        self.print_report(report)
+        return report
+
+
+    def work(self, tasks, report):
+        """
+        Submits batches of jobs from 'tasks' until it yields None.
+        """
+        while True:
+            batch = tasks.get()
+            if batch is None:
+                return
+            failed = self.submit_with_retries(batch, report)
+            with self.lock:
+                report["failed"].extend(failed)
+
+
+    def print_report(self, report):
+        """
+        Prints the throughput and failures of a submission.
+        """
+        print("=" * 80)
+        print("Submitted %s jobs in %.1f(s) over %s workers, in %s arcsub calls" % (report["submitted"], report["time"], self.workers, report["calls"]))
+        if report["time"] > 0:
+            print("Throughput: %.2f jobs/s" % (report["submitted"] / report["time"]))
+        for ce in self.balancer.weights:
+            print("    %s: %s jobs, final rate limit %.2f calls/s" % (ce, report["ces"].get(ce, 0), self.limiters[ce].rate))
+        if report["calls"]:
+            print("Mean CE response time: %.1f(s)" % (report["response_time"] / report["calls"]))
+        print("Retries: %s" % report["retries"])
+        print("Failed submissions (descriptions kept): %s" % len(report["failed"]))
+        for job_number in report["failed"]:
+            print("    job%s" % job_number)
+        if report["unknown"]:
+            print("Submissions with unknown outcome (not retried, check with 'jobdb.py status --state %s'): %s" % (jobdb.UNKNOWN, len(report["unknown"])))
+            for job_number in report["unknown"]:
+                print("    job%s" % job_number)
+        print("=" * 80)
@@ -0,0 +1,52 @@
+"""
+Reads result tarballs as streams, writing their members straight to their destination.
+"""
+import fnmatch
+import os
+import shutil
+import tarfile
+import zlib
+
+
+def extract_by_category(tarball, categories):
+    """
+    Streams the members of a (gzipped) tarball, writing each regular file whose base
+    name matches a glob pattern to the directory of its category, given:
+        tarball    : path to the tarball
+        categories : list of (pattern, directory) pairs, the first matching pattern wins
+    Members matching no pattern are skipped and nothing is written to the cwd.
+    Returns True if the whole tarball was read, or False (after logging it) if it is
+    empty, truncated or otherwise unreadable, keeping the files written before the error.
+    """
+    written = 0
+    try:
+        with tarfile.open(tarball, "r|*") as stream:
+            for member in stream:
+                if not member.isfile():
+                    continue
+
+                name = os.path.basename(member.name)
+                for pattern, directory in categories:
+                    if fnmatch.fnmatch(name, pattern):
+                        write_member(stream.extractfile(member), os.path.join(directory, name))
+                        written += 1
+                        break
+    except (tarfile.TarError, IOError, EOFError, zlib.error) as error:
+        print("Failed to extract %s after %s files: %s" % (tarball, written, error))
+        return False
+    return True
+
+
+def write_member(source, path):
+    """
+    Copies an open member stream to 'path' via a temporary file in the same directory,
+    so that a partially written file is never visible under its final name.
+    """
+    tmp_path = "%s.tmp%s" % (path, os.getpid())
+    try:
+        with open(tmp_path, "wb") as destination:
+            shutil.copyfileobj(source, destination, 1024 * 1024)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+    os.rename(tmp_path, path)
@@ -0,0 +1,239 @@
+"""
+Node-local cache of tool tarballs shared by the jobs running on a worker node.
+
+Tarballs are stored under their ADLER32 checksum, so that a tarball which changes on
+grid storage is fetched again while an unchanged one is only downloaded by the first
+job on the node. Each object has a lock file: jobs unpacking a cached object share it,
+while the job downloading a missing object holds it exclusively so that concurrent jobs
+wait for the download rather than repeating it. Objects are unpacked straight into the
+job's working directory and the least recently used ones are evicted once the cache
+exceeds its size cap.
+
+Tarballs are piped into 'tar' as they arrive, so a download and its unpacking overlap and
+no intermediate copy is written to the working directory; 'unpack_all' does this for all
+the tarballs of a job at once, using the copies pre-staged by the CE when there are any.
+"""
+import errno
+import fcntl
+import os
+import subprocess
+import threading
+import zlib
+
+from GridTools import staging, storage
+
+
+class ToolCache():
+
+
+    def __init__(self, cache_dir, max_size=20.0e9):
+        """
+        Initialises the cache given:
+            cache_dir : directory holding the cache, created if missing
+            max_size  : float cap on the total size of the cached tarballs in bytes
+        """
+        self.cache_dir = str(cache_dir)
+        self.max_size = float(max_size)
+        try:
+            os.makedirs(self.cache_dir)
+        except OSError as error:
+            if error.errno != errno.EEXIST:
+                raise
+
+
+    @classmethod
+    def from_environment(cls, user_name):
+        """
+        Returns the cache configured by $GRID_TOOLS_CACHE (directory, by default
+        /tmp/grid_tools_cache_<user_name>) and $GRID_TOOLS_CACHE_SIZE (cap in GB).
+        """
+        cache_dir = os.environ.get("GRID_TOOLS_CACHE", "/tmp/grid_tools_cache_%s" % str(user_name))
+        max_size = float(os.environ.get("GRID_TOOLS_CACHE_SIZE", 20)) * 1.0e9
+        return cls(cache_dir, max_size)
+
+
+    def get_path(self, checksum):
+        """
+        Returns the path of the cached object with the given checksum.
+        """
+        return os.path.join(self.cache_dir, "%s.tar.gz" % checksum)
+
+
+    def unpack(self, url, directory="."):
+        """
+        Unpacks the tarball 'url' into 'directory', streaming it from the cache if another
+        job on the node has downloaded it already and otherwise downloading it into the
+        cache while it is unpacked. Returns True on success.
+        """
+        checksum = storage.get_checksum(url)
+        if checksum is None:
+            print("No checksum available for %s, unpacking without the cache" % url)
+            return unpack_stream(storage.open_read(url), directory) is not None
+
+        checksum = "%08x" % int(checksum, 16)
+        path = self.get_path(checksum)
+        with open("%s.lock" % path, "a") as lock:
+            # Jobs unpacking a cached object share its lock, which keeps it from eviction
+            fcntl.flock(lock, fcntl.LOCK_SH)
+            try:
+                if not os.path.exists(path):
+                    # Only a download takes the lock exclusively. Converting the lock releases
+                    # it first, so another job may have downloaded the object meanwhile
+                    fcntl.flock(lock, fcntl.LOCK_EX)
+                if os.path.exists(path):
+                    # Opened before going back to a shared lock, as the object could be
+                    # evicted while the lock is converted
+                    cached = open(path, "rb")
+                    fcntl.flock(lock, fcntl.LOCK_SH)
+                    print("Unpacking cached %s" % url)
+                    succeeded = unpack_stream(cached, directory) is not None
+                else:
+                    succeeded = self.download_unpacking(url, path, checksum, directory)
+                if succeeded:
+                    # Mark as recently used for eviction
+                    os.utime(path, None)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+        self.evict()
+        return succeeded
+
+
+    def download_unpacking(self, url, path, checksum, directory):
+        """
+        Downloads 'url' into the cache, unpacking it into 'directory' as it arrives,
+        and verifies its checksum.
+        """
+        print("Downloading and unpacking %s into the node cache" % url)
+        tmp_path = "%s.tmp%s" % (path, os.getpid())
+        with open(tmp_path, "wb") as tee:
+            streamed = unpack_stream(storage.open_read(url), directory, tee)
+
+        if streamed is None or int(streamed, 16) != int(checksum, 16):
+            print("Failed or corrupt download of %s, discarding" % url)
+            os.remove(tmp_path)
+            return False
+
+        os.rename(tmp_path, path)
+        return True
+
+
+    def evict(self):
+        """
+        Removes the least recently used objects until the cache fits under its cap,
+        skipping objects currently locked by another job.
+        """
+        with open(os.path.join(self.cache_dir, "evict.lock"), "a") as evict_lock:
+            fcntl.flock(evict_lock, fcntl.LOCK_EX)
+            try:
+                objects = []
+                for name in os.listdir(self.cache_dir):
+                    if not name.endswith(".tar.gz"):
+                        continue
+                    path = os.path.join(self.cache_dir, name)
+                    status = os.stat(path)
+                    objects.append((status.st_mtime, status.st_size, path))
+
+                total = sum(size for mtime, size, path in objects)
+                for mtime, size, path in sorted(objects):
+                    if total <= self.max_size:
+                        break
+                    if self.remove_unlocked(path):
+                        print("Evicted %s from the node cache" % path)
+                        total -= size
+            finally:
+                fcntl.flock(evict_lock, fcntl.LOCK_UN)
+
+
+    def remove_unlocked(self, path):
+        """
+        Removes a cached object if no other job holds its lock, returning True if removed.
+        """
+        with open("%s.lock" % path, "a") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                return False
+            try:
+                os.remove(path)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        return True
+
+
+def unpack_stream(source, directory=".", tee=None):
+    """
+    Pipes a gzipped tarball read from the stream 'source' into 'tar', given:
+        source    : object with a read(size) method, closed once exhausted
+        directory : directory to unpack into
+        tee       : optional open file to which the raw stream is also written
+    Returns the ADLER32 checksum of the stream as a hex string, or None if unpacking failed.
+    """
+    unpacker = subprocess.Popen(["tar", "-xzf", "-", "-C", directory], stdin = subprocess.PIPE)
+    checksum = 1
+    try:
+        while True:
+            block = source.read(1024 * 1024)
+            if not block:
+                break
+            checksum = zlib.adler32(block, checksum)
+            unpacker.stdin.write(block)
+            if tee is not None:
+                tee.write(block)
+    except (IOError, OSError) as error:
+        # A broken pipe if 'tar' gave up on the stream
+        print("Error unpacking into %s: %s" % (directory, error))
+    finally:
+        try:
+            unpacker.stdin.close()
+        except (IOError, OSError):
+            pass
+        if hasattr(source, "close"):
+            source.close()
+
+    if unpacker.wait() != 0:
+        return None
+    return "%08x" % (checksum & 0xffffffff)
+
+
+def unpack_all(cache, bundles):
+    """
+    Downloads and unpacks tool tarballs concurrently, one thread (and 'tar' process)
+    per tarball, given:
+        cache   : ToolCache the tarballs are fetched through
+        bundles : list of (url, directory) pairs, the directory being created if missing
+    Tarballs staged into the working directory by the CE are unpacked (and removed)
+    instead of being downloaded. Returns the list of urls which failed to unpack.
+    """
+    failed = []
+    lock = threading.Lock()
+
+    def unpack_single(url, directory):
+        try:
+            staged = staging.get_staged(url)
+            if staged is not None:
+                print("Unpacking staged %s" % staged)
+                succeeded = unpack_stream(open(staged, "rb"), directory) is not None
+                os.remove(staged)
+            else:
+                succeeded = cache.unpack(url, directory)
+        except Exception as error:
+            print("Error unpacking %s: %s" % (url, error))
+            succeeded = False
+        if not succeeded:
+            with lock:
+                failed.append(url)
+
+    threads = []
+    for url, directory in bundles:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        thread = threading.Thread(target = unpack_single, args = (url, directory))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+
+    for url in failed:
+        print("Failed to unpack %s" % url)
+    return failed
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+"""
+Copies many files concurrently over several transfer streams.
+
+Transfers are fed through a bounded queue to a fixed number of worker threads, each
+retrying failed copies with randomised exponential backoff. A report of the throughput
+and any failures is printed at the end. A local (file://) source may be used to
+benchmark the engine without a grid, e.g.
+    python transfer.py -s 16 file:///scratch/user/outputs /scratch/user/copies
+"""
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from GridTools import storage
+
+
+class BulkTransfer():
+
+
+    def __init__(self, streams=8, retries=3, backoff=1.0, queue_size=None):
+        """
+        Initialises a bulk transfer given:
+            streams    : int number of concurrent transfers
+            retries    : int number of retries of each failed transfer
+            backoff    : float base delay in seconds before the first retry, doubling
+                         (with random jitter) for each subsequent retry
+            queue_size : optional int bound on the number of queued transfers,
+                         defaults to four per stream
+        """
+        self.streams = max(1, int(streams))
+        self.retries = int(retries)
+        self.backoff = float(backoff)
+        self.queue_size = int(queue_size) if queue_size else 4 * self.streams
+        self.lock = threading.Lock()
+
+
+    def run(self, transfers, copy=storage.copy, on_success=None):
+        """
+        Performs the (source, destination) pairs in 'transfers' and returns a report dict.
+        'copy' performs a single transfer returning True on success and 'on_success' is
+        called with (source, destination) after each successful transfer, one call at a time.
+        """
+        tasks = queue.Queue(self.queue_size)
+        report = {"succeeded" : 0, "failed" : [], "retries" : 0, "bytes" : 0, "time" : 0.0}
+
+        workers = []
+        for idx in range(self.streams):
+            worker = threading.Thread(target = self.work, args = (tasks, copy, on_success, report))
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+
+        t0 = time.time()
+        for transfer in transfers:
+            # Blocks while the queue is full
+            tasks.put(transfer)
+        for worker in workers:
+            tasks.put(None)
+        for worker in workers:
+            worker.join()
+        report["time"] = time.time() - t0
+
+        self.print_report(report)
+        return report
+
+
+    def work(self, tasks, copy, on_success, report):
+        """
+        Worker loop: performs queued transfers until a None sentinel is received.
+        """
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+
+            source, destination = task
+            succeeded = self.copy_with_retries(source, destination, copy, report)
+            with self.lock:
+                if succeeded:
+                    report["succeeded"] += 1
+                    local_path = storage.get_local_path(destination)
+                    if local_path is not None and os.path.isfile(local_path):
+                        report["bytes"] += os.path.getsize(local_path)
+                    if on_success is not None:
+                        on_success(source, destination)
+                else:
+                    report["failed"].append(source)
+
+
+    def copy_with_retries(self, source, destination, copy, report):
+        """
+        Attempts a transfer up to 1 + self.retries times, returning True on success.
+        """
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                with self.lock:
+                    report["retries"] += 1
+                time.sleep(self.backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+            try:
+                if copy(source, destination):
+                    return True
+            except (IOError, OSError) as error:
+                print("Error copying %s: %s" % (source, error))
+        print("Failed to copy %s after %s attempts" % (source, self.retries + 1))
+        return False
+
+
+    def print_report(self, report):
+        """
+        Prints the throughput and failures of a bulk transfer.
+        """
+        megabytes = report["bytes"] / 1.0e6
+        print("=" * 80)
+        print("Transferred %s files (%.1f MB) in %.1f(s) over %s streams" % (report["succeeded"], megabytes, report["time"], self.streams))
+        if report["time"] > 0:
+            print("Throughput: %.2f MB/s, %.2f files/s" % (megabytes / report["time"], report["succeeded"] / report["time"]))
+        print("Retries: %s" % report["retries"])
+        print("Failed transfers: %s" % len(report["failed"]))
+        for source in report["failed"]:
+            print("    %s" % source)
+        print("=" * 80)
+
+
+def parse():
+    """
+    Parse command line arguments.
+        source      : directory to copy files from, with protocol
+        destination : local directory to copy files to
+        streams     : int number of concurrent transfers
+        retries     : int number of retries of each failed transfer
+    """
+    parser = argparse.ArgumentParser(description = "Usage: python transfer.py [-s streams] [-n retries] source destination")
+    parser.add_argument('source', type = str)
+    parser.add_argument('destination', type = str)
+    parser.add_argument('--streams', '-s', type = int, default = 8)
+    parser.add_argument('--retries', '-n', type = int, default = 3)
+    return parser.parse_args()
+
+
+def main():
+    """
+    Copies every file in a directory, reporting the throughput.
+    """
+    args = parse()
+    transfers = [("%s/%s" % (args.source.rstrip("/"), name), os.path.join(args.destination, name))
+                 for name, size in storage.list_dir(args.source)]
+    BulkTransfer(args.streams, args.retries).run(transfers)
+
+
+if __name__ == """__main__""":
+    main()
@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+"""
+Uploads the results of the runs on a node to grid storage without flooding it.
+
+Runs that finish together (and every node of a submission wave does) would otherwise
+all write to the SE at once. Each results tarball is first moved into a spool next to
+the job, with the destination recorded beside it, and uploaded from there: after a
+random delay, holding one of a fixed number of upload slots shared through lock files
+by every job on the node, and retried with randomised exponential backoff until the
+checksum of the uploaded file matches the local one. Tarballs are only removed from the
+spool once uploaded, so those that still fail can be drained later: by the job at its
+end, or from the spool kept on the CE (retrieved with 'arcget') with
+    python upload.py <job directory>/spool
+Each attempt is logged in the spool and the success rate and latency of the uploads
+are reported at the end of the job.
+"""
+import argparse
+import contextlib
+import errno
+import fcntl
+import json
+import os
+import random
+import shutil
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from GridTools import storage
+
+
+SPOOL_DIR = "spool"
+LOG_NAME = "uploads.log"
+# Suffix of the file recording the destination of a spooled tarball
+DESTINATION_SUFFIX = ".destination"
+
+
+def make_dir(directory):
+    """
+    Creates 'directory' if it does not exist.
+    """
+    try:
+        os.makedirs(directory)
+    except OSError as error:
+        if error.errno != errno.EEXIST:
+            raise
+
+
+def normalise_checksum(checksum):
+    """
+    Returns an ADLER32 checksum as zero-padded lower-case hex, or None.
+    """
+    try:
+        return "%08x" % int(checksum, 16)
+    except (TypeError, ValueError):
+        return None
+
+
+class Uploader():
+
+
+    def __init__(self, spool_dir=SPOOL_DIR, lock_dir=None, slots=2, jitter=30.0, retries=4, backoff=10.0):
+        """
+        Initialises an uploader given:
+            spool_dir : directory holding the tarballs waiting to be uploaded
+            lock_dir  : directory of the slot lock files shared by the jobs on the node,
+                        by default the spool itself (limiting only this job)
+            slots     : int number of uploads allowed at once
+            jitter    : float upper bound in seconds of the random delay before an upload
+            retries   : int number of retries of each failed upload
+            backoff   : float base delay in seconds before the first retry, doubling
+                        (with random jitter) for each subsequent retry
+        """
+        # Absolute, since the runs save their results from their sandboxes
+        self.spool_dir = os.path.abspath(str(spool_dir))
+        self.lock_dir = os.path.abspath(str(lock_dir)) if lock_dir else self.spool_dir
+        self.slots = max(1, int(slots))
+        self.jitter = float(jitter)
+        self.retries = int(retries)
+        self.backoff = float(backoff)
+        # Created up front, since the job declares it as an output kept on the CE
+        make_dir(self.spool_dir)
+
+
+    @classmethod
+    def from_environment(cls, user_name, spool_dir=SPOOL_DIR):
+        """
+        Returns the uploader configured by $GRID_TOOLS_UPLOAD_LOCKS (directory of the
+        slot locks, by default /tmp/grid_tools_uploads_<user_name>),
+        $GRID_TOOLS_UPLOAD_SLOTS (uploads at once on the node, by default 2) and
+        $GRID_TOOLS_UPLOAD_JITTER (maximum delay before an upload, by default 30 seconds).
+        """
+        lock_dir = os.environ.get("GRID_TOOLS_UPLOAD_LOCKS", "/tmp/grid_tools_uploads_%s" % str(user_name))
+        slots = int(os.environ.get("GRID_TOOLS_UPLOAD_SLOTS", 2))
+        jitter = float(os.environ.get("GRID_TOOLS_UPLOAD_JITTER", 30))
+        return cls(spool_dir, lock_dir, slots, jitter)
+
+
+    def save(self, path, destination):
+        """
+        Moves the local file 'path' into the spool and uploads it to 'destination',
+        returning True if it was uploaded. A local destination (e.g. the spool of
+        pre-merging) is copied to straight away.
+        """
+        if storage.get_local_path(destination) is not None:
+            return storage.copy(path, destination)
+        if not os.path.isfile(path):
+            print("No %s to upload" % path)
+            return False
+        return self.upload(self.spool(path, destination))
+
+
+    def spool(self, path, destination):
+        """
+        Moves the local file 'path' into the spool, recording its 'destination',
+        and returns its path in the spool.
+        """
+        make_dir(self.spool_dir)
+        spooled = os.path.join(self.spool_dir, os.path.basename(path))
+        with open(spooled + DESTINATION_SUFFIX, "w") as destination_file:
+            destination_file.write(str(destination))
+        shutil.move(path, spooled)
+        return spooled
+
+
+    def get_spooled(self):
+        """
+        Returns the paths of the tarballs in the spool, oldest first.
+        """
+        if not os.path.isdir(self.spool_dir):
+            return []
+        paths = [os.path.join(self.spool_dir, name[:-len(DESTINATION_SUFFIX)])
+                 for name in os.listdir(self.spool_dir) if name.endswith(DESTINATION_SUFFIX)]
+        return sorted((path for path in paths if os.path.isfile(path)), key = os.path.getmtime)
+
+
+    @contextlib.contextmanager
+    def get_slot(self):
+        """
+        Waits for one of the upload slots of the node and holds it until the end of the
+        'with' block. The lock is released by the system should the process die.
+        """
+        make_dir(self.lock_dir)
+        while True:
+            for idx in random.sample(range(self.slots), self.slots):
+                lock = open(os.path.join(self.lock_dir, "slot%s.lock" % idx), "a")
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except (IOError, OSError):
+                    lock.close()
+                    continue
+                try:
+                    yield idx
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+                    lock.close()
+                return
+            time.sleep(random.uniform(0.5, 1.5))
+
+
+    def verify(self, path, destination):
+        """
+        Returns True if the checksum of the uploaded 'destination' matches that of the
+        local 'path', or None if the storage offers no checksum to compare against.
+        """
+        remote = normalise_checksum(storage.get_checksum(destination))
+        if remote is None:
+            print("No checksum available for %s, the upload is unverified" % destination)
+            return None
+        local = normalise_checksum(storage.get_file_checksum(path))
+        if remote != local:
+            print("Checksum mismatch for %s: %s uploaded, %s expected" % (destination, remote, local))
+            return False
+        return True
+
+
+    def upload(self, spooled):
+        """
+        Uploads the spooled file 'spooled' to its destination, with a random delay
+        first and up to self.retries retries, and removes it from the spool once
+        uploaded. Returns True on success.
+        """
+        with open(spooled + DESTINATION_SUFFIX) as destination_file:
+            destination = destination_file.read().strip()
+        time.sleep(random.uniform(0.0, self.jitter))
+
+        t0 = time.time()
+        wait = 0.0
+        status = "failed"
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                time.sleep(self.backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+            # Hold a slot only while copying, not while backing off
+            t1 = time.time()
+            with self.get_slot():
+                wait += time.time() - t1
+                try:
+                    copied = storage.copy(spooled, destination)
+                except (IOError, OSError) as error:
+                    print("Error uploading %s: %s" % (spooled, error))
+                    copied = False
+                verified = self.verify(spooled, destination) if copied else False
+            if verified is not False:
+                status = "uploaded" if verified else "unverified"
+                break
+
+        self.log({"name" : os.path.basename(spooled), "destination" : destination, "status" : status,
+                  "attempts" : attempt + 1, "latency" : time.time() - t0, "wait" : wait,
+                  "bytes" : os.path.getsize(spooled)})
+        if status == "failed":
+            print("Failed to upload %s after %s attempts, leaving it in %s" % (destination, attempt + 1, self.spool_dir))
+            return False
+        os.remove(spooled)
+        os.remove(spooled + DESTINATION_SUFFIX)
+        return True
+
+
+    def drain(self):
+        """
+        Attempts again to upload every tarball left in the spool, returning True if
+        the spool is empty afterwards.
+        """
+        spooled = self.get_spooled()
+        if spooled:
+            print("Draining %s uploads from %s" % (len(spooled), self.spool_dir))
+        return all([self.upload(path) for path in spooled])
+
+
+    def log(self, record):
+        """
+        Appends the record of an upload to the log in the spool. Records are written
+        in a single call, so the runs of the job may log concurrently.
+        """
+        make_dir(self.spool_dir)
+        with open(os.path.join(self.spool_dir, LOG_NAME), "a") as log_file:
+            log_file.write(json.dumps(record) + "\n")
+
+
+    def get_report(self):
+        """
+        Returns a report dict of the uploads logged in the spool, counting each file
+        by the outcome of its last attempt.
+        """
+        records = []
+        log_name = os.path.join(self.spool_dir, LOG_NAME)
+        if os.path.isfile(log_name):
+            with open(log_name) as log_file:
+                records = [json.loads(line) for line in log_file if line.strip()]
+
+        outcomes = {}
+        for record in records:
+            outcomes[record["name"]] = record
+        uploaded = [record for record in outcomes.values() if record["status"] != "failed"]
+        latencies = sorted(record["latency"] for record in uploaded)
+        return {"files" : len(outcomes),
+                "uploaded" : len(uploaded),
+                "unverified" : len([record for record in uploaded if record["status"] == "unverified"]),
+                "failed" : sorted(name for name, record in outcomes.items() if record["status"] == "failed"),
+                "attempts" : sum(record["attempts"] for record in records),
+                "bytes" : sum(record["bytes"] for record in uploaded),
+                "latencies" : latencies,
+                "wait" : sum(record["wait"] for record in records)}
+
+
+    def print_report(self):
+        """
+        Prints the success rate and latency of the uploads of the job.
+        """
+        report = self.get_report()
+        if not report["files"]:
+            return
+        latencies = report["latencies"]
+        print("=" * 80)
+        print("Uploaded %s of %s files (%.1f%%, %.1f MB) in %s attempts" % (report["uploaded"], report["files"], 100.0 * report["uploaded"] / report["files"], report["bytes"] / 1.0e6, report["attempts"]))
+        if latencies:
+            print("Upload latency: mean %.1f(s), median %.1f(s), max %.1f(s)" % (sum(latencies) / len(latencies), latencies[len(latencies) // 2], latencies[-1]))
+        print("Time waiting for an upload slot: %.1f(s)" % report["wait"])
+        if report["unverified"]:
+            print("Uploads without a checksum to verify: %s" % report["unverified"])
+        print("Failed uploads, left in %s: %s" % (self.spool_dir, len(report["failed"])))
+        for name in report["failed"]:
+            print("    %s" % name)
+        print("=" * 80)
+
+
+def parse():
+    """
+    Parse command line arguments.
+        spool_dir : spool directory of a job
+        retries   : int number of retries of each failed upload
+    """
+    parser = argparse.ArgumentParser(description = "Usage: python upload.py [-n retries] spool_dir")
+    parser.add_argument('spool_dir', type = str)
+    parser.add_argument('--retries', '-n', type = int, default = 4)
+    return parser.parse_args()
+
+
+def main():
+    """
+    Drains the spool of a job, reporting the uploads.
+    """
+    args = parse()
+    uploader = Uploader(args.spool_dir, jitter = 0.0, retries = args.retries)
+    uploader.drain()
+    uploader.print_report()
+
+
+if __name__ == """__main__""":
+    main()
@@ -0,0 +1,285 @@
+"""
+Queue of work units shared by pilot jobs.
+
+A pilot sets up its environment once and then keeps claiming units from the queue until
+its wall-time budget is spent. A unit is a job number: the pilot runs for it exactly the
+seeds (get_unique_seed(run) for each run) a submission with that job number would, so
+results do not depend on which pilot claims which unit.
+
+The queue is a directory on any storage backend (a local directory works as a stand-in
+for testing) holding:
+    queue.json : manifest listing the units, written by the manager
+    claimed/   : one entry per claim of a unit ('<unit>', then '<unit>.<attempt>' for
+                 each takeover), created with an atomic mkdir so that exactly one
+                 pilot wins each attempt at a unit
+    leases/    : '<unit>.<attempt>.<expiry>' entries giving the time at which each
+                 claim lapses, written before the claim so that none is ever seen
+                 without one
+    done/      : one entry per completed unit
+A claim lapses some time after the deadline of the pilot holding it, after which a unit
+that is not done (e.g. its pilot was killed at the wall-time limit, lost with its node
+or pre-empted) is taken over by the next pilot to reach it. Creating the queue again
+(e.g. to submit more pilots) keeps the existing claims, so the pilots carry on from
+where the previous ones stopped and pick up the units of dead pilots once their claims
+lapse. Claims without a lease, which only pilots of earlier versions make, are taken to
+have lapsed.
+
+Within a node, a unit may also be split into chunks of events: the workers then pull
+chunks from a shared counter until the unit's budget of events is used, so that a slow
+chunk holds up one worker rather than the whole node.
+"""
+import json
+import multiprocessing
+import os
+import time
+import traceback
+
+from GridTools import premerge, sandbox, storage
+
+
+# Seconds a claim outlives the deadline of the pilot holding it, allowing for a unit
+# running past the deadline and for clock skew between nodes
+LEASE_GRACE = 3600
+# Seconds a claim lasts when no expiry is given
+DEFAULT_LEASE = 7 * 86400
+
+
+class WorkQueue():
+
+
+    def __init__(self, url):
+        """
+        Initialises access to the queue in the directory 'url' on any storage backend.
+        """
+        self.url = str(url).rstrip("/")
+        self.units = None
+
+
+    def create(self, units):
+        """
+        Creates the queue (if needed) and writes its manifest of units.
+        """
+        for directory in [self.url, "%s/claimed" % self.url, "%s/leases" % self.url, "%s/done" % self.url]:
+            storage.make_dir(directory)
+
+        tmp_manifest = "queue.json.tmp%s" % os.getpid()
+        with open(tmp_manifest, "w") as manifest_file:
+            json.dump({"units" : [int(unit) for unit in units]}, manifest_file)
+        try:
+            if not storage.copy(tmp_manifest, "%s/queue.json" % self.url):
+                raise IOError("Failed to write the work queue to %s" % self.url)
+        finally:
+            os.remove(tmp_manifest)
+        self.units = [int(unit) for unit in units]
+
+
+    def get_units(self):
+        """
+        Returns the list of units, reading the manifest on first use.
+        """
+        if self.units is None:
+            tmp_manifest = "queue.json.tmp%s" % os.getpid()
+            if not storage.copy("%s/queue.json" % self.url, tmp_manifest):
+                raise IOError("Failed to read the work queue from %s" % self.url)
+            try:
+                with open(tmp_manifest) as manifest_file:
+                    self.units = json.load(manifest_file)["units"]
+            finally:
+                os.remove(tmp_manifest)
+        return self.units
+
+
+    def get_claims(self):
+        """
+        Returns a dict mapping each claimed unit (as a str) to the number of its latest
+        attempt and the time at which that claim lapses (0 if it has no lease).
+        """
+        claims = {}
+        for name in storage.list_names("%s/claimed" % self.url):
+            unit, _, attempt = name.partition(".")
+            attempt = int(attempt or 0)
+            if claims.get(unit, (-1, 0))[0] < attempt:
+                claims[unit] = (attempt, 0)
+        for name in storage.list_names("%s/leases" % self.url):
+            fields = name.split(".")
+            if len(fields) != 3 or fields[0] not in claims:
+                continue
+            attempt, expiry = claims[fields[0]]
+            # Pilots losing the race for an attempt leave their leases too, so the
+            # latest expiry is kept
+            if int(fields[1]) == attempt:
+                claims[fields[0]] = (attempt, max(expiry, int(fields[2])))
+        return claims
+
+
+    def claim(self, start=0, expiry=None):
+        """
+        Claims the first unit which is neither done nor held by a live claim, searching
+        from position 'start' in the manifest so that pilots starting together do not all
+        race for the same unit. The claim lapses at 'expiry' (a time.time() value, by
+        default DEFAULT_LEASE seconds from now), after which another pilot may take the
+        unit over unless it is done.
+        Returns the unit, or None once every unit is done or held.
+        """
+        units = self.get_units()
+        if not units:
+            return None
+        expiry = int(expiry or time.time() + DEFAULT_LEASE)
+        claims = self.get_claims()
+        done = set(storage.list_names("%s/done" % self.url))
+        now = time.time()
+        start = int(start) % len(units)
+        for unit in units[start:] + units[:start]:
+            if str(unit) in done:
+                continue
+            attempt, lapses = claims.get(str(unit), (-1, 0))
+            if attempt >= 0 and lapses > now:
+                continue
+
+            attempt += 1
+            storage.make_dir("%s/leases/%s.%s.%s" % (self.url, unit, attempt, expiry))
+            # Another pilot may have claimed the unit since the listing
+            if storage.make_dir("%s/claimed/%s" % (self.url, unit if attempt == 0 else "%s.%s" % (unit, attempt))):
+                if attempt > 0:
+                    print("Taking over unit %s from a lapsed claim" % unit)
+                return unit
+        return None
+
+
+    def set_done(self, unit):
+        """
+        Records the unit as completed.
+        """
+        storage.make_dir("%s/done/%s" % (self.url, unit))
+
+
+def run_unit(job, processes, events, chunk_events=None, merge=False):
+    """
+    Runs 'processes' runs of 'events' events for the current job number of 'job' in
+    parallel, as a single submission does, each in its own sandbox.
+    If 'chunk_events' is set, the same budget of events is run in chunks instead.
+    If 'merge' is set, the results of the runs are merged on the node and uploaded once.
+    """
+    if merge:
+        run_merged(job, processes, events, chunk_events)
+        return
+
+    if chunk_events:
+        run_chunks(job, processes, events, chunk_events)
+        return
+
+    runs = []
+    for number in range(processes):
+        p = multiprocessing.Process(target = sandbox.run_job, args = (job, number, events))
+        runs.append(p)
+
+    for run in runs:
+        run.start()
+
+    for run in runs:
+        run.join()
+
+
+def run_merged(job, processes, events, chunk_events=None):
+    """
+    Runs the current job number of 'job' as run_unit does, with the runs saving their
+    results to a spool on the node, and then uploads them merged into one tarball.
+    """
+    output_dir = job.output_dir
+    spool_dir = os.path.abspath(os.path.join(sandbox.RUNS_DIR, "results_%s" % job.job_number))
+    if not os.path.isdir(spool_dir):
+        os.makedirs(spool_dir)
+
+    # The runs are forked with the spool as their output directory
+    job.output_dir = spool_dir
+    try:
+        run_unit(job, processes, events, chunk_events)
+    finally:
+        job.output_dir = output_dir
+    premerge.upload(spool_dir, output_dir, job.job_number, processes, job.uploader)
+
+
+def get_chunk_count(processes, events, chunk_events):
+    """
+    Returns the number of chunks of 'chunk_events' events run by a job of 'processes'
+    runs of 'events' events, the budget being rounded up to whole chunks.
+    """
+    return -(-int(processes) * int(events) // int(chunk_events))
+
+
+def run_chunks(job, processes, events, chunk_events):
+    """
+    Runs the budget of 'processes' * 'events' events for the current job number of 'job'
+    as chunks of 'chunk_events' events, pulled by 'processes' workers until none are left.
+    Chunk i is run as run number i, so it is seeded with job.get_unique_seed(i): seeds
+    stay unique across job numbers and do not depend on which worker runs which chunk.
+    All chunks are the same size (the budget is rounded up to whole chunks), so that their
+    results carry equal weight when merged.
+    """
+    chunks = get_chunk_count(processes, events, chunk_events)
+    print("Running %s chunks of %s events on %s workers" % (chunks, chunk_events, processes))
+    counter = multiprocessing.Value("i", 0)
+
+    workers = []
+    for number in range(processes):
+        p = multiprocessing.Process(target = run_worker, args = (job, counter, chunks, chunk_events))
+        workers.append(p)
+
+    for worker in workers:
+        worker.start()
+
+    for worker in workers:
+        worker.join()
+
+
+def run_worker(job, counter, chunks, chunk_events):
+    """
+    Takes the next chunk index from the shared 'counter' and runs it, until all 'chunks'
+    have been taken.
+    """
+    while True:
+        with counter.get_lock():
+            index = counter.value
+            counter.value += 1
+        if index >= chunks:
+            return
+
+        try:
+            sandbox.run_job(job, index, chunk_events)
+        except Exception:
+            # A broken chunk should not stop the worker taking the remaining ones
+            print("Chunk %s failed:" % index)
+            traceback.print_exc()
+
+
+def run_pilot(job, processes, events, queue_url, deadline, chunk_events=None, merge=False):
+    """
+    Claims units from the queue at 'queue_url' and runs them with the (already set up)
+    'job' until the queue is empty or the next unit is not expected to finish before
+    'deadline' (a time.time() value), in chunks of 'chunk_events' events if set and
+    merging the results of each unit on the node if 'merge' is set.
+    Returns the list of units run.
+    """
+    queue = WorkQueue(queue_url)
+    completed = []
+    longest = 0.0
+    while True:
+        if time.time() + longest > deadline:
+            print("Wall-time budget spent, pilot stopping")
+            break
+
+        unit = queue.claim(job.job_number, deadline + LEASE_GRACE)
+        if unit is None:
+            print("Work queue empty, pilot stopping")
+            break
+
+        print("Pilot running unit %s" % unit)
+        t0 = time.time()
+        job.job_number = int(unit)
+        run_unit(job, processes, events, chunk_events, merge)
+        queue.set_done(unit)
+        completed.append(unit)
+        longest = max(longest, time.time() - t0)
+
+    print("Pilot ran %s units: %s" % (len(completed), completed))
+    return completed
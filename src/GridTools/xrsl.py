@@ -0,0 +1,58 @@
+"""
+xRSL job descriptions rendered in Python from a template.
+
+The managers describe a job by its executable, its quoted arguments, the number of
+cores and any further relations, and the descriptions of a whole campaign are rendered
+and written to job<job_number>.jdl in one pass, without starting a shell per job.
+"""
+import os
+
+from GridTools import upload
+
+
+TEMPLATE = """&(executable = '%(executable)s')
+(arguments = %(arguments)s)
+(jobname = %(executable)s.%(job_number)s)
+(stdout = 'stdout')
+(stderr = 'stderr')
+(gmlog = 'job%(job_number)s.log')
+(outputFiles = ('%(spool_dir)s/' ''))
+%(relations)s(count = '%(count)s')
+(countpernode = '%(count)s')
+"""
+
+
+def get_job_file(job_number, directory="."):
+    """
+    Returns the path of the description of job 'job_number'.
+    """
+    return os.path.join(directory, "job%s.jdl" % job_number)
+
+
+def render(executable, job_number, arguments, count, relations=""):
+    """
+    Returns the xRSL description of a job given:
+        executable : job script run on the node
+        job_number : index of the submission
+        arguments  : arguments of the job script, quoted for xRSL
+        count      : int number of cores requested on one node
+        relations  : further xRSL relations, one per line
+    The uploads a job fails to make are left in its spool, kept on the CE for 'arcget'.
+    """
+    return TEMPLATE % {"executable" : executable, "job_number" : job_number, "arguments" : arguments,
+                       "spool_dir" : upload.SPOOL_DIR, "relations" : relations, "count" : count}
+
+
+def write_all(descriptions, directory="."):
+    """
+    Writes the (job number, description) pairs in 'descriptions' to their job files
+    and returns the (job number, job file) pairs.
+    """
+    job_files = []
+    for job_number, description in descriptions:
+        job_file = get_job_file(job_number, directory)
+        with open(job_file, "w") as description_file:
+            description_file.write(description)
+        job_files.append((job_number, job_file))
+    print("Wrote %s job descriptions" % len(job_files))
+    return job_files
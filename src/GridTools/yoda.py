@@ -0,0 +1,419 @@
+"""
+Reads, merges and writes text YODA files in-process.
+
+Bin contents are loaded into NumPy arrays and summed with vectorised operations,
+reproducing the default behaviour of the 'yodamerge' script:
+    Counter, Histo1D/2D, Profile1D/2D : weights summed over the input files and
+                                        scaled by 1/N (--add sums without scaling)
+    Scatter1D/2D/3D                   : values averaged over the input files with
+                                        errors added in quadrature and scaled by 1/N
+                                        (--add sums values instead)
+    anything else                     : first occurrence is kept
+Objects keep their raw sums and the number of files merged into them, so partial
+merges may be combined in any order before the result is written. This allows large
+sets of files to be merged in chunks on a pool of worker processes, with the partial
+results combined pairwise in a reduction tree of logarithmic depth.
+
+A partial merge may also be written out (e.g. on a grid node, before uploading it), in
+which case its raw sums are written with a 'MergedFiles' annotation recording the number
+of files merged into each object. Reading the file back restores that count, so merging
+partial merges gives the same result as merging all the original files at once.
+"""
+import gzip
+import multiprocessing
+import sys
+from collections import OrderedDict
+
+import numpy
+
+
+# Number of leading columns describing the binning (or fixed coordinates) of each row
+EDGE_COLUMNS = {
+    "Counter"   : 0,
+    "Histo1D"   : 2,
+    "Profile1D" : 2,
+    "Histo2D"   : 4,
+    "Profile2D" : 4,
+    "Scatter1D" : 0,
+    "Scatter2D" : 3,
+    "Scatter3D" : 6,
+}
+
+HISTOGRAMS = ("Counter", "Histo1D", "Histo2D", "Profile1D", "Profile2D")
+SCATTERS = ("Scatter1D", "Scatter2D", "Scatter3D")
+
+# Row labels are padded to the width YODA writes them with
+PADDED_LABELS = {"Total" : "Total   "}
+
+# Annotation holding the number of files merged into an object of a partial merge
+MERGED_FILES = "MergedFiles"
+
+
+class AnalysisObject():
+
+
+    def __init__(self, path, tag, annotations, layout, edges, values):
+        """
+        Initialises an analysis object given:
+            path        : str object path, e.g. /ANALYSIS/d01-x01-y01
+            tag         : str block tag, e.g. YODA_HISTO1D_V2
+            annotations : list of (key, value) str pairs in file order
+            layout      : list of comment lines in the data section, with None
+                          marking the position of each data row
+            edges       : list of tuples of str binning columns for each row
+            values      : 2D numpy array of the remaining columns for each row
+        """
+        self.path = str(path)
+        self.tag = str(tag)
+        self.annotations = annotations
+        self.layout = layout
+        self.edges = edges
+        self.values = values
+        self.nfiles = 1
+        self.type = self.get_type()
+
+
+    def get_type(self):
+        """
+        Returns the object type, from the 'Type' annotation or the block tag.
+        """
+        for key, value in self.annotations:
+            if key == "Type":
+                return value.strip()
+
+        # Older files without annotations: YODA_HISTO1D_V2 -> Histo1D
+        name = self.tag.replace("YODA_", "").split("_V")[0]
+        for aotype in EDGE_COLUMNS:
+            if aotype.upper() == name:
+                return aotype
+        return name
+
+
+    def is_mergeable(self):
+        """
+        Returns True if the bin contents of the object can be summed.
+        """
+        return (self.type in HISTOGRAMS or self.type in SCATTERS) and self.values is not None
+
+
+    def add(self, other):
+        """
+        Adds the raw sums of another object with the same path and binning.
+        """
+        if other.type != self.type:
+            print("WARNING: type mismatch for %s (%s, %s), keeping the first" % (self.path, self.type, other.type))
+            return
+
+        if not self.is_mergeable():
+            return
+
+        if other.edges != self.edges or other.values.shape != self.values.shape:
+            raise(ValueError("Binning mismatch when merging %s" % self.path))
+
+        self.values = self.values + other.values
+        self.nfiles += other.nfiles
+
+
+    def get_scale_powers(self):
+        """
+        Returns the power of the weight scale factor carried by each value column:
+        sumw2 scales quadratically, numEntries not at all and everything else linearly.
+        """
+        powers = numpy.ones(self.values.shape[1])
+        if len(powers) > 1:
+            powers[1] = 2.0
+        powers[-1] = 0.0
+        return powers
+
+
+    def get_final_values(self, stack=False):
+        """
+        Returns the merged values as they should be written out.
+        """
+        if self.type in SCATTERS:
+            # Columns are value, err-, err+ with the errors held as squared sums
+            final = self.values.copy()
+            final[:, 1:] = numpy.sqrt(final[:, 1:])
+            if not stack:
+                final /= self.nfiles
+            return final
+
+        if stack or self.nfiles == 1:
+            return self.values
+        return self.values * (1.0 / self.nfiles) ** self.get_scale_powers()
+
+
+    def get_final_annotations(self, stack=False):
+        """
+        Returns the annotations with 'ScaledBy' updated (or added) for averaged histograms.
+        """
+        if stack or self.nfiles == 1 or self.type not in HISTOGRAMS:
+            return self.annotations
+
+        annotations = []
+        scaled = False
+        for key, value in self.annotations:
+            if key == "ScaledBy":
+                value = repr(float(value) / self.nfiles)
+                scaled = True
+            annotations.append((key, value))
+
+        if not scaled:
+            # scaleW adds the annotation, which YODA writes in order of key
+            index = len([key for key, value in annotations if key < "ScaledBy"])
+            annotations.insert(index, ("ScaledBy", repr(1.0 / self.nfiles)))
+        return annotations
+
+
+    def get_statistic(self, comment, values):
+        """
+        Recomputes the summary statistic comments (mean, area, volume) written
+        by YODA above the bins of a histogram.
+        """
+        totals = [row for row, edges in zip(values, self.edges) if edges[0] == "Total"]
+        if not totals:
+            return comment
+        total = totals[0]
+        sumw = total[0]
+
+        label = comment.split(":")[0]
+        if label == "# Area" or label == "# Volume":
+            return "%s: %.6e" % (label, sumw)
+        if label == "# Mean":
+            if EDGE_COLUMNS[self.type] == 2:
+                return "# Mean: %.6e" % (total[2] / sumw if sumw else float("nan"))
+            return "# Mean: (%.6e, %.6e)" % (total[2] / sumw if sumw else float("nan"),
+                                             total[4] / sumw if sumw else float("nan"))
+        return comment
+
+
+    def to_lines(self, stack=False, partial=False):
+        """
+        Returns the object as a list of text lines in YODA format, with its raw sums and
+        the number of files merged into it if 'partial' is set.
+        """
+        lines = ["BEGIN %s %s" % (self.tag, self.path)]
+        if partial:
+            annotations = list(self.annotations)
+            if self.is_mergeable():
+                annotations.append((MERGED_FILES, str(self.nfiles)))
+            stack = True
+        else:
+            annotations = self.get_final_annotations(stack)
+        for key, value in annotations:
+            lines.append("%s: %s" % (key, value))
+
+        values = self.get_final_values(stack) if self.is_mergeable() else self.values
+        row = 0
+        for entry in self.layout:
+            if entry is None:
+                tokens = [PADDED_LABELS.get(edge, edge) for edge in self.edges[row]]
+                # Partial merges keep full precision, as they are merged further
+                tokens += [(partial and "%.15e" or "%.6e") % value for value in values[row]]
+                lines.append("\t".join(tokens))
+                row += 1
+            elif self.type in HISTOGRAMS and self.nfiles > 1 and entry.startswith(("# Mean:", "# Area:", "# Volume:")):
+                lines.append(self.get_statistic(entry, values))
+            else:
+                lines.append(entry)
+
+        lines.append("END %s" % self.tag)
+        return lines
+
+
+
+def is_number(token):
+    """
+    Returns True if token can be read as a float.
+    """
+    try:
+        float(token)
+    except ValueError:
+        return False
+    return True
+
+
+def open_file(filename, mode="r"):
+    """
+    Opens a (possibly gzipped) YODA file as text.
+    """
+    if filename.endswith(".gz"):
+        if sys.version_info[0] < 3:
+            return gzip.open(filename, mode.replace("t", ""))
+        return gzip.open(filename, mode + "t" if "t" not in mode else mode)
+    return open(filename, mode)
+
+
+def get_edge_count(row, n_edges):
+    """
+    Returns the number of binning columns of a data row of an object with 'n_edges' of
+    them: labelled rows (e.g. Total) have two labels in place of the edges, also in 2D.
+    """
+    if row and not is_number(row[0]):
+        return len([token for token in row[:n_edges] if not is_number(token)])
+    return n_edges
+
+
+def parse_block(tag, path, lines):
+    """
+    Builds an AnalysisObject from the lines between BEGIN and END of one block.
+    """
+    # Annotations precede the '---' separator (V2) or the first comment/data row (V1)
+    annotations = []
+    start = 0
+    if "---" in lines:
+        start = lines.index("---") + 1
+        body = lines[:start - 1]
+    else:
+        body = []
+        for line in lines:
+            if line.startswith("#") or ": " not in line or is_number(line.split()[0]):
+                break
+            body.append(line)
+            start += 1
+    for line in body:
+        if ": " in line:
+            key, value = line.split(": ", 1)
+        else:
+            key, value = line.rstrip(":"), ""
+        annotations.append((key, value))
+
+    layout = []
+    if "---" in lines:
+        layout.append("---")
+    ao = AnalysisObject(path, tag, [(key, value) for key, value in annotations if key != MERGED_FILES], layout, [], None)
+    for key, value in annotations:
+        if key == MERGED_FILES:
+            # Written by a partial merge
+            ao.nfiles = int(value)
+    n_edges = EDGE_COLUMNS.get(ao.type)
+
+    rows = []
+    for line in lines[start:]:
+        if not line.strip() or line.startswith("#") or n_edges is None:
+            layout.append(line)
+            continue
+        layout.append(None)
+        rows.append(line.split())
+
+    if n_edges is None:
+        # Unknown types are passed through untouched
+        return ao
+
+    ao.edges = [tuple(row[:get_edge_count(row, n_edges)]) for row in rows]
+    if len(set(len(row) - len(edges) for row, edges in zip(rows, ao.edges))) > 1:
+        raise(ValueError("Rows with different numbers of values in %s" % path))
+    tokens = [token for row, edges in zip(rows, ao.edges) for token in row[len(edges):]]
+    ao.values = numpy.array(tokens, dtype=float).reshape(len(rows), -1) if rows else numpy.zeros((0, 1))
+
+    if ao.type in SCATTERS:
+        # Keep the errors as squared sums so that they add in quadrature
+        ao.values[:, 1:] = ao.values[:, 1:] ** 2
+    return ao
+
+
+def read(filename):
+    """
+    Reads a YODA file and returns an ordered dict of path -> AnalysisObject.
+    """
+    aos = OrderedDict()
+    block = None
+    with open_file(filename) as yoda_file:
+        for line in yoda_file:
+            line = line.rstrip("\n")
+            if line.startswith("BEGIN "):
+                fields = line.split(None, 2)
+                tag = fields[1]
+                path = fields[2] if len(fields) > 2 else ""
+                block = []
+            elif line.startswith("END ") and block is not None:
+                ao = parse_block(tag, path, block)
+                aos[ao.path] = ao
+                block = None
+            elif block is not None:
+                block.append(line)
+    return aos
+
+
+def combine(aos, other):
+    """
+    Merges the analysis objects in 'other' into 'aos' (both dicts of path -> AnalysisObject)
+    and returns 'aos'.
+    """
+    for path, ao in other.items():
+        if path in aos:
+            aos[path].add(ao)
+        else:
+            aos[path] = ao
+    return aos
+
+
+def accumulate(filenames):
+    """
+    Reads and merges a list of YODA files, returning the unnormalised result.
+    """
+    aos = OrderedDict()
+    for filename in filenames:
+        combine(aos, read(filename))
+    return aos
+
+
+def combine_pair(pair):
+    """
+    Merges a pair of partial results, for use with multiprocessing.Pool.map.
+    """
+    return combine(pair[0], pair[1])
+
+
+def accumulate_parallel(filenames, processes):
+    """
+    Reads and merges a list of YODA files on 'processes' worker processes: each worker
+    accumulates one chunk of the files and the partial results are then combined
+    pairwise until a single result remains.
+    """
+    n_chunks = min(processes, len(filenames))
+    chunks = [filenames[idx::n_chunks] for idx in range(n_chunks)]
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        partials = pool.map(accumulate, chunks)
+        while len(partials) > 1:
+            pairs = list(zip(partials[0::2], partials[1::2]))
+            leftover = partials[-1:] if len(partials) % 2 else []
+            partials = pool.map(combine_pair, pairs) + leftover
+    finally:
+        pool.close()
+        pool.join()
+    return partials[0]
+
+
+def write(aos, filename, stack=False, partial=False):
+    """
+    Writes merged analysis objects (sorted by path) to a YODA file, as a partial merge
+    to be merged further if 'partial' is set.
+    """
+    with open_file(filename, "w") as yoda_file:
+        for path in sorted(aos):
+            yoda_file.write("\n".join(aos[path].to_lines(stack, partial)) + "\n\n")
+
+
+def merge_files(filenames, output, stack=False, processes=1, partial=False):
+    """
+    Merges a list of YODA files into 'output', equivalent to
+    'yodamerge [--add] filenames -o output', using 'processes' worker
+    processes (0 for all available cores). If 'partial' is set the output is
+    a partial merge, to be merged further with other files.
+    """
+    filenames = sorted(filenames)
+    if not filenames:
+        print("No yoda files to merge into %s" % output)
+        return
+
+    if processes == 0:
+        processes = multiprocessing.cpu_count()
+
+    if processes > 1 and len(filenames) > 1:
+        aos = accumulate_parallel(filenames, processes)
+    else:
+        aos = accumulate(filenames)
+    write(aos, output, stack, partial)
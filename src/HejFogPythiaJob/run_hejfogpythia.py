@@ -4,15 +4,37 @@ Runs a multiprocessed HEJ+Pythia (with HEJFOG as the LO generator) job on a sing
 grid node.
 """
 import argparse
+import glob
 import os
+import sys
 import time
 import multiprocessing
 
+# Shared tools live next to the job directories in src/
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from GridTools import cards, manifest, resources, sandbox, stages, staging, tarballs, toolcache, upload, workqueue
+
+
+# Tool tarballs on grid storage (formatted with the user name) and the directories
+# they are unpacked into
+TOOL_BUNDLES = [
+    ("gsiftp://se01.dur.scotgrid.ac.uk/dpm/dur.scotgrid.ac.uk/home/pheno/%s/HEJ/HEJ.tar.gz", "."),
+    ("gsiftp://se01.dur.scotgrid.ac.uk/dpm/dur.scotgrid.ac.uk/home/pheno/%s/Pythia/Pythia.tar.gz", "."),
+    ("gsiftp://se01.dur.scotgrid.ac.uk/dpm/dur.scotgrid.ac.uk/home/pheno/%s/HEJ_pythia/HEJ_pythia.tar.gz", "."),
+]
+
+# Run cards linked from the base directory into the sandbox of each run
+CARDS = ["configFOG.yml", "config.yml", "hej_merging.cmnd"]
+
+# Peak memory (MB) and disk (MB, plus kB per event) of one run, used to size the
+# number of concurrent runs to the node
+RUN_PROFILE = resources.Profile(4000, 1000, 20)
+
 
 class HejFogPythiaJob(): 
 
 
-    def __init__(self, user_name, job_number, base_dir, rivet_dir, output_dir):
+    def __init__(self, user_name, job_number, base_dir, rivet_dir, output_dir, stage_timeout=None):
         """
         Initialises a (HEJFOG-initiated) HEJ+Pythia run given:
             user_name : str user name for gridui and dpm grid storage
@@ -20,12 +42,15 @@ class HejFogPythiaJob():
             base_dir : base directory for input files
             rivet_dir : path for compiled rivet analysis libraries, and PDFs
             output_dir : output directory on grid storage server, with protocol
+            stage_timeout : optional wall-time limit in seconds of each generator stage
         """
         self.user_name = str(user_name)
         self.job_number = int(job_number)
         self.base_dir = str(base_dir)
         self.rivet_dir = str(rivet_dir)
         self.output_dir = str(output_dir)
+        self.stage_timeout = stage_timeout
+        self.uploader = upload.Uploader.from_environment(self.user_name)
 
 
     def __del__(self):
@@ -47,33 +72,22 @@ class HejFogPythiaJob():
         os.system(cmd)
         os.system("source /cvmfs/pheno.egi.eu/HEJ/HEJ_env.sh")
         os.environ["MYPROXY_SERVER"] = "myproxy.gridpp.rl.ac.uk"
+        cache = toolcache.ToolCache.from_environment(self.user_name)
+
+        print("Downloading and unpacking tool tarballs from grid storage")
+        failed = toolcache.unpack_all(cache, [(url % self.user_name, directory) for url, directory in TOOL_BUNDLES])
+        if failed:
+            # The runs cannot work without their tools, so fail the job rather than its runs
+            raise IOError("Failed to unpack the tools %s" % ", ".join(failed))
+        self.base_dir = staging.get_base_dir(self.base_dir)
+        # Cards rendered for each seed are read once per node
+        self.templates = cards.load_templates(self.base_dir, ["configFOG.yml", "config.yml", "hej_merging.cmnd"])
 
-        print("Downloading HEJ.tar.gz from grid storage")
-        cmd = "gfal-copy gsiftp://se01.dur.scotgrid.ac.uk/dpm/dur.scotgrid.ac.uk/home/pheno/%s/HEJ/HEJ.tar.gz ./ -f" % self.user_name
-        os.system(cmd)
-        print("untarring HEJ.tar.gz")
-        os.system("tar -xzf HEJ.tar.gz")
-        os.system("rm HEJ.tar.gz")
- 
         print("Setting environment for HEJ run")
         self.set_hej_env()
         os.environ["LD_LIBRARY_PATH"] = "%s/HEJ/lib:%s" % (str(os.getcwd()), str(os.environ.get("LD_LIBRARY_PATH",'')))
         os.environ["PATH"] = "%s/HEJ/bin:%s" % (str(os.getcwd()), str(os.environ.get("PATH",'')))
 
-        print("Downloading Pythia.tar.gz from grid storage")
-        cmd = "gfal-copy gsiftp://se01.dur.scotgrid.ac.uk/dpm/dur.scotgrid.ac.uk/home/pheno/%s/Pythia/Pythia.tar.gz ./ -f" % self.user_name
-        os.system(cmd)
-        print("untarring Pythia.tar.gz")
-        os.system("tar -xzf Pythia.tar.gz")
-        os.system("rm -f Pythia.tar.gz")
-        
-        print("Downloading HEJ_pythia.tar.gz from grid storage")
-        cmd = "gfal-copy gsiftp://se01.dur.scotgrid.ac.uk/dpm/dur.scotgrid.ac.uk/home/pheno/%s/HEJ_pythia/HEJ_pythia.tar.gz ./ -f" % self.user_name
-        os.system(cmd)
-        print("untarring HEJ_pythia.tar.gz")
-        os.system("tar -xzf HEJ_pythia.tar.gz")
-        os.system("rm HEJ_pythia.tar.gz")
-
         print("Setting environment for HEJ_Pythia")
         os.environ["PATH"] = "%s/HEJ_pythia/bin:%s" % (str(os.getcwd()), str(os.environ.get("PATH",'')))
         os.environ["LD_LIBRARY_PATH"] = "%s/Pythia/lib:%s" % (str(os.getcwd()), str(os.environ.get("LD_LIBRARY_PATH",'')))
@@ -113,64 +127,44 @@ class HejFogPythiaJob():
         """
         # TODO: Don't hardcode names of runfiles (even though they are standard)
         seed = self.get_unique_seed(run_number)
-        cmd = "cp -r %s/configFOG.yml %s/config.yml %s/hej_merging.cmnd ." % (str(self.base_dir), str(self.base_dir), str(self.base_dir))
-        os.system(cmd)
+        sandbox.link_inputs(os.path.join(self.base_dir, card) for card in CARDS)
 
         # Modify HEJFOG input parameter seeds
-        cmd = "cp configFOG.yml configFOG_%s.yml" % (str(seed))
-        os.system(cmd)
-        cmd = "sed -i 's/events:.*/events: %s/g' configFOG_%s.yml" % (str(events), str(seed))
-        os.system(cmd)
-        cmd = "sed -i 's/seed:.*/seed: %s/g' configFOG_%s.yml" % (str(seed), str(seed))
-        os.system(cmd)
-        cmd = "sed -i 's/output:.*HEJ.*/output: HEJFOG_%s/g' configFOG_%s.yml" % (str(seed), str(seed))
-        os.system(cmd)
-        cmd = "sed -i 's/.*lhe/  - HEJFOG_%s.lhe/g' configFOG_%s.yml" % (str(seed), str(seed))
-        os.system(cmd)
+        self.templates["configFOG.yml"].render("configFOG_%s.yml" % (str(seed)), [
+            ("events:.*", "events: %s" % (str(events))),
+            ("seed:.*", "seed: %s" % (str(seed))),
+            ("output:.*HEJ.*", "output: HEJFOG_%s" % (str(seed))),
+            (".*lhe", "  - HEJFOG_%s.lhe" % (str(seed))),
+        ])
 
         # Run HEJFOG
-        print("Starting HEJFOG run at:")
-        os.system("date")
         cmd = "HEJFOG configFOG_%s.yml" % (str(seed))
-        os.system(cmd)
-        print("HEJFOG finished running at:")
-        os.system("date")
+        if not stages.run_stage("HEJFOG", cmd, ["HEJFOG_%s.lhe" % (str(seed))], self.stage_timeout):
+            return
 
         # Modify HEJ input parameter seeds
-        cmd = "cp config.yml config_%s.yml" % (str(seed))
-        os.system(cmd)
-        cmd = "sed -i 's/seed:.*/seed: %s/g' config_%s.yml" % (str(seed), str(seed))
-        os.system(cmd)
-        cmd = "sed -i 's/output:.*HEJ.*/output: HEJ_%s/g' config_%s.yml" % (str(seed), str(seed))
-        os.system(cmd)
-        cmd = "sed -i 's/.*lhe/  - HEJ_%s.lhe/g' config_%s.yml" % (str(seed), str(seed))
-        os.system(cmd)
+        self.templates["config.yml"].render("config_%s.yml" % (str(seed)), [
+            ("seed:.*", "seed: %s" % (str(seed))),
+            ("output:.*HEJ.*", "output: HEJ_%s" % (str(seed))),
+            (".*lhe", "  - HEJ_%s.lhe" % (str(seed))),
+        ])
 
         # Run HEJ
-        print("Starting HEJ run at:")
-        os.system("date")
         cmd = "HEJ config_%s.yml HEJFOG_%s.lhe" % (str(seed), str(seed))
-        os.system(cmd)
-        print("HEJ finished running at:")
-        os.system("date")
+        if not stages.run_stage("HEJ", cmd, ["HEJ_%s.*" % (str(seed))], self.stage_timeout):
+            return
 
         # Modify HEJ+Pythia parameter seeds
-        cmd = "cp hej_merging.cmnd hej_merging_%s.cmnd" % (str(seed))
-        os.system(cmd)
-        cmd = "sed -i 's/Random:seed.*=.*/Random:seed = %s/g' hej_merging_%s.cmnd" % (str(seed), str(seed))
-        os.system(cmd)
-        cmd = "sed -i 's/rivet:output.*=.*/rivet:output = HEJmerging_%s.yoda/g' hej_merging_%s.cmnd" % (str(seed), str(seed))
-        os.system(cmd)
-        cmd = "sed -i 's/Merging:HEJconfigPath.*=.*/Merging:HEJconfigPath = config_%s.yml/g' hej_merging_%s.cmnd" % (str(seed), str(seed))
-        os.system(cmd)
+        self.templates["hej_merging.cmnd"].render("hej_merging_%s.cmnd" % (str(seed)), [
+            ("Random:seed.*=.*", "Random:seed = %s" % (str(seed))),
+            ("rivet:output.*=.*", "rivet:output = HEJmerging_%s.yoda" % (str(seed))),
+            ("Merging:HEJconfigPath.*=.*", "Merging:HEJconfigPath = config_%s.yml" % (str(seed))),
+        ])
 
         # Run HEJ+Pythia
-        print("Starting HEJ+Pythia run at:")
-        os.system("date")
         cmd = "HEJ_Pythia hej_merging_%s.cmnd HEJ_%s.lhe" % (str(seed), str(seed))
-        os.system(cmd)
-        print("HEJ+Pythia finished running at:")
-        os.system("date")
+        if not stages.run_stage("HEJ+Pythia", cmd, ["HEJmerging_%s.*" % (str(seed))], self.stage_timeout):
+            return
 
         self.print_info()
         self.save_results(seed)
@@ -181,19 +175,20 @@ class HejFogPythiaJob():
         Copies the analysis output files and input cards to the grid storage.
         """
         # Compress the output into one tarball
-        cmd = "tar -czvf hej_pythia_output%s.tar.gz *%s*.yoda *%s.cmnd *%s.yml" % (str(seed), str(seed), str(seed), str(seed))
+        cmd = "tar -czhvf hej_pythia_output%s.tar.gz *%s*.yoda *%s.cmnd *%s.yml" % (str(seed), str(seed), str(seed), str(seed))
         os.system(cmd)
 
-        # Copy the tarball of results to the grid storage
-        cmd = "gfal-copy hej_pythia_output%s.tar.gz %s -f" % (str(seed), str(self.output_dir))
-        os.system(cmd)
+        # Upload the tarball of results to the grid storage, spooling it if that fails
+        tarball = "hej_pythia_output%s.tar.gz" % (str(seed))
+        self.uploader.save(tarball, "%s/%s" % (str(self.output_dir), tarball))
 
 
     def clean_job(self):
         """
-        Removes the remaining files.
+        Removes the sandboxes of the runs, the staged run cards and the tools.
         """
-        os.system("rm *gz *yml *dat *yoda *cmnd *tex *lhe* Results* -r Process Sherpa HEJ HEJ_pythia lib bin include share Pythia Status* -f")
+        sandbox.clean()
+        os.system("rm -r %s Sherpa HEJ HEJ_pythia lib bin include share Pythia -f" % staging.CARDS_DIR)
 
 
     def print_info(self):
@@ -212,17 +207,28 @@ class HejFogPythiaJob():
 class HejFogPythiaMerger():
 
 
-    def __init__(self, user_name, grid_output_dir, prune=False, prune_script="yodastats"):
+    def __init__(self, user_name, grid_output_dir, prune=False, prune_script="yodastats", processes=1, streams=8):
         """
         Initialises merger for output files given:
             user_name       : user name for gridui and dpm grid storage
             grid_output_dir : location of output files on grid storage
             prune           : optional bool to prune the output data
             prune_script    : name of C/C++ script to prune yoda files
+            processes       : optional int number of worker processes for merging,
+                              0 uses all available cores
+            streams         : optional int number of concurrent transfers when copying
         """
         self.user_name = str(user_name)
         self.grid_output_dir = str(grid_output_dir)
+        self.processes = int(processes)
+        self.streams = int(streams)
         self.prune = bool(prune)
+        # Glob patterns of output files and the directory each category is sorted into
+        self.categories = [
+            ("LO*yoda", "results/lo-output"),
+            ("HEJ_*yoda", "results/hej-output"),
+            ("HEJmerging_*yoda", "results/hej-pythia-output"),
+        ]
         if self.prune:
             self.prune_script = prune_script
 
@@ -234,41 +240,40 @@ class HejFogPythiaMerger():
 
     def copy_files(self):
         """
-        Copies grid output files to scratch dir.
+        Copies grid output files not retrieved by a previous finalise to scratch dir
+        and organises them.
         """
-        print("Copying output to scratch")
-        cmd = "gfal-copy -f -r %s %s" % (self.grid_output_dir, self.scratch_dir)
-        os.system(cmd)
+        print("Copying new output to scratch")
+        retrieved = manifest.Manifest(os.path.join(self.scratch_dir, "manifest.json"))
+        manifest.retrieve_new(self.grid_output_dir, self.scratch_dir, retrieved, self.streams)
         os.system("mkdir results")
         os.system("mkdir results/lo-output")
         os.system("mkdir results/hej-output")
         os.system("mkdir results/hej-pythia-output")
 
         print("Organising output into categories of runs")
-        files = os.listdir(self.scratch_dir)
+        files = retrieved.get_unorganised()
         print(files)
-        with multiprocessing.Pool() as pool:
-            # Use multiprocessing to organise output in parallel
-            pool.map(self.organise_single, files)
-
-        os.system("rm tmp_logfile")
+        try:
+            with multiprocessing.Pool() as pool:
+                # Use multiprocessing to organise output in parallel
+                organised = pool.map(self.organise_single, files)
+            retrieved.set_organised([name for name, success in zip(files, organised) if success])
+            retrieved.set_failed([name for name, success in zip(files, organised) if not success])
+        finally:
+            retrieved.save()
 
 
     def organise_single(self, filename):
         """
-        Organise the tarball of results named 'filename'.
+        Organise the tarball of results named 'filename', streaming each output file
+        straight into its category directory. Returns True if it was organised.
         """
-        # TODO: Clean output for log file (e.g. mark with process ID)
-        cmd = "tar -xzf %s/%s >> tmp_logfile 2>&1" % (self.scratch_dir, filename)
-        os.system(cmd)
-        cmd = "mv LO*yoda results/lo-output >> tmp_logfile 2>&1"
-        os.system(cmd)
-        cmd = "mv HEJ_*yoda results/hej-output >> tmp_logfile 2>&1"
-        os.system(cmd)
-        cmd = "mv HEJmerging_*yoda results/hej-pythia-output >> tmp_logfile 2>&1"
-        os.system(cmd)
-        cmd = "rm *yoda *cmnd *yml >> tmp_logfile 2>&1"
-        os.system(cmd)
+        try:
+            return tarballs.extract_by_category(os.path.join(self.scratch_dir, filename), self.categories)
+        except Exception as error:
+            print("Failed to organise %s: %s" % (filename, error))
+            return False
 
 
     def merge_output(self, with_variations = True):
@@ -283,23 +288,16 @@ class HejFogPythiaMerger():
         cmd = "mkdir results/merged"
         os.system(cmd)
         if with_variations:
-            cmd = "yodamerge results/lo-output/HEJFOG*.MuR2_MuF2_* -o results/merged/LO-MUR2-MUF2.yoda"
-            os.system(cmd)
-            # cmd = "yodamerge results/lo-output/HEJFOG*.MuR1_MuF2_* -o results/merged/LO-MUR1-MUF2.yoda"
-            # os.system(cmd)
-            # cmd = "yodamerge results/lo-output/HEJFOG*.MuR2_MuF1_* -o results/merged/LO-MUR2-MUF1.yoda"
-            # os.system(cmd)
-            # cmd = "yodamerge results/lo-output/HEJFOG*.MuR0.5_MuF1_* -o results/merged/LO-MUR0.5-MUF1.yoda"
-            # os.system(cmd)
-            # cmd = "yodamerge results/lo-output/HEJFOG*.MuR1_MuF0.5_* -o results/merged/LO-MUR1-MUF0.5.yoda"
-            # os.system(cmd)
-            cmd = "yodamerge results/lo-output/HEJFOG*.MuR0.5_MuF0.5_* -o results/merged/LO-MUR0.5-MUF0.5.yoda"
-            os.system(cmd)
+            self.merge_yoda("results/lo-output/HEJFOG*.MuR2_MuF2_*", "results/merged/LO-MUR2-MUF2.yoda")
+            # self.merge_yoda("results/lo-output/HEJFOG*.MuR1_MuF2_*", "results/merged/LO-MUR1-MUF2.yoda")
+            # self.merge_yoda("results/lo-output/HEJFOG*.MuR2_MuF1_*", "results/merged/LO-MUR2-MUF1.yoda")
+            # self.merge_yoda("results/lo-output/HEJFOG*.MuR0.5_MuF1_*", "results/merged/LO-MUR0.5-MUF1.yoda")
+            # self.merge_yoda("results/lo-output/HEJFOG*.MuR1_MuF0.5_*", "results/merged/LO-MUR1-MUF0.5.yoda")
+            self.merge_yoda("results/lo-output/HEJFOG*.MuR0.5_MuF0.5_*", "results/merged/LO-MUR0.5-MUF0.5.yoda")
         
         cmd = "rm results/lo-output/HEJFOG*Mu*"
         os.system(cmd)
-        cmd = "yodamerge results/lo-output/HEJFOG* -o results/merged/LO.yoda"
-        os.system(cmd)
+        self.merge_yoda("results/lo-output/HEJFOG*", "results/merged/LO.yoda")
         cmd = "rm -r results/lo-output"
         os.system(cmd)
         print("LO yoda files merged")
@@ -307,36 +305,39 @@ class HejFogPythiaMerger():
         # Merge HEJ results
         print("Merging HEJ yoda files")
         if with_variations:
-            cmd = "yodamerge results/hej-output/HEJ*MuR2_MuF2* -o results/merged/HEJ-MUR2-MUF2.yoda"
-            os.system(cmd)
-            # cmd = "yodamerge results/hej-output/HEJ*MuR1_MuF2* -o results/merged/HEJ-MUR1-MUF2.yoda"
-            # os.system(cmd)
-            # cmd = "yodamerge results/hej-output/HEJ*MuR2_MuF1* -o results/merged/HEJ-MUR2-MUF1.yoda"
-            # os.system(cmd)
-            # cmd = "yodamerge results/hej-output/HEJ*MuR0.5_MuF1* -o results/merged/HEJ-MUR0.5-MUF1.yoda"
-            # os.system(cmd)
-            # cmd = "yodamerge results/hej-output/HEJ*MuR1_MuF0.5* -o results/merged/HEJ-MUR1-MUF0.5.yoda"
-            # os.system(cmd)
-            cmd = "yodamerge results/hej-output/HEJ*MuR0.5_MuF0.5* -o results/merged/HEJ-MUR0.5-MUF0.5.yoda"
-            os.system(cmd)
+            self.merge_yoda("results/hej-output/HEJ*MuR2_MuF2*", "results/merged/HEJ-MUR2-MUF2.yoda")
+            # self.merge_yoda("results/hej-output/HEJ*MuR1_MuF2*", "results/merged/HEJ-MUR1-MUF2.yoda")
+            # self.merge_yoda("results/hej-output/HEJ*MuR2_MuF1*", "results/merged/HEJ-MUR2-MUF1.yoda")
+            # self.merge_yoda("results/hej-output/HEJ*MuR0.5_MuF1*", "results/merged/HEJ-MUR0.5-MUF1.yoda")
+            # self.merge_yoda("results/hej-output/HEJ*MuR1_MuF0.5*", "results/merged/HEJ-MUR1-MUF0.5.yoda")
+            self.merge_yoda("results/hej-output/HEJ*MuR0.5_MuF0.5*", "results/merged/HEJ-MUR0.5-MUF0.5.yoda")
         
         cmd = "rm results/hej-output/HEJ*Mu*"
         os.system(cmd)
-        cmd = "yodamerge results/hej-output/HEJ* -o results/merged/HEJ.yoda"
-        os.system(cmd)
+        self.merge_yoda("results/hej-output/HEJ*", "results/merged/HEJ.yoda")
         cmd = "rm -r results/hej-output"
         os.system(cmd)
         print("HEJ yoda files merged")
 
         # Merge HEJ+Pythia results
         print("Merging HEJ+Pythia yoda files")
-        cmd = "yodamerge results/hej-pythia-output/HEJ* -o results/merged/HEJmerging.yoda"
-        os.system(cmd)
+        self.merge_yoda("results/hej-pythia-output/HEJ*", "results/merged/HEJmerging.yoda")
         cmd = "rm -r results/hej-pythia-output"
         os.system(cmd)
         print("HEJ+Pythia yoda files merged")
 
 
+    def merge_yoda(self, pattern, output):
+        """
+        Merges the yoda files matching the glob 'pattern' into 'output' in-process,
+        equivalent to 'yodamerge pattern -o output'. Large sets of files are merged
+        in a reduction tree across 'self.processes' worker processes.
+        """
+        # Imported here since NumPy is only required for merging
+        from GridTools import yoda
+        yoda.merge_files(glob.glob(pattern), output, processes = self.processes)
+
+
     def clear_files(self):
         """
         Removes files created in scratch.
@@ -361,14 +362,19 @@ def parse():
     Parse command line arguments.
         user_name : str user handle on gridui and dpm storage
         job_number : int identifying submission
-        runs_per_job : int number of runs per submission < 4
+        runs_per_job : int number of runs per submission, 0 for as many as the node fits
         events : int number of events per run
         base_dir : base directory containing run configuration files
         rivet_dir : directory containing rivet analyses
         grid_output_dir : directory on grid storage for output, with protocol
+        queue : work queue directory for pilot mode, with protocol
+        wall_time : int wall-time budget of a pilot in seconds
+        stage_timeout : int wall-time limit of each generator stage in seconds
+        chunk_events : int number of events per chunk, to run the node's events as chunks
+        premerge : merge the results of the node's runs before uploading them
         name : job name
     """
-    parser = argparse.ArgumentParser(description = "Usage: python run_hejpythia.py -u user_name -j job_number -p runs_per_job -e events -b base_dir -r rivet_dir -o grid_output_dir")
+    parser = argparse.ArgumentParser(description = "Usage: python run_hejpythia.py -u user_name -j job_number -p runs_per_job -e events -b base_dir -r rivet_dir -o grid_output_dir [-q queue] [-l wall_time] [-x stage_timeout] [-z chunk_events] [--premerge]")
     parser.add_argument('--user_name', '-u', nargs = 1, type = str)
     parser.add_argument('--job_number', '-j', nargs = 1, type = int, default = 1)
     parser.add_argument('--processes', '-p', nargs = 1, type = int, default = 1)
@@ -376,6 +382,11 @@ def parse():
     parser.add_argument('--base_dir', '-b', nargs = 1, type = str, default = os.getcwd())
     parser.add_argument('--rivet_dir', '-r', nargs = 1, type = str, default = os.getcwd())
     parser.add_argument('--output', '-o', nargs = 1, type = str)
+    parser.add_argument('--queue', '-q', nargs = 1, type = str, default = None)
+    parser.add_argument('--wall_time', '-l', nargs = 1, type = int, default = [86400])
+    parser.add_argument('--stage_timeout', '-x', nargs = 1, type = int, default = [None])
+    parser.add_argument('--chunk_events', '-z', nargs = 1, type = int, default = [None])
+    parser.add_argument('--premerge', action = "store_true")
     return parser.parse_args()
 
 
@@ -386,29 +397,27 @@ def main():
     args = parse()
 
     t0 = time.time()
-    hejpythia = HejFogPythiaJob(args.user_name[0], args.job_number[0], args.base_dir[0], args.rivet_dir[0], args.output[0])
+    hejpythia = HejFogPythiaJob(args.user_name[0], args.job_number[0], args.base_dir[0], args.rivet_dir[0], args.output[0], stage_timeout = args.stage_timeout[0])
     hejpythia.set_env()
 
-    if args.processes[0] > 4:
-        raise(ValueError("Maximum number of processes is 4 per node."))
+    # Fit the number of runs to the node, taking as many as it fits for -p 0
+    processes = resources.get_concurrency(RUN_PROFILE, args.events[0], args.processes[0])
 
     t1 = time.time()
-    jobs = []
-    for number in range(args.processes[0]):
-        p = multiprocessing.Process(target = hejpythia.run_job, args = (number, args.events[0]))
-        jobs.append(p)
-
-    for job in jobs:
-        job.start()
-    
-    for job in jobs:
-        job.join()
-
+    if args.queue is not None:
+        # Pilot mode: keep claiming job numbers from the work queue
+        workqueue.run_pilot(hejpythia, processes, args.events[0], args.queue[0], t0 + args.wall_time[0], args.chunk_events[0], args.premerge)
+    else:
+        workqueue.run_unit(hejpythia, processes, args.events[0], args.chunk_events[0], args.premerge)
+
+    # Retry the uploads that failed during the runs
+    hejpythia.uploader.drain()
     t2 = time.time()
 
     print("Environment setting time %s(s)" % (t1 - t0))
     print("Execution time %s(s)" % (t2 - t1))
     print("Total time %s(s)" % (t2 - t0))
+    hejpythia.uploader.print_report()
 
 
 if __name__ == """__main__""":
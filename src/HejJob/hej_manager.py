@@ -1,124 +1,155 @@
 #!/usr/bin/env python
 import os
-from run_hej import HejJob, HejMerger
+from run_hej import HejJob, HejMerger, CARDS, TOOL_BUNDLES
+from GridTools import arcstatus, jobdb, staging, submission, workqueue, xrsl
 import argparse
 
 
-def make_job_file(user_name, job_number, events, processes, base_dir, rivet_dir, output_dir, name):
+def get_job_description(user_name, job_number, events, processes, base_dir, rivet_dir, output_dir, name, input_files = "", extra_arguments = "", whole_node = False):
     """
-    Creates xrsl submission file given:
+    Returns the xrsl submission file of a job given:
         job_number : int between n_min and n_max (inclusive)
         events : int number of events per run
-        processes : int number of runs per submission < 4
+        processes : int number of runs per submission (and cores requested)
         base_dir : base directory containing run configuration files
         rivet_dir : directory containing rivet analyses
         output_dir : directory on grid storage for output, with protocol
         name : job name
+        input_files : xRSL inputFiles relation for inputs staged by the CE
+        extra_arguments : further arguments of the job script, quoted for xRSL
+        whole_node : request exclusive use of the node, with as many runs as it fits
     """
-    print("Writing job%s.jdl" % (job_number))
-    cmd = """echo "&(executable = '%s')\n""" % (name)
-    cmd += """(arguments = '-u' '%s' '-j' '%s' '-p' '%s' '-e' '%s' '-b' '%s' '-r' '%s' '-o' '%s')\n""" % (user_name, job_number, processes, events, base_dir, rivet_dir, output_dir)
-    cmd += """(jobname = %s.%s)\n""" % (name, job_number)
-    cmd += """(stdout = 'stdout')\n(stderr = 'stderr')\n(gmlog = 'job%s.log')\n""" % (job_number)
-    cmd += """(count = '%s')\n(countpernode = '%s')" """ % (processes, processes)
-    cmd += """> job%s.jdl""" % (job_number)
-    os.system(cmd)
+    # The job script sizes the number of runs to a whole node itself
+    runs = 0 if whole_node else processes
+    arguments = """'-u' '%s' '-j' '%s' '-p' '%s' '-e' '%s' '-b' '%s' '-r' '%s' '-o' '%s'%s""" % (user_name, job_number, runs, events, base_dir, rivet_dir, output_dir, extra_arguments)
+    relations = input_files
+    if whole_node:
+        relations += """(exclusiveExecution = 'yes')\n"""
+    return xrsl.render(name, job_number, arguments, processes, relations)
 
 
-def run(args, write_only = False):
+def get_input_files(args):
+    """
+    Stages the run cards to grid storage and returns the xRSL inputFiles relation
+    declaring them and the tool tarballs, to be staged by the CE.
+    """
+    bundle_urls = [url % args["user_name"] for url, directory in TOOL_BUNDLES]
+    cards_url = staging.stage_cards(args["base_dir"], CARDS, "%s/inputs" % args["output_dir"])
+    return staging.get_input_files(bundle_urls, cards_url)
+
+
+def run(args, write_only = False, stage = False, pilots = 0, wall_time = 86400, stage_timeout = None, whole_node = False, chunk_events = None, premerge = False, submit_workers = 4, batch_size = 20):
     """
     Submits n_max - n_min + 1 multiprocessed xrsl job scripts to the grid
     unless write_only is set --- then only xrsl input files are written.
+    If stage is set the job inputs are staged by the CE rather than by each job.
+    If pilots is set the job numbers are put in a work queue in output_dir/queue
+    instead, and that many pilot jobs are submitted to work through it, each
+    within a budget of wall_time seconds, under the negative job numbers following
+    those of the pilots already in jobs.db.
+    If stage_timeout is set each generator stage is killed after that many seconds.
+    If whole_node is set each job takes a node to itself and runs as many runs as it
+    fits, with at least 'processes' cores requested.
+    If chunk_events is set each job runs its events in chunks of that many events,
+    which its runs take in turn until all are done.
+    If premerge is set each job merges the results of its runs before uploading them.
+    Jobs are submitted over submit_workers concurrent submissions of batch_size jobs
+    each to the least loaded of the CEs in args["ces"], and the jobs already in
+    jobs.db are skipped. Each job is recorded in jobs.db with the seeds it runs.
     """
-    for idx in range(args["n_min"], args["n_max"] + 1):
-        make_job_file(args["user_name"], idx, args["events"], args["processes"],
-                      args["base_dir"], args["rivet_dir"],
-                      args["output_dir"], args["job_name"])
-
+    input_files = ""
+    if stage:
+        input_files = get_input_files(args)
+
+    job_numbers = list(range(args["n_min"], args["n_max"] + 1))
+    extra_arguments = ""
+    if pilots:
+        queue_url = "%s/queue" % args["output_dir"]
         if not write_only:
-            if (idx%2) == 0:
-                cmd = "arcsub --direct -c ce1.dur.scotgrid.ac.uk -j ./multijobs.dat job%s.jdl &" % (idx)
-                os.system(cmd)
-
-            # Sleep after every other job submission.
-            else:
-                cmd = "arcsub --direct -c ce1.dur.scotgrid.ac.uk -j ./multijobs.dat job%s.jdl &" % (idx)
-                os.system(cmd)
-                cmd = "sleep 0.2"
-                os.system(cmd)
-
-    cmd = "sleep 0.5"
-    os.system(cmd)
+            workqueue.WorkQueue(queue_url).create(job_numbers)
+        # Pilots are recorded in jobs.db under job numbers of their own, so that more
+        # may be submitted later
+        job_numbers = jobdb.get_pilot_numbers(pilots)
+        extra_arguments = " '-q' '%s' '-l' '%s'" % (queue_url, wall_time)
+    if stage_timeout:
+        extra_arguments += " '-x' '%s'" % (stage_timeout)
+    if chunk_events:
+        extra_arguments += " '-z' '%s'" % (chunk_events)
+    if premerge:
+        extra_arguments += " '--premerge'"
+
+    descriptions = [(idx, get_job_description(args["user_name"], idx, args["events"], args["processes"],
+                                            args["base_dir"], args["rivet_dir"],
+                                            args["output_dir"], args["job_name"], input_files, extra_arguments, whole_node))
+                    for idx in job_numbers]
+    job_files = xrsl.write_all(descriptions)
 
     if not write_only:
-        cmd = "rm *jdl"
-        os.system(cmd)
+        # Pilots and whole nodes do not know their seeds until they run
+        runs = None
+        if not pilots and not whole_node:
+            runs = workqueue.get_chunk_count(args["processes"], args["events"], chunk_events) if chunk_events else args["processes"]
+        submission.Submitter(args["ces"], workers = submit_workers, batch_size = batch_size,
+                             runs = runs, output_dir = args["output_dir"]).run(job_files)
 
 
 def main(args):
     """
     Main method for manager functionality.
     """
-    parser = argparse.ArgumentParser(description = "Usage: python hej_manager.py [-w] [--write] -r [--run] -s [-status] -f [--finalise] -m [--merge] -c [--clean] -k [--kill]")
+    parser = argparse.ArgumentParser(description = "Usage: python hej_manager.py [-w] [--write] -r [--run] [-i] [--stage] [-q pilots] [-l wall_time] [-x stage_timeout] [-n] [--whole_node] [-z chunk_events] [--premerge] [--submit_workers workers] [--batch_size jobs] -s [-status] [--ttl seconds] [--json file] -f [--finalise] [-t streams] -m [--merge] [workers] -c [--clean] -k [--kill] [--ce ce]")
     parser.add_argument('--write', '-w', action = "store_true")
     parser.add_argument('--run', '-r', action = "store_true")
+    parser.add_argument('--stage', '-i', action = "store_true")
+    parser.add_argument('--pilots', '-q', type = int, default = 0)
+    parser.add_argument('--wall_time', '-l', type = int, default = 86400)
+    parser.add_argument('--stage_timeout', '-x', type = int, default = None)
+    parser.add_argument('--whole_node', '-n', action = "store_true")
+    parser.add_argument('--chunk_events', '-z', type = int, default = None)
+    parser.add_argument('--premerge', action = "store_true")
+    parser.add_argument('--submit_workers', type = int, default = 4)
+    parser.add_argument('--batch_size', type = int, default = 20)
     parser.add_argument('--status', '-s', action = "store_true")
+    parser.add_argument('--ttl', type = int, default = 300)
+    parser.add_argument('--json', type = str, default = None)
     parser.add_argument('--finalise', '-f', action = "store_true")
-    parser.add_argument('--merge', '-m', action = "store_true")
+    parser.add_argument('--streams', '-t', type = int, default = 8)
+    parser.add_argument('--merge', '-m', nargs = '?', type = int, const = 0, default = None)
     parser.add_argument('--clean', '-c', action = "store_true")
     parser.add_argument('--kill', '-k', action = "store_true")
+    parser.add_argument('--ce', action = "append", default = [])
     manager_args = parser.parse_args()
 
     if manager_args.run or manager_args.write:
-         run(args, manager_args.write)
+         run(args, manager_args.write, manager_args.stage, manager_args.pilots, manager_args.wall_time, stage_timeout = manager_args.stage_timeout, whole_node = manager_args.whole_node, chunk_events = manager_args.chunk_events, premerge = manager_args.premerge, submit_workers = manager_args.submit_workers, batch_size = manager_args.batch_size)
          return
 
     if manager_args.status:
          print("Writing job statuses to logfile.txt")
-         os.system("rm logfile.txt")
-         job_statuses = os.popen("arcstat -j multijobs.dat").read()
-
-         n_running = os.popen("arcstat -j multijobs.dat | grep -i 'Running' | wc -l").read()
-         n_finished = os.popen("arcstat -j multijobs.dat | grep -i 'Finished' | wc -l").read()
-         n_finishing = os.popen("arcstat -j multijobs.dat | grep -i 'Finishing' | wc -l").read()
-         n_failed = os.popen("arcstat -j multijobs.dat | grep -i 'Failed' | wc -l").read()
-         n_queuing = os.popen("arcstat -j multijobs.dat | grep -i 'Queuing' | wc -l").read()
-         n_missing = os.popen("arcstat -j multijobs.dat | grep -i 'Waiting' | wc -l").read()
-         n_tot = int(n_running) + int(n_finished) + int(n_finishing) + int(n_failed) + int(n_queuing) + int(n_missing)
-
-         with open("logfile.txt", "a") as logfile:
-             logfile.write("=" * 80 + "\n")
-             logfile.write("-" * 32 + " JOB INFORMATION " + "-" * 31 + "\n")
-             logfile.write("=" * 80 + "\n")
-             logfile.write(job_statuses)
-             logfile.write("\n" + "=" * 80 + "\n")
-             logfile.write("-" * 30 + " SUMMARY INFORMATION " + "-" * 29 + "\n")
-             logfile.write("=" * 80 + "\n")
-             logfile.write("Total jobs: %s\n" % str(n_tot))
-             logfile.write("Number of running jobs: %s\n" % str(n_running))
-             logfile.write("Number of finished jobs: %s\n" % str(n_finished))
-             logfile.write("Number of finishing jobs: %s\n" % str(n_finishing))
-             logfile.write("Number of failed jobs: %s\n" % str(n_failed))
-             logfile.write("Number of queuing jobs: %s\n" % str(n_queuing))
-             logfile.write("Number of missing jobs: %s\n" % str(n_missing)) 
-
+         snapshot = arcstatus.get_snapshot("multijobs.dat", manager_args.ttl)
+         arcstatus.write_report(snapshot, "logfile.txt")
+         if os.path.isfile(jobdb.DATABASE):
+             jobdb.JobDatabase(jobdb.DATABASE).update_states(snapshot["jobs"], snapshot["time"])
+         if manager_args.json:
+             print("Writing job statuses to %s" % manager_args.json)
+             arcstatus.write_json(snapshot, manager_args.json)
          return
 
     if manager_args.clean:
-        os.system("arcclean -j multijobs.dat")
+        jobdb.kill_or_clean("arcclean", manager_args.ce)
         return
 
     if manager_args.kill:
-        os.system("arckill -j multijobs.dat")
+        jobdb.kill_or_clean("arckill", manager_args.ce)
         return
 
-    merger = HejMerger(args["user_name"], args["output_dir"])
+    merger = HejMerger(args["user_name"], args["output_dir"], processes = manager_args.merge or 0, streams = manager_args.streams)
     if manager_args.finalise:
         merger.copy_files()
-        os.system("arcclean -j multijobs.dat")
+        jobdb.kill_or_clean("arcclean")
         return
 
-    if manager_args.merge:
+    if manager_args.merge is not None:
         merger.merge_output()
         return
     
@@ -134,6 +165,7 @@ if __name__ == """__main__""":
         base_dir   : base directory containing run configuration files
         rivet_dir  : directory containing rivet analyses
         output_dir : directory on grid storage for output, with protocol
+        ces        : list of (computing element, weight) pairs to share the jobs between
         name : job name
     """
 
@@ -147,6 +179,7 @@ if __name__ == """__main__""":
            "base_dir"   : "/mt/home/hhassan/Projects/HEJ_PYTHIA/pythia_merging/Setup/7TeV/7TeV-20GeV-R06/2j_HT2_7TeV/",
            "rivet_dir"  : "/mt/home/hhassan/Projects/HEJ_PYTHIA/pythia_merging/rivet",
            "output_dir" : "gsiftp://se01.dur.scotgrid.ac.uk/dpm/dur.scotgrid.ac.uk/home/pheno/hhassan/pythia_merging/azimuthal-20GeV-2jet-single-run",
+           "ces"        : [("ce1.dur.scotgrid.ac.uk", 1)],
     }
 
     main(args)
@@ -1,12 +1,13 @@
 #!/usr/bin/env python
 import os
 from run_job import Job, JobMerger
+from GridTools import arcstatus, jobdb, submission, xrsl
 import argparse
 
 
-def make_job_file(user_name, job_number, events, processes, base_dir, output_dir, name):
+def get_job_description(user_name, job_number, events, processes, base_dir, output_dir, name):
     """
-    Creates xrsl submission file given:
+    Returns the xrsl submission file of a job given:
         user_name : str identifying user on gridui and dpm storage
         job_number : int between n_min and n_max (inclusive)
         events : int number of events per run
@@ -15,105 +16,77 @@ def make_job_file(user_name, job_number, events, processes, base_dir, output_dir
         output_dir : directory on grid storage for output, with protocol
         name : job name
     """
-    print("Writing job%s.jdl" % (job_number))
-    cmd = """echo "&(executable = '%s')\n""" % (name)
-    cmd += """(arguments = '-u' '%s' '-j' '%s' '-p' '%s' '-e' '%s' '-b' '%s' '-o' '%s')\n""" % (user_name, job_number, processes, events, base_dir, output_dir)
-    cmd += """(jobname = %s.%s)\n""" % (name, job_number)
-    cmd += """(stdout = 'stdout')\n(stderr = 'stderr')\n(gmlog = 'job%s.log')\n""" % (job_number)
-    cmd += """(count = '%s')\n(countpernode = '%s')" """ % (processes, processes)
-    cmd += """> job%s.jdl""" % (job_number)
-    os.system(cmd)
+    arguments = """'-u' '%s' '-j' '%s' '-p' '%s' '-e' '%s' '-b' '%s' '-o' '%s'""" % (user_name, job_number, processes, events, base_dir, output_dir)
+    return xrsl.render(name, job_number, arguments, processes)
 
 
-def run(args):
+def run(args, write_only = False, submit_workers = 4, batch_size = 20):
     """
-    Submits n_max - n_min + 1 multithreaded xrsl job scripts to the grid.
+    Submits n_max - n_min + 1 multithreaded xrsl job scripts to the grid
+    unless write_only is set --- then only xrsl input files are written.
+    Jobs are submitted over submit_workers concurrent submissions of batch_size jobs
+    each to the least loaded of the CEs in args["ces"], and the jobs already in
+    jobs.db are skipped. Submitted jobs are recorded in jobs.db with their seeds.
     """
-    for idx in range(args["n_min"], args["n_max"] + 1):
-        make_job_file(args["user_name"], idx, args["events"], args["processes"],
-                      args["base_dir"], args["rivet_dir"],
-                      args["output_dir"], args["job_name"])
+    descriptions = [(idx, get_job_description(args["user_name"], idx, args["events"], args["processes"],
+                                            args["base_dir"], args["output_dir"], args["job_name"]))
+                    for idx in range(args["n_min"], args["n_max"] + 1)]
+    job_files = xrsl.write_all(descriptions)
 
-        if (idx%2) == 0:
-            cmd = "arcsub --direct -c ce1.dur.scotgrid.ac.uk -j ./multijobs.dat job%s.jdl &" % (idx)
-            os.system(cmd)
-
-        # Sleep after every other job submission.
-        else:
-            cmd = "arcsub --direct -c ce1.dur.scotgrid.ac.uk -j ./multijobs.dat job%s.jdl &" % (idx)
-            os.system(cmd)
-            cmd = "sleep 0.2"
-            os.system(cmd)
-
-    cmd = "sleep 0.5"
-    os.system(cmd)
-    cmd = "rm *jdl"
-    os.system(cmd)
+    if not write_only:
+        submission.Submitter(args["ces"], workers = submit_workers, batch_size = batch_size,
+                             runs = args["processes"], output_dir = args["output_dir"]).run(job_files)
 
 
 def main(args):
     """
     Main method for manager functionality.
     """
-    parser = argparse.ArgumentParser(description = "Usage: python job_manager.py [-w] [--write] -r [--run] -s [-status] -f [--finalise] -m [--merge] -c [--clean] -k [--kill]")
+    parser = argparse.ArgumentParser(description = "Usage: python job_manager.py [-w] [--write] -r [--run] [--submit_workers workers] [--batch_size jobs] -s [-status] [--ttl seconds] [--json file] -f [--finalise] [-t streams] -m [--merge] [workers] -c [--clean] -k [--kill] [--ce ce]")
     parser.add_argument('--write', '-w', action = "store_true")
     parser.add_argument('--run', '-r', action = "store_true")
+    parser.add_argument('--submit_workers', type = int, default = 4)
+    parser.add_argument('--batch_size', type = int, default = 20)
     parser.add_argument('--status', '-s', action = "store_true")
+    parser.add_argument('--ttl', type = int, default = 300)
+    parser.add_argument('--json', type = str, default = None)
     parser.add_argument('--finalise', '-f', action = "store_true")
-    parser.add_argument('--merge', '-m', action = "store_true")
+    parser.add_argument('--streams', '-t', type = int, default = 8)
+    parser.add_argument('--merge', '-m', nargs = '?', type = int, const = 0, default = None)
     parser.add_argument('--clean', '-c', action = "store_true")
     parser.add_argument('--kill', '-k', action = "store_true")
+    parser.add_argument('--ce', action = "append", default = [])
     manager_args = parser.parse_args()
 
     if manager_args.run or manager_args.write:
-         run(args, manager_args.write)
+         run(args, manager_args.write, submit_workers = manager_args.submit_workers, batch_size = manager_args.batch_size)
          return
 
     if manager_args.status:
          print("Writing job statuses to logfile.txt")
-         os.system("rm logfile.txt")
-         job_statuses = os.popen("arcstat -j multijobs.dat").read()
-
-         n_running = os.popen("arcstat -j multijobs.dat | grep -i 'Running' | wc -l").read()
-         n_finished = os.popen("arcstat -j multijobs.dat | grep -i 'Finished' | wc -l").read()
-         n_finishing = os.popen("arcstat -j multijobs.dat | grep -i 'Finishing' | wc -l").read()
-         n_failed = os.popen("arcstat -j multijobs.dat | grep -i 'Failed' | wc -l").read()
-         n_queuing = os.popen("arcstat -j multijobs.dat | grep -i 'Queuing' | wc -l").read()
-         n_missing = os.popen("arcstat -j multijobs.dat | grep -i 'Waiting' | wc -l").read()
-         n_tot = n_running + n_finished + n_finishing + n_failed + n_queuing + n_missing
-
-         with open("logfile.txt", "a") as logfile:
-             logfile.write("=" * 80 + "\n")
-             logfile.write("-" * 32 + " JOB INFORMATION " + "-" * 31 + "\n")
-             logfile.write("=" * 80 + "\n")
-             logfile.write(job_statuses)
-             logfile.write("\n" + "=" * 80 + "\n")
-             logfile.write("-" * 30 + " SUMMARY INFORMATION " + "-" * 29 + "\n")
-             logfile.write("=" * 80 + "\n")
-             logfile.write("Total jobs: %s\n" % str(n_tot))
-             logfile.write("Number of running jobs: %s\n" % str(n_running))
-             logfile.write("Number of finished jobs: %s\n" % str(n_finished))
-             logfile.write("Number of finishing jobs: %s\n" % str(n_finishing))
-             logfile.write("Number of failed jobs: %s\n" % str(n_failed))
-             logfile.write("Number of queuing jobs: %s\n" % str(n_queuing))
-             logfile.write("Number of missing jobs: %s\n" % str(n_missing)) 
-
+         snapshot = arcstatus.get_snapshot("multijobs.dat", manager_args.ttl)
+         arcstatus.write_report(snapshot, "logfile.txt")
+         if os.path.isfile(jobdb.DATABASE):
+             jobdb.JobDatabase(jobdb.DATABASE).update_states(snapshot["jobs"], snapshot["time"])
+         if manager_args.json:
+             print("Writing job statuses to %s" % manager_args.json)
+             arcstatus.write_json(snapshot, manager_args.json)
          return
 
     if manager_args.clean:
-        os.system("arcclean -j multijobs.dat")
+        jobdb.kill_or_clean("arcclean", manager_args.ce)
         return
 
     if manager_args.kill:
-        os.system("arckill -j multijobs.dat")
+        jobdb.kill_or_clean("arckill", manager_args.ce)
         return
 
-    merger = JobMerger(args["user_name"], args["output_dir"])
+    merger = JobMerger(args["user_name"], args["output_dir"], processes = manager_args.merge or 0, streams = manager_args.streams)
     if manager_args.finalise:
         merger.copy_files()
-        os.system("arcclean -j multijobs.dat")
+        jobdb.kill_or_clean("arcclean")
 
-    if manager_args.merge:
+    if manager_args.merge is not None:
         merger.merge_output()
     
 
@@ -128,6 +101,7 @@ if __name__ == """__main__""":
         base_dir   : base directory containing run configuration files
         rivet_dir  : directory containing rivet analyses
         output_dir : directory on grid storage for output, with protocol
+        ces        : list of (computing element, weight) pairs to share the jobs between
         name : job name
     """
 
@@ -141,6 +115,7 @@ if __name__ == """__main__""":
            "base_dir"   : "",
            "rivet_dir"  : "",
            "output_dir" : "gsiftp://se01.dur.scotgrid.ac.uk/dpm/dur.scotgrid.ac.uk/home/pheno/user",
+           "ces"        : [("ce1.dur.scotgrid.ac.uk", 1)],
     }
 
     main(args)
@@ -4,25 +4,39 @@ Runs a multitprocessed temporary job on a single grid node.
 """
 import argparse
 import os
+import sys
 import time
 import multiprocessing
 
+# Shared tools live next to the job directories in src/
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from GridTools import manifest, resources, sandbox, stages, tarballs, upload, workqueue
+
+
+# Peak memory (MB) and disk (MB, plus kB per event) of one run, used to size the
+# number of concurrent runs to the node
+RUN_PROFILE = resources.Profile(1000, 100, 0)
+
 
 class Job(): 
 
 
-    def __init__(self, user_name, job_number, base_dir, output_dir):
+    def __init__(self, user_name, job_number, base_dir, output_dir, stage_timeout=None):
         """
         Initialises a Job run given:
             user_name : str user name for gridui and dpm grid storage
             job_number : index of the submission
             base_dir : base directory for input files
             output_dir : output directory on grid storage server, with protocol
+            stage_timeout : optional wall-time limit in seconds of each generator stage
         """
         self.user_name = str(user_name)
         self.job_number = int(job_number)
-        self.base_dir = str(base_dir)
+        # Absolute, since each run works in its own sandbox directory
+        self.base_dir = os.path.abspath(str(base_dir))
         self.output_dir = str(output_dir)
+        self.stage_timeout = stage_timeout
+        self.uploader = upload.Uploader.from_environment(self.user_name)
 
 
     def __del__(self):
@@ -63,12 +77,9 @@ class Job():
         os.system(cmd)
 
         # Run Job
-        print("Starting Job run at:")
-        os.system("date")
         cmd = "executable --input input_files%s --events %s --output output_files%s" % (str(seed), str(events), str(seed))
-        os.system(cmd)
-        print("Job finished running at:")
-        os.system("date")
+        if not stages.run_stage("Job", cmd, ["output_files%s*" % (str(seed))], self.stage_timeout):
+            return
 
         self.print_info()
         self.save_results(seed)
@@ -79,19 +90,19 @@ class Job():
         Copies the output files and input to the grid storage.
         """
         # Compress the output into one tarball
-        cmd = "tar -czvf output%s.tar.gz output_file%s* input_files%s*" % (str(seed), str(seed), str(seed))
+        cmd = "tar -czhvf output%s.tar.gz output_file%s* input_files%s*" % (str(seed), str(seed), str(seed))
         os.system(cmd)
 
-        # Copy the tarball of results to the grid storage
-        cmd = "gfal-copy output%s.tar.gz %s -f" % (str(seed), str(self.output_dir))
-        os.system(cmd)
+        # Upload the tarball of results to the grid storage, spooling it if that fails
+        tarball = "output%s.tar.gz" % (str(seed))
+        self.uploader.save(tarball, "%s/%s" % (str(self.output_dir), tarball))
 
 
     def clean_job(self):
         """
-        Removes the remaining files.
+        Removes the sandboxes of the runs.
         """
-        os.system("rm *gz input_files* output_files* -f")
+        sandbox.clean()
 
 
     def print_info(self):
@@ -110,17 +121,26 @@ class Job():
 class JobMerger():
 
 
-    def __init__(self, user_name, grid_output_dir, prune=False, prune_script="yodastats"):
+    def __init__(self, user_name, grid_output_dir, prune=False, prune_script="yodastats", processes=1, streams=8):
         """
         Initialises merger for output files given:
             user_name       : user name for gridui and dpm grid storage
             grid_output_dir : location of output files on grid storage
             prune           : optional bool to prune the output data
             prune_script    : name of C/C++ script to prune yoda files
+            processes       : optional int number of worker processes for merging,
+                              0 uses all available cores
+            streams         : optional int number of concurrent transfers when copying
         """
         self.user_name = str(user_name)
         self.grid_output_dir = str(grid_output_dir)
+        self.processes = int(processes)
+        self.streams = int(streams)
         self.prune = bool(prune)
+        # Glob patterns of output files and the directory each category is sorted into
+        self.categories = [
+            ("output_files*", "results"),
+        ]
         if self.prune:
             self.prune_script = prune_script
 
@@ -132,33 +152,36 @@ class JobMerger():
 
     def copy_files(self):
         """
-        Copies grid output files to scratch dir.
+        Copies grid output files not retrieved by a previous finalise to scratch dir
+        and organises them.
         """
-        print("Copying output to scratch")
-        cmd = "gfal-copy -f -r %s %s" % (self.grid_output_dir, self.scratch_dir)
-        os.system(cmd)
+        print("Copying new output to scratch")
+        retrieved = manifest.Manifest(os.path.join(self.scratch_dir, "manifest.json"))
+        manifest.retrieve_new(self.grid_output_dir, self.scratch_dir, retrieved, self.streams)
         os.system("mkdir results")
 
         print("Organising output into categories of runs")
-        files = os.listdir(self.scratch_dir)
-        with multiprocessing.Pool() as pool:
-            # Use multiprocessing to organise output in parallel
-            pool.map(self.organise_single, files)
-
-        os.system("rm tmp_logfile")
+        files = retrieved.get_unorganised()
+        try:
+            with multiprocessing.Pool() as pool:
+                # Use multiprocessing to organise output in parallel
+                organised = pool.map(self.organise_single, files)
+            retrieved.set_organised([name for name, success in zip(files, organised) if success])
+            retrieved.set_failed([name for name, success in zip(files, organised) if not success])
+        finally:
+            retrieved.save()
 
 
     def organise_single(self, filename):
         """
-        Organise the tarball of results named 'filename'.
+        Organise the tarball of results named 'filename', streaming each output file
+        straight into its category directory. Returns True if it was organised.
         """
-        # TODO: Clean output for log file (e.g. mark with process ID)
-        cmd = "tar -xzf %s/%s >> tmp_logfile 2>&1" % (self.scratch_dir, filename)
-        os.system(cmd)
-        cmd = "mv output_files* results >> tmp_logfile 2>&1"
-        os.system(cmd
-        cmd = "rm output_files* >> tmp_logfile 2>&1"
-        os.system(cmd)
+        try:
+            return tarballs.extract_by_category(os.path.join(self.scratch_dir, filename), self.categories)
+        except Exception as error:
+            print("Failed to organise %s: %s" % (filename, error))
+            return False
 
 
     def merge_output(self):
@@ -201,13 +224,18 @@ def parse():
     """
     Parse command line arguments.
     """
-    parser = argparse.ArgumentParser(description = "Usage: python run_multi.py -u user_name -j job_number -p runs_per_job -e events -b base_dir -o grid_output_dir")
+    parser = argparse.ArgumentParser(description = "Usage: python run_multi.py -u user_name -j job_number -p runs_per_job -e events -b base_dir -o grid_output_dir [-q queue] [-l wall_time] [-x stage_timeout] [-z chunk_events] [--premerge]")
     parser.add_argument('--user_name', '-u', nargs = 1, type = str)
     parser.add_argument('--job_number', '-j', nargs = 1, type = int, default = 1)
     parser.add_argument('--processes', '-p', nargs = 1, type = int, default = 1)
     parser.add_argument('--events', '-e', nargs = 1, type = int, default = 100)
     parser.add_argument('--base_dir', '-b', nargs = 1, type = str, default = os.getcwd())
     parser.add_argument('--output', '-o', nargs = 1, type = str)
+    parser.add_argument('--queue', '-q', nargs = 1, type = str, default = None)
+    parser.add_argument('--wall_time', '-l', nargs = 1, type = int, default = [86400])
+    parser.add_argument('--stage_timeout', '-x', nargs = 1, type = int, default = [None])
+    parser.add_argument('--chunk_events', '-z', nargs = 1, type = int, default = [None])
+    parser.add_argument('--premerge', action = "store_true")
     return parser.parse_args()
 
 
@@ -221,26 +249,24 @@ def main():
     grid_job = Job(args.user_name[0], args.job_number[0], args.base_dir[0], args.rivet_dir[0], args.output[0])
     grid_job.set_env()
 
-    if args.processes[0] > 4:
-        raise(ValueError("Maximum number of processes is 4 per node."))
+    # Fit the number of runs to the node, taking as many as it fits for -p 0
+    processes = resources.get_concurrency(RUN_PROFILE, args.events[0], args.processes[0])
 
     t1 = time.time()
-    jobs = []
-    for number in range(args.processes[0]):
-        p = multiprocessing.Process(target = grid_job.run_job, args = (number, args.events[0]))
-        jobs.append(p)
-
-    for job in jobs:
-        job.start()
-    
-    for job in jobs:
-        job.join()
-
+    if args.queue is not None:
+        # Pilot mode: keep claiming job numbers from the work queue
+        workqueue.run_pilot(grid_job, processes, args.events[0], args.queue[0], t0 + args.wall_time[0], args.chunk_events[0], args.premerge)
+    else:
+        workqueue.run_unit(grid_job, processes, args.events[0], args.chunk_events[0], args.premerge)
+
+    # Retry the uploads that failed during the runs
+    grid_job.uploader.drain()
     t2 = time.time()
 
     print("Environment setting time %s(s)" % (t1 - t0))
     print("Execution time %s(s)" % (t2 - t1))
     print("Total time %s(s)" % (t2 - t0))
+    grid_job.uploader.print_report()
 
 
 if __name__ == """__main__""":
@@ -3,15 +3,39 @@
 Runs a multiprocessed naiive_ckkwl job on a single grid node.
 """
 import argparse
+import glob
 import os
+import sys
 import time
 import multiprocessing
 
+# Shared tools live next to the job directories in src/
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from GridTools import cards, manifest, resources, sandbox, stages, staging, tarballs, toolcache, upload, workqueue
+
+
+# Tool tarballs on grid storage (formatted with the user name) and the directories
+# they are unpacked into
+TOOL_BUNDLES = [
+    ("gsiftp://se01.dur.scotgrid.ac.uk/dpm/dur.scotgrid.ac.uk/home/pheno/%s/Sherpa/Sherpa.tar.gz", "Sherpa"),
+    ("gsiftp://se01.dur.scotgrid.ac.uk/dpm/dur.scotgrid.ac.uk/home/pheno/%s/lib/libSherpaLHEfix.tar.gz", "."),
+    ("gsiftp://se01.dur.scotgrid.ac.uk/dpm/dur.scotgrid.ac.uk/home/pheno/%s/HEJ/HEJ.tar.gz", "."),
+    ("gsiftp://se01.dur.scotgrid.ac.uk/dpm/dur.scotgrid.ac.uk/home/pheno/%s/Pythia/Pythia.tar.gz", "."),
+    ("gsiftp://se01.dur.scotgrid.ac.uk/dpm/dur.scotgrid.ac.uk/home/pheno/%s/HEJ_pythia/HEJ_pythia.tar.gz", "."),
+]
+
+# Run cards linked from the base directory into the sandbox of each run
+CARDS = ["Results.db", "Process", "Run.dat", "config.yml", "ckkwl.cmnd"]
+
+# Peak memory (MB) and disk (MB, plus kB per event) of one run, used to size the
+# number of concurrent runs to the node
+RUN_PROFILE = resources.Profile(4000, 2000, 20)
+
 
 class NaiiveCKKWLJob(): 
 
 
-    def __init__(self, user_name, job_number, base_dir, rivet_dir, output_dir):
+    def __init__(self, user_name, job_number, base_dir, rivet_dir, output_dir, stage_timeout=None):
         """
         Initialises a naive_ckkwl run given:
             user_name : str user name for gridui and dpm grid storage
@@ -19,12 +43,15 @@ class NaiiveCKKWLJob():
             base_dir : base directory for input files
             rivet_dir : path for compiled rivet analysis libraries, and PDFs
             output_dir : output directory on grid storage server, with protocol
+            stage_timeout : optional wall-time limit in seconds of each generator stage
         """
         self.user_name = str(user_name)
         self.job_number = int(job_number)
         self.base_dir = str(base_dir)
         self.rivet_dir = str(rivet_dir)
         self.output_dir = str(output_dir)
+        self.stage_timeout = stage_timeout
+        self.uploader = upload.Uploader.from_environment(self.user_name)
 
 
     def __del__(self):
@@ -46,28 +73,25 @@ class NaiiveCKKWLJob():
         os.system(cmd)
         os.system("source /cvmfs/pheno.egi.eu/HEJ/HEJ_env.sh")
         os.environ["MYPROXY_SERVER"] = "myproxy.gridpp.rl.ac.uk"
+        cache = toolcache.ToolCache.from_environment(self.user_name)
 
-        print("Copying Sherpa.tar.gz from grid storage")
-        os.system("mkdir ./Sherpa")
-        cmd = "gfal-copy gsiftp://se01.dur.scotgrid.ac.uk/dpm/dur.scotgrid.ac.uk/home/pheno/%s/Sherpa/Sherpa.tar.gz . -f" % self.user_name
-        os.system(cmd)
-        os.environ["RIVET_ANALYSIS_PATH"] = str(self.rivet_dir)
-        os.environ["LHAPDF_DATA_PATH"] = str(self.rivet_dir)
+        print("Downloading and unpacking tool tarballs from grid storage")
+        failed = toolcache.unpack_all(cache, [(url % self.user_name, directory) for url, directory in TOOL_BUNDLES])
+        if failed:
+            # The runs cannot work without their tools, so fail the job rather than its runs
+            raise IOError("Failed to unpack the tools %s" % ", ".join(failed))
+        self.base_dir = staging.get_base_dir(self.base_dir)
+        # Cards rendered for each seed are read once per node
+        self.templates = cards.load_templates(self.base_dir, ["config.yml", "ckkwl.cmnd"])
 
-        print("untarring Sherpa.tar.gz")
-        os.system("tar -xzf Sherpa.tar.gz")
-        os.system("mv bin lib include share Sherpa")
+        os.environ["RIVET_ANALYSIS_PATH"] = os.path.abspath(str(self.rivet_dir))
+        os.environ["LHAPDF_DATA_PATH"] = os.path.abspath(str(self.rivet_dir))
 
         print("Setting Sherpa path variables")
         os.environ["SHERPA_INCLUDE_PATH"] = "%s/Sherpa/include/SHERPA-MC" % str(os.getcwd())
         os.environ["SHERPA_SHARE_PATH"] = "%s/Sherpa/share/SHERPA-MC" % str(os.getcwd())
         os.environ["SHERPA_LIBRARY_PATH"] = "%s/Sherpa/lib/SHERPA-MC" % str(os.getcwd())
         
-        print("Copying libSherpaLHEfix.tar.gz from grid storage")
-        cmd = "gfal-copy gsiftp://se01.dur.scotgrid.ac.uk/dpm/dur.scotgrid.ac.uk/home/pheno/%s/lib/libSherpaLHEfix.tar.gz ./ -f" % self.user_name
-        os.system(cmd)
-        print("untarring libSherpaLHEfix.tar.gz")
-        os.system("tar -xzf libSherpaLHEfix.tar.gz")
         os.environ["SHERPA_LHEFIX_PATH"] = "%s/lib" % str(os.getcwd())
         
         print("Setting environment for Sherpa run")
@@ -75,32 +99,11 @@ class NaiiveCKKWLJob():
         os.environ["LD_LIBRARY_PATH"] = "%s:%s" % (str(os.environ.get("SHERPA_LIBRARY_PATH",'')), str(os.environ.get("LD_LIBRARY_PATH",'')))
         os.environ["LD_LIBRARY_PATH"] = "%s:%s" % (str(os.environ.get("SHERPA_LHEFIX_PATH",'')), str(os.environ.get("LD_LIBRARY_PATH",'')))
 
-        print("Downloading HEJ.tar.gz from grid storage")
-        cmd = "gfal-copy gsiftp://se01.dur.scotgrid.ac.uk/dpm/dur.scotgrid.ac.uk/home/pheno/%s/HEJ/HEJ.tar.gz ./ -f" % self.user_name
-        os.system(cmd)
-        print("untarring HEJ.tar.gz")
-        os.system("tar -xzf HEJ.tar.gz")
-        os.system("rm HEJ.tar.gz")
- 
         print("Setting environment for HEJ run")
         self.set_hej_env()
         os.environ["LD_LIBRARY_PATH"] = "%s/HEJ/lib:%s" % (str(os.getcwd()), str(os.environ.get("LD_LIBRARY_PATH",'')))
         os.environ["PATH"] = "%s/HEJ/bin:%s" % (str(os.getcwd()), str(os.environ.get("PATH",'')))
 
-        print("Downloading Pythia.tar.gz from grid storage")
-        cmd = "gfal-copy gsiftp://se01.dur.scotgrid.ac.uk/dpm/dur.scotgrid.ac.uk/home/pheno/%s/Pythia/Pythia.tar.gz ./ -f" % self.user_name
-        os.system(cmd)
-        print("untarring Pythia.tar.gz")
-        os.system("tar -xzf Pythia.tar.gz")
-        os.system("rm -f Pythia.tar.gz")
-        
-        print("Downloading HEJ_pythia.tar.gz from grid storage")
-        cmd = "gfal-copy gsiftp://se01.dur.scotgrid.ac.uk/dpm/dur.scotgrid.ac.uk/home/pheno/%s/HEJ_pythia/HEJ_pythia.tar.gz ./ -f" % self.user_name
-        os.system(cmd)
-        print("untarring HEJ_pythia.tar.gz")
-        os.system("tar -xzf HEJ_pythia.tar.gz")
-        os.system("rm HEJ_pythia.tar.gz")
-
         print("Setting environment for naiive_ckkwl")
         os.environ["PATH"] = "%s/HEJ_pythia/bin:%s" % (str(os.getcwd()), str(os.environ.get("PATH",'')))
         os.environ["LD_LIBRARY_PATH"] = "%s/Pythia/lib:%s" % (str(os.getcwd()), str(os.environ.get("LD_LIBRARY_PATH",'')))
@@ -140,50 +143,35 @@ class NaiiveCKKWLJob():
         """
         # TODO: Don't hardcode names of runfiles (even though they are standard)
         seed = self.get_unique_seed(run_number)
-        cmd = "cp -r %s/Results.db %s/Process %s/Run.dat %s/config.yml %s/ckkwl.cmnd ." % (str(self.base_dir), str(self.base_dir), str(self.base_dir), str(self.base_dir), str(self.base_dir))
-        os.system(cmd)
+        sandbox.link_inputs(os.path.join(self.base_dir, card) for card in CARDS)
 
         # Run Sherpa
-        print("Starting Sherpa run at:")
-        os.system("date")
         cmd = "Sherpa -f Run.dat -R %s -e %s ANALYSIS_OUTPUT=LO-%s EVENT_OUTPUT=LHEfix[SherpaLHE_%s] USE_GZIP=1" % (str(seed), str(events), str(seed), str(seed))
-        os.system(cmd)
-        print("Sherpa finished running at:")
-        os.system("date")
+        if not stages.run_stage("Sherpa", cmd, ["SherpaLHE_%s.lhe*" % (str(seed))], self.stage_timeout):
+            return
 
         # Modify HEJ input parameter seeds
-        cmd = "cp config.yml config_%s.yml" % (str(seed))
-        os.system(cmd)
-        cmd = "sed -i 's/seed:.*/seed: %s/g' config_%s.yml" % (str(seed), str(seed))
-        os.system(cmd)
-        cmd = "sed -i 's/output:.*HEJ.*/output: HEJ_%s/g' config_%s.yml" % (str(seed), str(seed))
-        os.system(cmd)
-        cmd = "sed -i 's/.*lhe/  - HEJ_%s.lhe/g' config_%s.yml" % (str(seed), str(seed))
-        os.system(cmd)
+        self.templates["config.yml"].render("config_%s.yml" % (str(seed)), [
+            ("seed:.*", "seed: %s" % (str(seed))),
+            ("output:.*HEJ.*", "output: HEJ_%s" % (str(seed))),
+            (".*lhe", "  - HEJ_%s.lhe" % (str(seed))),
+        ])
 
         # Run HEJ
-        print("Starting HEJ run at:")
-        os.system("date")
         cmd = "HEJ config_%s.yml SherpaLHE_%s.lhe.gz" % (str(seed), str(seed))
-        os.system(cmd)
-        print("HEJ finished running at:")
-        os.system("date")
+        if not stages.run_stage("HEJ", cmd, ["HEJ_%s.*" % (str(seed))], self.stage_timeout):
+            return
 
         # Modify naiive_ckkwl parameter seeds
-        cmd = "cp ckkwl.cmnd ckkwl_%s.cmnd" % (str(seed))
-        os.system(cmd)
-        cmd = "sed -i 's/Random:seed.*=.*/Random:seed = %s/g' ckkwl_%s.cmnd" % (str(seed), str(seed))
-        os.system(cmd)
-        cmd = "sed -i 's/rivet:output.*=.*/rivet:output = ckkwl_%s.yoda/g' ckkwl_%s.cmnd" % (str(seed), str(seed))
-        os.system(cmd)
+        self.templates["ckkwl.cmnd"].render("ckkwl_%s.cmnd" % (str(seed)), [
+            ("Random:seed.*=.*", "Random:seed = %s" % (str(seed))),
+            ("rivet:output.*=.*", "rivet:output = ckkwl_%s.yoda" % (str(seed))),
+        ])
 
         # Run naiive_ckkwl
-        print("Starting naiive_ckkwl run at:")
-        os.system("date")
         cmd = "naiive_ckkwl ckkwl_%s.cmnd HEJ_%s.lhe" % (str(seed), str(seed))
-        os.system(cmd)
-        print("naiive_ckkwl finished running at:")
-        os.system("date")
+        if not stages.run_stage("naiive_ckkwl", cmd, ["ckkwl_%s.yoda*" % (str(seed))], self.stage_timeout):
+            return
 
         self.print_info()
         self.save_results(seed)
@@ -194,19 +182,20 @@ class NaiiveCKKWLJob():
         Copies the analysis output files and input cards to the grid storage.
         """
         # Compress the output into one tarball
-        cmd = "tar -czvf ckkwl_output%s.tar.gz *%s*.yoda *%s.cmnd *%s.yml *dat" % (str(seed), str(seed), str(seed), str(seed))
+        cmd = "tar -czhvf ckkwl_output%s.tar.gz *%s*.yoda *%s.cmnd *%s.yml *dat" % (str(seed), str(seed), str(seed), str(seed))
         os.system(cmd)
 
-        # Copy the tarball of results to the grid storage
-        cmd = "gfal-copy ckkwl_output%s.tar.gz %s -f" % (str(seed), str(self.output_dir))
-        os.system(cmd)
+        # Upload the tarball of results to the grid storage, spooling it if that fails
+        tarball = "ckkwl_output%s.tar.gz" % (str(seed))
+        self.uploader.save(tarball, "%s/%s" % (str(self.output_dir), tarball))
 
 
     def clean_job(self):
         """
-        Removes the remaining files.
+        Removes the sandboxes of the runs, the staged run cards and the tools.
         """
-        os.system("rm *gz *yml *dat *yoda *cmnd *tex *lhe* Results* -r Process Sherpa HEJ HEJ_pythia naiive_ckkwl lib bin include share Pythia Status* -f")
+        sandbox.clean()
+        os.system("rm -r %s Sherpa HEJ HEJ_pythia naiive_ckkwl lib bin include share Pythia -f" % staging.CARDS_DIR)
 
 
     def print_info(self):
@@ -225,17 +214,28 @@ class NaiiveCKKWLJob():
 class NaiiveCKKWLMerger():
 
 
-    def __init__(self, user_name, grid_output_dir, prune=False, prune_script="yodastats"):
+    def __init__(self, user_name, grid_output_dir, prune=False, prune_script="yodastats", processes=1, streams=8):
         """
         Initialises merger for output files given:
             user_name       : user name for gridui and dpm grid storage
             grid_output_dir : location of output files on grid storage
             prune           : optional bool to prune the output data
             prune_script    : name of C/C++ script to prune yoda files
+            processes       : optional int number of worker processes for merging,
+                              0 uses all available cores
+            streams         : optional int number of concurrent transfers when copying
         """
         self.user_name = str(user_name)
         self.grid_output_dir = str(grid_output_dir)
+        self.processes = int(processes)
+        self.streams = int(streams)
         self.prune = bool(prune)
+        # Glob patterns of output files and the directory each category is sorted into
+        self.categories = [
+            ("LO*yoda", "results/lo-output"),
+            ("HEJ_*yoda", "results/hej-output"),
+            ("ckkwl_*yoda", "results/ckkwl-output"),
+        ]
         if self.prune:
             self.prune_script = prune_script
 
@@ -247,41 +247,40 @@ class NaiiveCKKWLMerger():
 
     def copy_files(self):
         """
-        Copies grid output files to scratch dir.
+        Copies grid output files not retrieved by a previous finalise to scratch dir
+        and organises them.
         """
-        print("Copying output to scratch")
-        cmd = "gfal-copy -f -r %s %s" % (self.grid_output_dir, self.scratch_dir)
-        os.system(cmd)
+        print("Copying new output to scratch")
+        retrieved = manifest.Manifest(os.path.join(self.scratch_dir, "manifest.json"))
+        manifest.retrieve_new(self.grid_output_dir, self.scratch_dir, retrieved, self.streams)
         os.system("mkdir results")
         os.system("mkdir results/lo-output")
         os.system("mkdir results/hej-output")
         os.system("mkdir results/ckkwl-output")
 
         print("Organising output into categories of runs")
-        files = os.listdir(self.scratch_dir)
+        files = retrieved.get_unorganised()
         print(files)
-        with multiprocessing.Pool() as pool:
-            # Use multiprocessing to organise output in parallel
-            pool.map(self.organise_single, files)
-
-        os.system("rm tmp_logfile")
+        try:
+            with multiprocessing.Pool() as pool:
+                # Use multiprocessing to organise output in parallel
+                organised = pool.map(self.organise_single, files)
+            retrieved.set_organised([name for name, success in zip(files, organised) if success])
+            retrieved.set_failed([name for name, success in zip(files, organised) if not success])
+        finally:
+            retrieved.save()
 
 
     def organise_single(self, filename):
         """
-        Organise the tarball of results named 'filename'.
+        Organise the tarball of results named 'filename', streaming each output file
+        straight into its category directory. Returns True if it was organised.
         """
-        # TODO: Clean output for log file (e.g. mark with process ID)
-        cmd = "tar -xzf %s/%s >> tmp_logfile 2>&1" % (self.scratch_dir, filename)
-        os.system(cmd)
-        cmd = "mv LO*yoda results/lo-output >> tmp_logfile 2>&1"
-        os.system(cmd)
-        cmd = "mv HEJ_*yoda results/hej-output >> tmp_logfile 2>&1"
-        os.system(cmd)
-        cmd = "mv ckkwl_*yoda results/ckkwl-output >> tmp_logfile 2>&1"
-        os.system(cmd)
-        cmd = "rm *yoda *cmnd *yml Run.dat >> tmp_logfile 2>&1"
-        os.system(cmd)
+        try:
+            return tarballs.extract_by_category(os.path.join(self.scratch_dir, filename), self.categories)
+        except Exception as error:
+            print("Failed to organise %s: %s" % (filename, error))
+            return False
 
 
     def merge_output(self, with_variations = True):
@@ -296,23 +295,16 @@ class NaiiveCKKWLMerger():
         cmd = "mkdir results/merged"
         os.system(cmd)
         if with_variations:
-            cmd = "yodamerge results/lo-output/LO*.MUR2_MUF2_* -o results/merged/LO-MUR2-MUF2.yoda"
-            os.system(cmd)
-            # cmd = "yodamerge results/lo-output/LO*.MUR1_MUF2_* -o results/merged/LO-MUR1-MUF2.yoda"
-            # os.system(cmd)
-            # cmd = "yodamerge results/lo-output/LO*.MUR2_MUF1_* -o results/merged/LO-MUR2-MUF1.yoda"
-            # os.system(cmd)
-            # cmd = "yodamerge results/lo-output/LO*.MUR0.5_MUF1_* -o results/merged/LO-MUR0.5-MUF1.yoda"
-            # os.system(cmd)
-            # cmd = "yodamerge results/lo-output/LO*.MUR1_MUF0.5_* -o results/merged/LO-MUR1-MUF0.5.yoda"
-            # os.system(cmd)
-            cmd = "yodamerge results/lo-output/LO*.MUR0.5_MUF0.5_* -o results/merged/LO-MUR0.5-MUF0.5.yoda"
-            os.system(cmd)
+            self.merge_yoda("results/lo-output/LO*.MUR2_MUF2_*", "results/merged/LO-MUR2-MUF2.yoda")
+            # self.merge_yoda("results/lo-output/LO*.MUR1_MUF2_*", "results/merged/LO-MUR1-MUF2.yoda")
+            # self.merge_yoda("results/lo-output/LO*.MUR2_MUF1_*", "results/merged/LO-MUR2-MUF1.yoda")
+            # self.merge_yoda("results/lo-output/LO*.MUR0.5_MUF1_*", "results/merged/LO-MUR0.5-MUF1.yoda")
+            # self.merge_yoda("results/lo-output/LO*.MUR1_MUF0.5_*", "results/merged/LO-MUR1-MUF0.5.yoda")
+            self.merge_yoda("results/lo-output/LO*.MUR0.5_MUF0.5_*", "results/merged/LO-MUR0.5-MUF0.5.yoda")
         
         cmd = "rm results/lo-output/LO*MU*"
         os.system(cmd)
-        cmd = "yodamerge results/lo-output/LO* -o results/merged/LO.yoda"
-        os.system(cmd)
+        self.merge_yoda("results/lo-output/LO*", "results/merged/LO.yoda")
         cmd = "rm -r results/lo-output"
         os.system(cmd)
         print("LO yoda files merged")
@@ -320,36 +312,39 @@ class NaiiveCKKWLMerger():
         # Merge HEJ results
         print("Merging HEJ yoda files")
         if with_variations:
-            cmd = "yodamerge results/hej-output/HEJ*MuR2_MuF2* -o results/merged/HEJ-MUR2-MUF2.yoda"
-            os.system(cmd)
-            # cmd = "yodamerge results/hej-output/HEJ*MuR1_MuF2* -o results/merged/HEJ-MUR1-MUF2.yoda"
-            # os.system(cmd)
-            # cmd = "yodamerge results/hej-output/HEJ*MuR2_MuF1* -o results/merged/HEJ-MUR2-MUF1.yoda"
-            # os.system(cmd)
-            # cmd = "yodamerge results/hej-output/HEJ*MuR0.5_MuF1* -o results/merged/HEJ-MUR0.5-MUF1.yoda"
-            # os.system(cmd)
-            # cmd = "yodamerge results/hej-output/HEJ*MuR1_MuF0.5* -o results/merged/HEJ-MUR1-MUF0.5.yoda"
-            # os.system(cmd)
-            cmd = "yodamerge results/hej-output/HEJ*MuR0.5_MuF0.5* -o results/merged/HEJ-MUR0.5-MUF0.5.yoda"
-            os.system(cmd)
+            self.merge_yoda("results/hej-output/HEJ*MuR2_MuF2*", "results/merged/HEJ-MUR2-MUF2.yoda")
+            # self.merge_yoda("results/hej-output/HEJ*MuR1_MuF2*", "results/merged/HEJ-MUR1-MUF2.yoda")
+            # self.merge_yoda("results/hej-output/HEJ*MuR2_MuF1*", "results/merged/HEJ-MUR2-MUF1.yoda")
+            # self.merge_yoda("results/hej-output/HEJ*MuR0.5_MuF1*", "results/merged/HEJ-MUR0.5-MUF1.yoda")
+            # self.merge_yoda("results/hej-output/HEJ*MuR1_MuF0.5*", "results/merged/HEJ-MUR1-MUF0.5.yoda")
+            self.merge_yoda("results/hej-output/HEJ*MuR0.5_MuF0.5*", "results/merged/HEJ-MUR0.5-MUF0.5.yoda")
         
         cmd = "rm results/hej-output/HEJ*Mu*"
         os.system(cmd)
-        cmd = "yodamerge results/hej-output/HEJ* -o results/merged/HEJ.yoda"
-        os.system(cmd)
+        self.merge_yoda("results/hej-output/HEJ*", "results/merged/HEJ.yoda")
         cmd = "rm -r results/hej-output"
         os.system(cmd)
         print("HEJ yoda files merged")
 
         # Merge naiive_ckkwl results
         print("Merging naiive_ckkwl yoda files")
-        cmd = "yodamerge results/ckkwl-output/ckkwl* -o results/merged/CKKWL.yoda"
-        os.system(cmd)
+        self.merge_yoda("results/ckkwl-output/ckkwl*", "results/merged/CKKWL.yoda")
         cmd = "rm -r results/ckkwl-output"
         os.system(cmd)
         print("ckkwl yoda files merged")
 
 
+    def merge_yoda(self, pattern, output):
+        """
+        Merges the yoda files matching the glob 'pattern' into 'output' in-process,
+        equivalent to 'yodamerge pattern -o output'. Large sets of files are merged
+        in a reduction tree across 'self.processes' worker processes.
+        """
+        # Imported here since NumPy is only required for merging
+        from GridTools import yoda
+        yoda.merge_files(glob.glob(pattern), output, processes = self.processes)
+
+
     def clear_files(self):
         """
         Removes files created in scratch.
@@ -374,14 +369,19 @@ def parse():
     Parse command line arguments.
         user_name : str user handle on gridui and dpm storage
         job_number : int identifying submission
-        runs_per_job : int number of runs per submission < 4
+        runs_per_job : int number of runs per submission, 0 for as many as the node fits
         events : int number of events per run
         base_dir : base directory containing run configuration files
         rivet_dir : directory containing rivet analyses
         grid_output_dir : directory on grid storage for output, with protocol
+        queue : work queue directory for pilot mode, with protocol
+        wall_time : int wall-time budget of a pilot in seconds
+        stage_timeout : int wall-time limit of each generator stage in seconds
+        chunk_events : int number of events per chunk, to run the node's events as chunks
+        premerge : merge the results of the node's runs before uploading them
         name : job name
     """
-    parser = argparse.ArgumentParser(description = "Usage: python run_naiiveckkwl.py -u user_name -j job_number -p runs_per_job -e events -b base_dir -r rivet_dir -o grid_output_dir")
+    parser = argparse.ArgumentParser(description = "Usage: python run_naiiveckkwl.py -u user_name -j job_number -p runs_per_job -e events -b base_dir -r rivet_dir -o grid_output_dir [-q queue] [-l wall_time] [-x stage_timeout] [-z chunk_events] [--premerge]")
     parser.add_argument('--user_name', '-u', nargs = 1, type = str)
     parser.add_argument('--job_number', '-j', nargs = 1, type = int, default = 1)
     parser.add_argument('--processes', '-p', nargs = 1, type = int, default = 1)
@@ -389,6 +389,11 @@ def parse():
     parser.add_argument('--base_dir', '-b', nargs = 1, type = str, default = os.getcwd())
     parser.add_argument('--rivet_dir', '-r', nargs = 1, type = str, default = os.getcwd())
     parser.add_argument('--output', '-o', nargs = 1, type = str)
+    parser.add_argument('--queue', '-q', nargs = 1, type = str, default = None)
+    parser.add_argument('--wall_time', '-l', nargs = 1, type = int, default = [86400])
+    parser.add_argument('--stage_timeout', '-x', nargs = 1, type = int, default = [None])
+    parser.add_argument('--chunk_events', '-z', nargs = 1, type = int, default = [None])
+    parser.add_argument('--premerge', action = "store_true")
     return parser.parse_args()
 
 
@@ -399,29 +404,27 @@ def main():
     args = parse()
 
     t0 = time.time()
-    ckkwl = NaiiveCKKWLJob(args.user_name[0], args.job_number[0], args.base_dir[0], args.rivet_dir[0], args.output[0])
+    ckkwl = NaiiveCKKWLJob(args.user_name[0], args.job_number[0], args.base_dir[0], args.rivet_dir[0], args.output[0], stage_timeout = args.stage_timeout[0])
     ckkwl.set_env()
 
-    if args.processes[0] > 4:
-        raise(ValueError("Maximum number of processes is 4 per node."))
+    # Fit the number of runs to the node, taking as many as it fits for -p 0
+    processes = resources.get_concurrency(RUN_PROFILE, args.events[0], args.processes[0])
 
     t1 = time.time()
-    jobs = []
-    for number in range(args.processes[0]):
-        p = multiprocessing.Process(target = ckkwl.run_job, args = (number, args.events[0]))
-        jobs.append(p)
-
-    for job in jobs:
-        job.start()
-    
-    for job in jobs:
-        job.join()
-
+    if args.queue is not None:
+        # Pilot mode: keep claiming job numbers from the work queue
+        workqueue.run_pilot(ckkwl, processes, args.events[0], args.queue[0], t0 + args.wall_time[0], args.chunk_events[0], args.premerge)
+    else:
+        workqueue.run_unit(ckkwl, processes, args.events[0], args.chunk_events[0], args.premerge)
+
+    # Retry the uploads that failed during the runs
+    ckkwl.uploader.drain()
     t2 = time.time()
 
     print("Environment setting time %s(s)" % (t1 - t0))
     print("Execution time %s(s)" % (t2 - t1))
     print("Total time %s(s)" % (t2 - t0))
+    ckkwl.uploader.print_report()
 
 
 if __name__ == """__main__""":
@@ -0,0 +1,71 @@
+"""
+Tests of the parsing of 'arcstat' output by GridTools.arcstatus.
+"""
+from GridTools import arcstatus
+
+
+OUTPUT = """Job: gsiftp://ce1.dur.scotgrid.ac.uk:2811/jobs/aaa
+ Name: run_sherpa.py.1
+ State: Finished
+ Exit Code: 0
+
+Job: gsiftp://ce2.dur.scotgrid.ac.uk:2811/jobs/bbb
+ Name: run_sherpa.py.2
+ State: Running (INLRMS:R)
+ Specific state: INLRMS:R
+
+Job: https://ce1.dur.scotgrid.ac.uk:443/arex/ccc
+ Name: run_sherpa.py.3
+ State: Failed
+ Specific state: FAILED
+ Exit Code: 1
+WARNING: Job information not found in the information system: gsiftp://ce2.dur.scotgrid.ac.uk:2811/jobs/ddd
+Job: gsiftp://ce2.dur.scotgrid.ac.uk:2811/jobs/eee
+ Name: run_sherpa.py.5
+
+Status of 5 jobs was queried, 4 jobs returned information
+"""
+
+
+def test_get_ce():
+    assert arcstatus.get_ce("gsiftp://ce1.dur.scotgrid.ac.uk:2811/jobs/aaa") == "ce1.dur.scotgrid.ac.uk"
+    assert arcstatus.get_ce("https://ce2.dur.scotgrid.ac.uk/arex/bbb") == "ce2.dur.scotgrid.ac.uk"
+
+
+def test_parse():
+    jobs = arcstatus.parse(OUTPUT)
+    assert [job["job_id"].rsplit("/", 1)[-1] for job in jobs] == ["aaa", "bbb", "ccc", "ddd", "eee"]
+    assert jobs[0] == {"job_id" : "gsiftp://ce1.dur.scotgrid.ac.uk:2811/jobs/aaa", "name" : "run_sherpa.py.1",
+                       "state" : "Finished", "exit_code" : "0", "ce" : "ce1.dur.scotgrid.ac.uk"}
+    # The detail of older clients is split off the state
+    assert jobs[1]["state"] == "Running"
+    assert jobs[1]["specific_state"] == "INLRMS:R"
+    assert jobs[2]["ce"] == "ce1.dur.scotgrid.ac.uk"
+    assert jobs[2]["exit_code"] == "1"
+    # Jobs without information, or a state, are missing
+    assert jobs[3] == {"job_id" : "gsiftp://ce2.dur.scotgrid.ac.uk:2811/jobs/ddd", "state" : arcstatus.MISSING,
+                       "ce" : "ce2.dur.scotgrid.ac.uk"}
+    assert jobs[4]["state"] == arcstatus.MISSING
+
+
+def test_parse_empty():
+    assert arcstatus.parse("") == []
+    assert arcstatus.parse("No jobs\n") == []
+
+
+def test_count_states():
+    counts = arcstatus.count_states(arcstatus.parse(OUTPUT))
+    assert list(counts) == arcstatus.STATES
+    assert counts == {"Running" : 1, "Finished" : 1, "Finishing" : 0, "Failed" : 1, "Queuing" : 0, "Missing" : 2}
+
+    counts = arcstatus.count_states([{"state" : "Deleted"}])
+    assert list(counts)[-1] == "Deleted"
+
+
+def test_count_states_by_ce():
+    counts = arcstatus.count_states_by_ce(arcstatus.parse(OUTPUT))
+    assert list(counts) == ["ce1.dur.scotgrid.ac.uk", "ce2.dur.scotgrid.ac.uk"]
+    assert counts["ce1.dur.scotgrid.ac.uk"]["Finished"] == 1
+    assert counts["ce1.dur.scotgrid.ac.uk"]["Failed"] == 1
+    assert counts["ce2.dur.scotgrid.ac.uk"]["Running"] == 1
+    assert counts["ce2.dur.scotgrid.ac.uk"]["Missing"] == 2
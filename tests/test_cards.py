@@ -0,0 +1,41 @@
+"""
+Tests of the rendering of per-seed run cards by GridTools.cards.
+"""
+import os
+
+from GridTools import cards
+
+
+CONFIG = """events: 1000
+random generator:
+  name: ranlux64
+  seed: 1
+event output:
+  - HEJ.lhe
+analysis:
+  output: HEJ
+"""
+
+
+def test_render(tmp_path):
+    (tmp_path / "config.yml").write_text(u"%s" % CONFIG)
+    templates = cards.load_templates(str(tmp_path), ["config.yml"])
+    output = str(tmp_path / "config_17.yml")
+    templates["config.yml"].render(output, [(r"seed: 1", "seed: 17"), (r"HEJ\.lhe", r"HEJ_17.lhe"), (r"output: HEJ", "output: HEJ_17")])
+    with open(output) as card:
+        text = card.read()
+    assert "seed: 17\n" in text
+    assert "  - HEJ_17.lhe\n" in text
+    assert text.endswith("  output: HEJ_17\n")
+    # The template is unchanged
+    assert templates["config.yml"].text == CONFIG
+    assert sorted(os.listdir(str(tmp_path))) == ["config.yml", "config_17.yml"]
+
+
+def test_replacements_are_literal(tmp_path):
+    (tmp_path / "run.cmnd").write_text(u"Main:numberOfEvents = N\nRandom:seed = S\n")
+    template = cards.CardTemplate(str(tmp_path / "run.cmnd"))
+    output = str(tmp_path / "run_3.cmnd")
+    template.render(output, [("= N", r"= 10 \1"), ("S", "3")])
+    with open(output) as card:
+        assert card.read() == "Main:numberOfEvents = 10 \\1\nRandom:seed = 3\n"
@@ -0,0 +1,42 @@
+"""
+Tests of the event chunks pulled by the runs of a node, GridTools.workqueue.run_chunks.
+"""
+import os
+
+from GridTools import workqueue
+
+
+class ChunkJob():
+
+
+    def __init__(self, job_number, output_dir):
+        self.job_number = job_number
+        self.output_dir = str(output_dir)
+
+
+    def get_unique_seed(self, run_number):
+        return int(0.5 * (self.job_number + run_number) * (self.job_number + run_number + 1) + run_number)
+
+
+    def run_job(self, run_number, events):
+        if run_number == 2:
+            raise RuntimeError("broken chunk")
+        with open(os.path.join(self.output_dir, "%s_%s" % (self.get_unique_seed(run_number), events)), "w"):
+            pass
+
+
+def test_get_chunk_count():
+    assert workqueue.get_chunk_count(4, 1000, 500) == 8
+    # The budget is rounded up to whole chunks
+    assert workqueue.get_chunk_count(3, 1000, 400) == 8
+
+
+def test_run_chunks(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    output_dir = tmp_path / "output"
+    output_dir.mkdir()
+    job = ChunkJob(5, output_dir)
+    workqueue.run_chunks(job, 3, 1000, 400)
+
+    # Every chunk but the broken one ran once, seeded as run number i of the job
+    assert sorted(os.listdir(str(output_dir))) == sorted("%s_400" % job.get_unique_seed(index) for index in range(8) if index != 2)
@@ -0,0 +1,141 @@
+"""
+Tests of the seed mapping and job selection of GridTools.jobdb.
+"""
+import pytest
+
+from GridTools import jobdb
+
+
+DESCRIPTION = "&(executable='run_sherpa.py')(jobname='job%s')(arguments='%s')"
+
+
+def test_get_seeds():
+    # Cantor's pairing of the job and run numbers, as get_unique_seed gives them
+    assert jobdb.get_seeds(0, 3) == [0, 2, 5]
+    assert jobdb.get_seeds(3, 2) == [6, 11]
+
+
+def test_get_job_number_inverts_get_seeds():
+    for job_number in list(range(50)) + [999, 123456, 10 ** 6]:
+        for run, seed in enumerate(jobdb.get_seeds(job_number, 10)):
+            assert jobdb.get_job_number(seed) == job_number, (job_number, run, seed)
+
+
+def test_parse_ranges():
+    assert jobdb.parse_ranges("1-100,205") == [(1, 100), (205, 205)]
+    assert jobdb.parse_ranges("7,") == [(7, 7)]
+    assert jobdb.parse_ranges("") == []
+
+
+def test_get_job_name():
+    assert jobdb.get_job_name(DESCRIPTION % (12, 12)) == "job12"
+    assert jobdb.get_job_name("(jobname = run.12)(count=1)") == "run.12"
+    assert jobdb.get_job_name(None) is None
+
+
+def make_database(tmp_path):
+    """
+    Returns a database of jobs 1 to 4 on two CEs, with job 2 submitted twice.
+    """
+    database = jobdb.JobDatabase(str(tmp_path / "jobs.db"))
+    for job_number in range(1, 5):
+        ce = "ce%s.example.org" % (job_number % 2 + 1)
+        database.record(job_number, "gsiftp://%s:2811/jobs/%s" % (ce, job_number), ce,
+                        jobdb.get_seeds(job_number, 2), "/out", DESCRIPTION % (job_number, job_number))
+    database.record(2, "gsiftp://ce1.example.org:2811/jobs/2b", "ce1.example.org")
+    return database
+
+
+def test_resubmission_supersedes(tmp_path):
+    database = make_database(tmp_path)
+    jobs = database.select(job_ranges = [(2, 2)])
+    assert [job["job_id"] for job in jobs] == ["gsiftp://ce1.example.org:2811/jobs/2b"]
+    # The seeds and output directory are kept from the earlier job
+    assert jobs[0]["seeds"] == " ".join(str(seed) for seed in jobdb.get_seeds(2, 2))
+    assert jobs[0]["output_dir"] == "/out"
+    assert len(database.select(job_ranges = [(2, 2)], superseded = True)) == 2
+
+
+def test_select(tmp_path):
+    database = make_database(tmp_path)
+    assert [job["job_number"] for job in database.select(ces = ["ce2.example.org"])] == [1, 3]
+    assert [job["job_number"] for job in database.select(job_ranges = [(1, 1), (3, 4)])] == [1, 3, 4]
+    assert [job["job_number"] for job in database.select(seed = jobdb.get_seeds(4, 2)[1])] == [4]
+
+
+def test_update_states(tmp_path):
+    database = make_database(tmp_path)
+    database.update_states([{"job_id" : "gsiftp://ce2.example.org:2811/jobs/1", "state" : "Finished"},
+                            ("gsiftp://ce2.example.org:2811/jobs/3", "Failed")])
+    assert [job["job_number"] for job in database.select(states = ["Finished", "Failed"])] == [1, 3]
+    assert database.count_states()["ce2.example.org"] == {"Failed" : 1, "Finished" : 1}
+
+
+def test_resolve_unknown(tmp_path):
+    database = make_database(tmp_path)
+    for job_number in (5, 6):
+        database.record(job_number, jobdb.get_unknown_id(job_number, "ce1.example.org"), "ce1.example.org",
+                        description = DESCRIPTION % (job_number, job_number), state = jobdb.UNKNOWN)
+    unknown = database.select(states = [jobdb.UNKNOWN])
+    assert [job["job_number"] for job in unknown] == [5, 6]
+    # Unknown jobs are not submitted again until found to be absent
+    assert database.get_submitted() == set(range(1, 7))
+
+    found = [{"job_id" : "gsiftp://ce1.example.org:2811/jobs/5", "name" : "job5", "state" : "Queuing"},
+             {"job_id" : "gsiftp://ce1.example.org:2811/jobs/other", "name" : "other", "state" : "Running"}]
+    assert database.resolve_unknown(unknown, found) == 1
+    assert database.select(job_ranges = [(5, 5)])[0]["job_id"] == "gsiftp://ce1.example.org:2811/jobs/5"
+    assert database.select(job_ranges = [(5, 5)])[0]["state"] == "Queuing"
+    assert database.select(job_ranges = [(6, 6)])[0]["state"] == jobdb.ABSENT
+    assert database.get_submitted() == set(range(1, 6))
+
+
+def test_import_ledger(tmp_path):
+    with open(str(tmp_path / jobdb.FLAT_LEDGER), "w") as ledger:
+        ledger.write("1 gsiftp://ce1.example.org:2811/jobs/1 ce1.example.org 100.0\n")
+        ledger.write("2 gsiftp://ce1.example.org:2811/jobs/2 ce1.example.org 101.0\n")
+    database = jobdb.JobDatabase(str(tmp_path / "jobs.db"))
+    assert database.get_submitted() == set([1, 2])
+
+
+def test_kill_or_clean(tmp_path, monkeypatch):
+    database = make_database(tmp_path)
+    database.record(5, jobdb.get_unknown_id(5, "ce2.example.org"), "ce2.example.org", state = jobdb.UNKNOWN)
+    calls = []
+    monkeypatch.setattr(jobdb, "run_arc", lambda command, job_ids, jobs_file: calls.append((command, job_ids)) or "")
+    jobdb.kill_or_clean("arckill", ["ce2.example.org"], filename = database.filename)
+    # Only the jobs on the CE with a job ID are killed
+    assert calls == [("arckill", ["gsiftp://ce2.example.org:2811/jobs/1", "gsiftp://ce2.example.org:2811/jobs/3"])]
+    assert [job["job_number"] for job in database.select(states = ["Killed"])] == [1, 3]
+
+    jobdb.kill_or_clean("arcclean", filename = database.filename)
+    assert len(calls[1][1]) == 4
+    assert database.count_states() == {"ce1.example.org" : {"Cleaned" : 2}, "ce2.example.org" : {"Cleaned" : 2, jobdb.UNKNOWN : 1}}
+
+
+def test_kill_or_clean_without_database(tmp_path, monkeypatch):
+    commands = []
+    monkeypatch.setattr(jobdb.os, "system", commands.append)
+    jobdb.kill_or_clean("arckill", ["ce1.example.org"], filename = str(tmp_path / "jobs.db"))
+    assert commands == ["arckill -j multijobs.dat -c ce1.example.org"]
+
+
+def test_get_job_number_rejects_seeds_out_of_range():
+    with pytest.raises(ValueError):
+        jobdb.get_job_number(-1)
+    # The seed of run 4 of job 3 is not among the seeds of a job of 4 runs
+    seed = jobdb.get_seeds(3, 5)[4]
+    assert jobdb.get_job_number(seed) == 3
+    with pytest.raises(ValueError):
+        jobdb.get_job_number(seed, 4)
+
+
+def test_select_rejects_seeds_not_recorded(tmp_path):
+    database = make_database(tmp_path)
+    # Jobs 1 to 4 run 2 seeds each
+    with pytest.raises(ValueError):
+        database.select(seed = jobdb.get_seeds(4, 3)[2])
+    with pytest.raises(ValueError):
+        database.select(seed = -5)
+    # Jobs not recorded, or recorded without seeds, take any seed of theirs
+    assert database.select(seed = jobdb.get_seeds(9, 3)[2]) == []
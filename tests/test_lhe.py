@@ -0,0 +1,99 @@
+"""
+Tests of the Les Houches event file helpers of GridTools.lhe.
+"""
+import gzip
+import io
+
+import pytest
+
+from GridTools import lhe
+
+
+HEADER = b"""<LesHouchesEvents version="1.0">
+<header>
+<!-- version="1.0" in a comment -->
+</header>
+"""
+EVENT = b"<event>\n 2 1 1.0 91.2 0.0078 0.118\n</event>\n"
+
+
+def write_events(path, header=HEADER, events=1000, trailer=b""):
+    """
+    Writes an event file of 'events' events with the given header and trailer.
+    """
+    with open(str(path), "wb") as event_file:
+        event_file.write(header + b"<init>\n2212 2212 6500 6500\n</init>\n" + EVENT * events + trailer + b"</LesHouchesEvents>\n")
+    return str(path)
+
+
+def test_read_header():
+    assert lhe.read_header(io.BytesIO(HEADER + b"<init>\n" + EVENT)) == HEADER
+    # The tag straddling two blocks is still found
+    padding = b" " * (lhe.BLOCK_SIZE - 3)
+    assert lhe.read_header(io.BytesIO(padding + b"<init>" + EVENT)) == padding
+    assert lhe.read_header(io.BytesIO(b"no init"), max_size = 4) == b"no init"
+
+
+def test_patch_header(tmp_path):
+    filename = write_events(tmp_path / "events.lhe")
+    with open(filename, "rb") as event_file:
+        original = event_file.read()
+
+    assert lhe.patch_header(filename, b'version="1.0"', b'version="3.0"') == 2
+    with open(filename, "rb") as event_file:
+        patched = event_file.read()
+    assert patched == original.replace(b'version="1.0"', b'version="3.0"')
+    assert len(patched) == len(original)
+
+
+def test_patch_header_leaves_events(tmp_path):
+    filename = write_events(tmp_path / "events.lhe", header = b"<LesHouchesEvents>\n", events = 10)
+    with open(filename, "ab") as event_file:
+        event_file.write(b'<!-- version="1.0" -->\n')
+    with open(filename, "rb") as event_file:
+        original = event_file.read()
+
+    # Nothing after the <init> block is touched
+    assert lhe.patch_header(filename, b'version="1.0"', b'version="3.0"') == 0
+    with open(filename, "rb") as event_file:
+        assert event_file.read() == original
+
+
+def test_patch_header_needs_equal_lengths(tmp_path):
+    filename = write_events(tmp_path / "events.lhe")
+    with pytest.raises(ValueError):
+        lhe.patch_header(filename, b'version="1.0"', b'version="3"')
+
+
+TRAILER = b"<!--\n# Number of Trials : 123456\n-->\n"
+
+
+def test_total_trials_in_header(tmp_path):
+    filename = write_events(tmp_path / "events.lhe", header = HEADER + b"# Number of Trials : 42\n")
+    assert lhe.get_total_trials(filename) == 42
+
+
+def test_total_trials_in_trailer(tmp_path):
+    filename = write_events(tmp_path / "events.lhe", events = 50000, trailer = TRAILER)
+    assert lhe.get_total_trials(filename) == 123456
+    # Only the last 'tail_size' bytes are searched
+    assert lhe.search_ends(filename, lhe.TRIALS_PATTERN, tail_size = 16) is None
+
+
+def test_total_trials_gzipped(tmp_path):
+    filename = write_events(tmp_path / "events.lhe", events = 50000, trailer = TRAILER)
+    with open(filename, "rb") as event_file, gzip.open(filename + ".gz", "wb") as gzipped:
+        gzipped.write(event_file.read())
+    assert lhe.get_total_trials(filename + ".gz") == 123456
+
+
+def test_search_stream_across_blocks():
+    data = b"x" * (lhe.BLOCK_SIZE - 10) + b"\n# Number of Trials : 77\n"
+    assert lhe.search_stream(io.BytesIO(data), lhe.TRIALS_PATTERN).group(1) == b"77"
+    # '^' only matches at real line starts
+    assert lhe.search_stream(io.BytesIO(b"x" * (lhe.BLOCK_SIZE - 1) + b"# Number of Trials : 77\n"), lhe.TRIALS_PATTERN) is None
+
+
+def test_total_trials_missing(tmp_path):
+    with pytest.raises(ValueError):
+        lhe.get_total_trials(write_events(tmp_path / "events.lhe"))
@@ -0,0 +1,63 @@
+"""
+Tests of the record of retrieved output files kept by GridTools.manifest.
+"""
+import os
+
+from GridTools import manifest, storage
+
+
+def make_outputs(directory, names):
+    """
+    Writes a small file for each of 'names' to 'directory'.
+    """
+    directory.mkdir(exist_ok = True)
+    for name in names:
+        (directory / name).write_text(u"output of %s" % name)
+
+
+def test_retrieve_new_only_copies_new_files(tmp_path):
+    remote = tmp_path / "remote"
+    local = tmp_path / "local"
+    make_outputs(remote, ["out_1.tar.gz", "out_2.tar.gz"])
+    local.mkdir()
+    filename = str(tmp_path / "manifest.json")
+
+    retrieved = manifest.retrieve_new(str(remote), str(local), manifest.Manifest(filename), streams = 2)
+    assert sorted(retrieved) == ["out_1.tar.gz", "out_2.tar.gz"]
+    assert sorted(os.listdir(str(local))) == ["out_1.tar.gz", "out_2.tar.gz"]
+
+    make_outputs(remote, ["out_3.tar.gz"])
+    record = manifest.Manifest(filename)
+    assert manifest.retrieve_new(str(remote), str(local), record, streams = 2) == ["out_3.tar.gz"]
+    assert record.files["out_3.tar.gz"]["checksum"] == storage.get_file_checksum(str(local / "out_3.tar.gz"))
+
+
+def test_get_missing_records_local_files(tmp_path):
+    local = tmp_path / "local"
+    make_outputs(local, ["out_1.tar.gz"])
+    record = manifest.Manifest(str(tmp_path / "manifest.json"))
+    size = os.path.getsize(str(local / "out_1.tar.gz"))
+
+    # A local file of the wrong size is transferred again
+    assert record.get_missing([("out_1.tar.gz", size + 1), ("out_2.tar.gz", 10)], str(local)) == ["out_1.tar.gz", "out_2.tar.gz"]
+    assert record.get_missing([("out_1.tar.gz", size), ("out_2.tar.gz", 10)], str(local)) == ["out_2.tar.gz"]
+    assert record.is_retrieved("out_1.tar.gz", size)
+
+
+def test_organised_and_failed(tmp_path):
+    local = tmp_path / "local"
+    make_outputs(local, ["out_1.tar.gz", "out_2.tar.gz", "out_3.tar.gz"])
+    filename = str(tmp_path / "manifest.json")
+    record = manifest.Manifest(filename)
+    for name in os.listdir(str(local)):
+        record.add(name, str(local / name))
+    assert record.get_unorganised() == ["out_1.tar.gz", "out_2.tar.gz", "out_3.tar.gz"]
+
+    record.set_organised(["out_1.tar.gz"])
+    record.set_failed(["out_2.tar.gz"])
+    record.save()
+    # Failed files are not organised again until they are retrieved again
+    record = manifest.Manifest(filename)
+    assert record.get_unorganised() == ["out_3.tar.gz"]
+    record.add("out_2.tar.gz", str(local / "out_2.tar.gz"))
+    assert record.get_unorganised() == ["out_2.tar.gz", "out_3.tar.gz"]
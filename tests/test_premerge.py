@@ -0,0 +1,75 @@
+"""
+Tests of merging the results of a node's runs before uploading, GridTools.premerge.
+"""
+import io
+import os
+import tarfile
+
+from GridTools import premerge, yoda
+
+
+HISTO = """BEGIN YODA_HISTO1D_V2 /TEST/h
+Path: /TEST/h
+Type: Histo1D
+---
+# xlow	 xhigh	 sumw	 sumw2	 sumwx	 sumwx2	 numEntries
+0.0	1.0	%(sumw)s	%(sumw)s	0.0	0.0	1
+END YODA_HISTO1D_V2
+
+"""
+
+
+def make_results(spool_dir, seed, sumw):
+    """
+    Writes the results tarball of run 'seed' holding a YODA file and a run card.
+    """
+    with tarfile.open(os.path.join(str(spool_dir), "sherpa_output%s.tar.gz" % seed), "w:gz") as tarball:
+        for name, text in [("Sherpa_%s.yoda" % seed, HISTO % {"sumw" : sumw}), ("Run_%s.dat" % seed, "card")]:
+            data = text.encode()
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tarball.addfile(info, io.BytesIO(data))
+
+
+def test_get_merged_name():
+    assert premerge.get_merged_name("HEJ_123.yoda", 123, 7) == "HEJ_job7.yoda"
+    assert premerge.get_merged_name("HEJ_123_MUR2.yoda.gz", 123, 7) == "HEJ_job7_MUR2.yoda.gz"
+    # Only a delimited seed is replaced
+    assert premerge.get_merged_name("HEJ_1234.yoda", 123, 7) == "HEJ_1234.yoda"
+
+
+def test_upload(tmp_path):
+    spool_dir = tmp_path / "spool"
+    output_dir = tmp_path / "output"
+    spool_dir.mkdir()
+    output_dir.mkdir()
+    for seed, sumw in [(11, 1.0), (12, 2.0), (13, 6.0)]:
+        make_results(spool_dir, seed, sumw)
+
+    assert premerge.upload(str(spool_dir), str(output_dir), 4)
+    assert os.listdir(str(output_dir)) == ["sherpa_outputjob4.tar.gz"]
+    assert not spool_dir.exists()
+
+    with tarfile.open(str(output_dir / "sherpa_outputjob4.tar.gz")) as tarball:
+        assert sorted(tarball.getnames()) == ["Sherpa_job4.yoda", "seed_11", "seed_11/Run_11.dat", "seed_12",
+                                              "seed_12/Run_12.dat", "seed_13", "seed_13/Run_13.dat"]
+        tarball.extract("Sherpa_job4.yoda", str(tmp_path))
+    # A partial merge, giving the average of the runs when merged further
+    merged = yoda.read(str(tmp_path / "Sherpa_job4.yoda"))["/TEST/h"]
+    assert merged.nfiles == 3
+    assert merged.values[0, 0] == 9.0
+
+
+def test_upload_unmerged_on_failure(tmp_path, monkeypatch):
+    spool_dir = tmp_path / "spool"
+    output_dir = tmp_path / "output"
+    spool_dir.mkdir()
+    output_dir.mkdir()
+    make_results(spool_dir, 11, 1.0)
+    make_results(spool_dir, 12, 2.0)
+
+    def fail(*args, **kwargs):
+        raise ImportError("No module named numpy")
+    monkeypatch.setattr(premerge, "merge_spool", fail)
+    assert premerge.upload(str(spool_dir), str(output_dir), 4)
+    assert sorted(os.listdir(str(output_dir))) == ["sherpa_output11.tar.gz", "sherpa_output12.tar.gz"]
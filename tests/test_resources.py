@@ -0,0 +1,50 @@
+"""
+Tests of the sizing of the number of runs to a node by GridTools.resources.
+"""
+from GridTools import resources
+
+
+GB = 1024 * resources.MB
+
+
+def set_node(monkeypatch, cpus, memory, disk):
+    """
+    Makes the node appear to offer the given CPUs, memory and disk (in bytes).
+    """
+    monkeypatch.setattr(resources, "get_cpu_count", lambda: cpus)
+    monkeypatch.setattr(resources, "get_memory_limit", lambda: memory)
+    monkeypatch.setattr(resources, "get_free_disk", lambda path=".": disk)
+
+
+def test_get_concurrency(monkeypatch):
+    profile = resources.Profile(memory = 2000, disk = 100, disk_per_event = 1.0)
+    set_node(monkeypatch, 16, 64 * GB, 1000 * GB)
+    assert resources.get_concurrency(profile, 10000) == 16
+    assert resources.get_concurrency(profile, 10000, requested = 4) == 4
+
+    # Limited by memory, whatever is requested
+    set_node(monkeypatch, 16, 8 * GB, 1000 * GB)
+    assert resources.get_concurrency(profile, 10000, requested = 8) == 4
+    # Limited by disk, with unknown memory
+    set_node(monkeypatch, 16, None, 2 * GB)
+    assert resources.get_concurrency(profile, 10 ** 6) == 1
+    # Always at least one run
+    set_node(monkeypatch, 16, 1 * GB, 1000 * GB)
+    assert resources.get_concurrency(profile, 10000) == 1
+
+
+def test_cpu_quota(tmp_path, monkeypatch):
+    (tmp_path / "cpu.max").write_text(u"250000 100000\n")
+    (tmp_path / "memory.max").write_text(u"max\n")
+    monkeypatch.setattr(resources, "get_cgroup_dirs", lambda controller: [(2, str(tmp_path))])
+    assert resources.get_cpu_quota() == 2.5
+    assert resources.get_cpu_count() <= 2
+
+    (tmp_path / "cpu.max").write_text(u"max 100000\n")
+    assert resources.get_cpu_quota() is None
+
+
+def test_memory_limit(tmp_path, monkeypatch):
+    (tmp_path / "memory.limit_in_bytes").write_text(u"%s\n" % 1024)
+    monkeypatch.setattr(resources, "get_cgroup_dirs", lambda controller: [(1, str(tmp_path))])
+    assert resources.get_memory_limit() == 1024
@@ -0,0 +1,47 @@
+"""
+Tests of the per-run working directories of GridTools.sandbox.
+"""
+import os
+
+from GridTools import sandbox
+
+
+def make_inputs(base_dir):
+    """
+    Writes the inputs of a Sherpa run to 'base_dir', returning their paths.
+    """
+    base_dir.mkdir()
+    (base_dir / "Run.dat").write_text(u"(run){ }(run)\n")
+    (base_dir / "Results.db").write_text(u"integration results\n")
+    (base_dir / "Process").mkdir()
+    (base_dir / "Process" / "Amegic.db").write_text(u"process library\n")
+    return [str(base_dir / name) for name in ("Run.dat", "Results.db", "Process", "missing.yml")]
+
+
+def test_link_inputs(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    inputs = make_inputs(tmp_path / "base")
+    with sandbox.Sandbox("seed_1") as run:
+        sandbox.link_inputs(inputs)
+        assert sorted(os.listdir(".")) == ["Process", "Results.db", "Run.dat"]
+        assert os.path.islink("Run.dat")
+        # The inputs the generator writes to are copies of their own
+        assert not os.path.islink("Results.db") and not os.path.islink("Process")
+        with open("Results.db", "a") as results:
+            results.write("written by the run\n")
+        with open(os.path.join("Process", "Amegic.db"), "a") as library:
+            library.write("written by the run\n")
+    assert not os.path.exists(run.path)
+    assert (tmp_path / "base" / "Results.db").read_text() == u"integration results\n"
+    assert (tmp_path / "base" / "Process" / "Amegic.db").read_text() == u"process library\n"
+
+
+def test_sandbox_restores_cwd(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs(os.path.join(sandbox.RUNS_DIR, "seed_2"))
+    (tmp_path / sandbox.RUNS_DIR / "seed_2" / "stale.lhe").write_text(u"left by an earlier attempt")
+    with sandbox.Sandbox("seed_2"):
+        assert os.listdir(".") == []
+        open("out.yoda", "w").close()
+    assert os.getcwd() == str(tmp_path)
+    assert os.listdir(sandbox.RUNS_DIR) == []
@@ -0,0 +1,32 @@
+"""
+Tests of the fail-fast generator stages of GridTools.stages.
+"""
+from GridTools import stages
+
+
+def test_run_stage(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    assert stages.run_stage("Touch", "sh -c 'echo events > out_1.lhe'", ["out_*.lhe"], poll_interval = 0.01)
+    assert not stages.run_stage("Fail", "sh -c 'exit 3'", poll_interval = 0.01)
+    # Empty outputs count as missing
+    assert not stages.run_stage("Empty", "touch empty.lhe", ["empty.lhe"], poll_interval = 0.01)
+    assert not stages.run_stage("Sleep", "sleep 10", timeout = 0.2, poll_interval = 0.01)
+
+
+def test_arguments_are_not_shell_expanded(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    assert stages.run_stage("Echo", "sh -c 'echo \"$0\" > out.txt' EVENT_OUTPUT=LHEfix[SherpaLHE_1]", ["out.txt"], poll_interval = 0.01)
+    assert (tmp_path / "out.txt").read_text() == u"EVENT_OUTPUT=LHEfix[SherpaLHE_1]\n"
+
+
+def test_run_concurrently(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    assert stages.run_concurrently(["sh -c 'echo a > a.txt'", "sh -c 'echo b > b.txt'"], ["a.txt", "b.txt"], poll_interval = 0.01)
+    assert not stages.run_concurrently(["true"], ["missing.txt"], poll_interval = 0.01)
+
+
+def test_run_concurrently_kills_the_others(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    # The other stages are killed as soon as one fails, rather than waited for
+    assert not stages.run_concurrently(["sh -c 'exit 1'", "sleep 30"], timeout = 20, poll_interval = 0.01)
+    assert not stages.run_concurrently(["sleep 30", "sleep 30"], timeout = 0.2, poll_interval = 0.01)
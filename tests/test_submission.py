@@ -0,0 +1,187 @@
+"""
+Tests of the submission engine of GridTools.submission, with 'arcsub' replaced by a fake.
+"""
+import os
+import threading
+import time
+
+from GridTools import jobdb, submission, xrsl
+
+
+CE = "ce1.example.org"
+
+
+def get_output(job_numbers, failed=()):
+    """
+    Returns the output of an 'arcsub' call accepting 'job_numbers' and listing 'failed'
+    in its summary.
+    """
+    lines = ["Job submitted with jobid: gsiftp://%s:2811/jobs/id%s" % (CE, job_number) for job_number in job_numbers]
+    lines += ["Job submission summary:", "-----------------------",
+              "%s of %s jobs were submitted" % (len(job_numbers), len(job_numbers) + len(failed))]
+    if failed:
+        lines.append("The following %s were not submitted" % len(failed))
+        lines += ["Name: run_sherpa.py.%s" % job_number for job_number in failed]
+    return "\n".join(lines) + "\n"
+
+
+class FakeArc():
+
+
+    def __init__(self, outputs):
+        """
+        Stands in for 'arcsub', answering each call with the next (code, output) of 'outputs'
+        and recording the job files it was given.
+        """
+        self.outputs = list(outputs)
+        self.calls = []
+
+
+    def run_command(self, cmd, timeout=None):
+        self.calls.append([arg for arg in cmd if arg.endswith(".jdl")])
+        return self.outputs.pop(0)
+
+
+def make_submitter(tmp_path, monkeypatch, outputs, **kwargs):
+    """
+    Returns a submitter without delays whose 'arcsub' answers with 'outputs', and the fake.
+    """
+    monkeypatch.chdir(tmp_path)
+    fake = FakeArc(outputs)
+    monkeypatch.setattr(submission, "run_command", fake.run_command)
+    options = {"workers" : 1, "batch_size" : 3, "backoff" : 0.0, "rate" : 1000.0, "runs" : 2, "output_dir" : "/out"}
+    options.update(kwargs)
+    return submission.Submitter(CE, database = str(tmp_path / "jobs.db"), **options), fake
+
+
+def write_jobs(job_numbers):
+    """
+    Writes the descriptions of 'job_numbers', returning their (job number, job file) pairs.
+    """
+    return xrsl.write_all([(job_number, xrsl.render("run_sherpa.py", job_number, "'-j' '%s'" % job_number, 4)) for job_number in job_numbers])
+
+
+def test_submit_batch(tmp_path, monkeypatch):
+    submitter, fake = make_submitter(tmp_path, monkeypatch, [(0, get_output([1, 3], failed = [2]))])
+    job_ids, unknown = submitter.submit_batch(CE, write_jobs([1, 2, 3]))
+    assert job_ids == {1 : "gsiftp://%s:2811/jobs/id1" % CE, 3 : "gsiftp://%s:2811/jobs/id3" % CE}
+    assert unknown == []
+    assert fake.calls == [["./job1.jdl", "./job2.jdl", "./job3.jdl"]]
+
+
+def test_submit_batch_failed(tmp_path, monkeypatch):
+    submitter, fake = make_submitter(tmp_path, monkeypatch, [(1, "ERROR: Failed to connect to %s\n" % CE)])
+    assert submitter.submit_batch(CE, write_jobs([1, 2])) == ({}, [])
+
+
+def test_submit_batch_ambiguous(tmp_path, monkeypatch):
+    # Two job IDs for three descriptions, without a summary naming the missing one
+    submitter, fake = make_submitter(tmp_path, monkeypatch, [(0, get_output([1, 2]).split("Job submission summary")[0])])
+    assert submitter.submit_batch(CE, write_jobs([1, 2, 3])) == ({}, [1, 2, 3])
+
+
+def test_submit_batch_killed(tmp_path, monkeypatch):
+    submitter, fake = make_submitter(tmp_path, monkeypatch, [(None, get_output([1])), (None, get_output([1, 2]))])
+    # Some jobs may have been accepted without being reported
+    assert submitter.submit_batch(CE, write_jobs([1, 2])) == ({}, [1, 2])
+    # Unless every one was
+    job_ids, unknown = submitter.submit_batch(CE, write_jobs([1, 2]))
+    assert sorted(job_ids) == [1, 2] and unknown == []
+
+
+def test_run(tmp_path, monkeypatch):
+    outputs = [(0, get_output([1, 3], failed = [2])), (0, get_output([2])), (0, get_output([4]))]
+    submitter, fake = make_submitter(tmp_path, monkeypatch, outputs)
+    report = submitter.run(write_jobs([1, 2, 3, 4]))
+    assert report["submitted"] == 4
+    assert report["retries"] == 1
+    assert report["failed"] == [] and report["unknown"] == []
+    # Only the failed job is retried
+    assert fake.calls == [["./job1.jdl", "./job2.jdl", "./job3.jdl"], ["./job2.jdl"], ["./job4.jdl"]]
+    assert [name for name in os.listdir(str(tmp_path)) if name.endswith(".jdl")] == []
+
+    jobs = submitter.database.select()
+    assert [(job["job_number"], job["state"]) for job in jobs] == [(number, jobdb.SUBMITTED) for number in range(1, 5)]
+    assert jobs[0]["seeds"] == " ".join(str(seed) for seed in jobdb.get_seeds(1, 2))
+    assert jobdb.get_job_name(jobs[0]["description"]) == "run_sherpa.py.1"
+
+    # Submitting again skips the jobs in the database
+    report = submitter.run(write_jobs([1, 2, 3, 4]))
+    assert report["skipped"] == 4 and len(fake.calls) == 3
+
+
+def test_run_failed(tmp_path, monkeypatch):
+    submitter, fake = make_submitter(tmp_path, monkeypatch, [(1, "ERROR\n")] * 3, retries = 2)
+    report = submitter.run(write_jobs([1]))
+    assert report["failed"] == [1]
+    # The description is kept for a later submission
+    assert os.path.isfile("job1.jdl")
+    assert submitter.database.get_submitted() == set()
+
+
+def test_run_unknown_not_retried(tmp_path, monkeypatch):
+    submitter, fake = make_submitter(tmp_path, monkeypatch, [(None, get_output([1]))])
+    report = submitter.run(write_jobs([1, 2]))
+    assert report["unknown"] == [1, 2]
+    assert len(fake.calls) == 1
+    assert [job["state"] for job in submitter.database.select()] == [jobdb.UNKNOWN] * 2
+    assert os.path.isfile("job1.jdl") and os.path.isfile("job2.jdl")
+
+    # Nor submitted again until found to be absent
+    assert submitter.run(write_jobs([1, 2]))["skipped"] == 2
+
+
+def test_pilots_have_their_own_job_numbers(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    assert jobdb.get_pilot_numbers(2) == [-1, -2]
+    outputs = [(0, get_output([1, 2])), (0, get_output([-1, -2])), (0, get_output([-3, -4]))]
+    submitter, fake = make_submitter(tmp_path, monkeypatch, outputs, runs = None)
+    submitter.run(write_jobs([1, 2]))
+
+    # Pilots submitted later carry on from the earlier ones, with the jobs they run untouched
+    for pilots in ([-1, -2], [-3, -4]):
+        assert jobdb.get_pilot_numbers(2, submitter.database.filename) == pilots
+        assert submitter.run(write_jobs(pilots))["submitted"] == 2
+    assert [job["job_number"] for job in submitter.database.select()] == [-4, -3, -2, -1, 1, 2]
+
+
+def test_load_balancer(monkeypatch):
+    depths = {"ce1" : 100, "ce2" : 10}
+    monkeypatch.setattr(submission, "get_queue_depth", lambda ce, timeout=60: depths[ce])
+    balancer = submission.LoadBalancer([("ce1", 1.0), ("ce2", 1.0)])
+    assert balancer.choose(50) == "ce2"
+    assert balancer.choose(50) == "ce2"
+    # ce2 now has 110 jobs waiting or sent to it
+    assert balancer.choose(50) == "ce1"
+
+    # Weighted: ce1 takes four times as many jobs for the same queue
+    depths["ce1"] = 30
+    balancer = submission.LoadBalancer([("ce1", 4.0), ("ce2", 1.0)])
+    assert balancer.choose(10) == "ce1"
+
+
+def test_load_balancer_polls_without_the_lock(monkeypatch):
+    started = threading.Event()
+    answer = threading.Event()
+
+    def get_queue_depth(ce, timeout=60):
+        started.set()
+        answer.wait(10)
+        return 0
+    monkeypatch.setattr(submission, "get_queue_depth", get_queue_depth)
+    balancer = submission.LoadBalancer([("ce1", 1.0), ("ce2", 1.0)])
+    balancer.waiting = {"ce1" : 5, "ce2" : 0}
+    balancer.polled = time.time() - 2 * balancer.poll_interval
+
+    poller = threading.Thread(target = balancer.choose, args = (1,))
+    poller.start()
+    assert started.wait(10)
+    # Other workers route on the last known depths while arcinfo runs
+    assert balancer.choose(10) == "ce2"
+    assert balancer.choose(10) == "ce1"
+    answer.set()
+    poller.join()
+
+    # Jobs routed during the poll stay counted, as the polled depths may not include them
+    assert balancer.routed["ce1"] + balancer.routed["ce2"] == 21
+    assert not balancer.polling
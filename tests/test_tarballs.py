@@ -0,0 +1,53 @@
+"""
+Tests of the streamed extraction of output tarballs by GridTools.tarballs.
+"""
+import io
+import os
+import tarfile
+
+from GridTools import tarballs
+
+
+def make_tarball(path, members):
+    """
+    Writes a gzipped tarball of the (name, bytes) 'members' to 'path'.
+    """
+    with tarfile.open(str(path), "w:gz") as tarball:
+        for name, data in members:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tarball.addfile(info, io.BytesIO(data))
+    return str(path)
+
+
+def test_extract_by_category(tmp_path):
+    tarball = make_tarball(tmp_path / "out.tar.gz", [("run/Sherpa_1.yoda", b"yoda"), ("run/Sherpa_1.log", b"log"),
+                                                     ("run/other.txt", b"other")])
+    yoda_dir = tmp_path / "yoda"
+    log_dir = tmp_path / "log"
+    yoda_dir.mkdir()
+    log_dir.mkdir()
+    assert tarballs.extract_by_category(tarball, [("*.yoda", str(yoda_dir)), ("*", str(log_dir))])
+    assert (yoda_dir / "Sherpa_1.yoda").read_bytes() == b"yoda"
+    assert sorted(os.listdir(str(log_dir))) == ["Sherpa_1.log", "other.txt"]
+
+
+def test_empty_tarball_fails(tmp_path):
+    empty = tmp_path / "empty.tar.gz"
+    empty.write_bytes(b"")
+    assert not tarballs.extract_by_category(str(empty), [("*", str(tmp_path))])
+
+
+def test_truncated_tarball_fails(tmp_path):
+    data = os.urandom(1 << 20)
+    tarball = make_tarball(tmp_path / "out.tar.gz", [("first.yoda", b"yoda"), ("second.dat", data)])
+    with open(tarball, "rb") as tarball_file:
+        truncated = tarball_file.read()[:len(data) // 2]
+    with open(tarball, "wb") as tarball_file:
+        tarball_file.write(truncated)
+
+    output_dir = tmp_path / "output"
+    output_dir.mkdir()
+    assert not tarballs.extract_by_category(tarball, [("*", str(output_dir))])
+    # Files written before the error are kept, and nothing is left half written
+    assert os.listdir(str(output_dir)) == ["first.yoda"]
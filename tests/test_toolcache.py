@@ -0,0 +1,99 @@
+"""
+Tests of the node-local tool tarball cache of GridTools.toolcache.
+"""
+import io
+import os
+import tarfile
+
+from GridTools import toolcache
+
+
+def make_tarball(path, name, data):
+    """
+    Writes a gzipped tarball holding the file 'name' with contents 'data' to 'path'.
+    """
+    with tarfile.open(str(path), "w:gz") as tarball:
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        tarball.addfile(info, io.BytesIO(data))
+    return str(path)
+
+
+def get_cached(cache):
+    """
+    Returns the names of the objects held by 'cache'.
+    """
+    return sorted(name for name in os.listdir(cache.cache_dir) if name.endswith(".tar.gz"))
+
+
+def test_unpack_downloads_once(tmp_path, monkeypatch):
+    url = make_tarball(tmp_path / "tools.tar.gz", "bin/tool", b"tool")
+    checksum = toolcache.storage.get_checksum(url)
+    cache = toolcache.ToolCache(str(tmp_path / "cache"))
+    (tmp_path / "job_0").mkdir()
+    (tmp_path / "job_1").mkdir()
+    assert cache.unpack(url, str(tmp_path / "job_0"))
+    assert get_cached(cache) == [os.path.basename(cache.get_path(checksum))]
+
+    # Later jobs unpack the cached object without reading the original
+    monkeypatch.setattr(toolcache.storage, "open_read", lambda url: None)
+    assert cache.unpack(url, str(tmp_path / "job_1"))
+    assert (tmp_path / "job_1" / "bin" / "tool").read_bytes() == b"tool"
+
+
+def test_changed_tarball_is_fetched_again(tmp_path):
+    url = make_tarball(tmp_path / "tools.tar.gz", "bin/tool", b"old")
+    cache = toolcache.ToolCache(str(tmp_path / "cache"))
+    assert cache.unpack(url, str(tmp_path))
+    make_tarball(tmp_path / "tools.tar.gz", "bin/tool", b"new")
+    assert cache.unpack(url, str(tmp_path))
+    assert (tmp_path / "bin" / "tool").read_bytes() == b"new"
+    assert len(get_cached(cache)) == 2
+
+
+def test_corrupt_tarball_is_not_cached(tmp_path):
+    url = str(tmp_path / "tools.tar.gz")
+    with open(url, "wb") as tarball:
+        tarball.write(os.urandom(4096))
+    cache = toolcache.ToolCache(str(tmp_path / "cache"))
+    assert not cache.unpack(url, str(tmp_path))
+    assert get_cached(cache) == []
+
+
+def test_evict(tmp_path):
+    cache = toolcache.ToolCache(str(tmp_path / "cache"))
+    paths = []
+    for idx in range(3):
+        url = make_tarball(tmp_path / ("tools_%s.tar.gz" % idx), "tool", os.urandom(1000))
+        assert cache.unpack(url, str(tmp_path))
+        paths.append(cache.get_path(toolcache.storage.get_checksum(url)))
+        os.utime(paths[-1], (idx, idx))
+
+    # The least recently used objects go first
+    cache.max_size = os.path.getsize(paths[2]) + 1
+    cache.evict()
+    assert get_cached(cache) == [os.path.basename(paths[2])]
+
+
+def test_unpack_all(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    cache = toolcache.ToolCache(str(tmp_path / "cache"))
+    remote = tmp_path / "remote"
+    remote.mkdir()
+    bundles = [(make_tarball(remote / ("tool_%s.tar.gz" % idx), "tool_%s" % idx, b"tool"), str(tmp_path / "tools" / str(idx))) for idx in range(4)]
+    missing = str(remote / "missing.tar.gz")
+
+    assert toolcache.unpack_all(cache, bundles + [(missing, str(tmp_path / "missing"))]) == [missing]
+    for idx in range(4):
+        assert (tmp_path / "tools" / str(idx) / ("tool_%s" % idx)).read_bytes() == b"tool"
+
+
+def test_unpack_all_uses_staged(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    # Staged by the CE into the working directory, while the remote copy is absent
+    make_tarball(tmp_path / "tool.tar.gz", "tool", b"staged")
+    url = str(tmp_path / "remote" / "tool.tar.gz")
+
+    assert toolcache.unpack_all(toolcache.ToolCache(str(tmp_path / "cache")), [(url, str(tmp_path / "tools"))]) == []
+    assert (tmp_path / "tools" / "tool").read_bytes() == b"staged"
+    assert not (tmp_path / "tool.tar.gz").exists()
@@ -0,0 +1,99 @@
+"""
+Tests of the spooled, verified uploads of GridTools.upload.
+"""
+import os
+
+from GridTools import storage, upload
+
+
+DESTINATION = "gsiftp://se.example.org/output/results_1.tar.gz"
+
+
+class FakeStorage():
+
+
+    def __init__(self, failures=0, corrupt=0):
+        """
+        Stands in for grid storage, failing the first 'failures' copies and corrupting
+        the next 'corrupt' ones.
+        """
+        self.failures = failures
+        self.corrupt = corrupt
+        self.files = {}
+
+
+    def copy(self, source, destination):
+        if self.failures:
+            self.failures -= 1
+            return False
+        with open(source, "rb") as source_file:
+            self.files[destination] = source_file.read()
+        if self.corrupt:
+            self.corrupt -= 1
+            self.files[destination] += b"corrupt"
+        return True
+
+
+    def get_checksum(self, url):
+        path = "%s.remote" % os.getpid()
+        with open(path, "wb") as remote:
+            remote.write(self.files[url])
+        try:
+            return storage.get_file_checksum(path)
+        finally:
+            os.remove(path)
+
+
+def make_uploader(tmp_path, monkeypatch, fake, retries=2):
+    """
+    Returns an uploader without delays writing to 'fake', and a results tarball to upload.
+    """
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(upload.storage, "copy", fake.copy)
+    monkeypatch.setattr(upload.storage, "get_checksum", fake.get_checksum)
+    results = tmp_path / "results_1.tar.gz"
+    results.write_bytes(b"results")
+    return upload.Uploader(str(tmp_path / "spool"), slots = 1, jitter = 0.0, retries = retries, backoff = 0.0), str(results)
+
+
+def test_save(tmp_path, monkeypatch):
+    fake = FakeStorage(failures = 1, corrupt = 1)
+    uploader, results = make_uploader(tmp_path, monkeypatch, fake)
+    assert uploader.save(results, DESTINATION)
+    assert fake.files[DESTINATION] == b"results"
+    assert not os.path.exists(results)
+    assert uploader.get_spooled() == []
+
+    report = uploader.get_report()
+    assert (report["files"], report["uploaded"], report["attempts"], report["failed"]) == (1, 1, 3, [])
+
+
+def test_failed_upload_stays_spooled(tmp_path, monkeypatch):
+    fake = FakeStorage(failures = 3)
+    uploader, results = make_uploader(tmp_path, monkeypatch, fake, retries = 1)
+    assert not uploader.save(results, DESTINATION)
+    spooled = uploader.get_spooled()
+    assert spooled == [os.path.join(uploader.spool_dir, "results_1.tar.gz")]
+    assert uploader.get_report()["failed"] == ["results_1.tar.gz"]
+
+    # Drained later, by the job or from the spool kept on the CE
+    assert uploader.drain()
+    assert fake.files[DESTINATION] == b"results"
+    assert uploader.get_spooled() == []
+    assert uploader.get_report()["failed"] == []
+
+
+def test_local_destination_is_copied(tmp_path, monkeypatch):
+    uploader, results = make_uploader(tmp_path, monkeypatch, FakeStorage())
+    monkeypatch.setattr(upload.storage, "copy", storage.LocalBackend().copy)
+    assert uploader.save(results, str(tmp_path / "premerge" / "results_1.tar.gz"))
+    assert (tmp_path / "premerge" / "results_1.tar.gz").read_bytes() == b"results"
+    assert uploader.get_spooled() == []
+
+
+def test_slots_are_exclusive(tmp_path, monkeypatch):
+    uploader, results = make_uploader(tmp_path, monkeypatch, FakeStorage())
+    uploader.slots = 2
+    with uploader.get_slot() as first:
+        with uploader.get_slot() as second:
+            assert sorted([first, second]) == [0, 1]
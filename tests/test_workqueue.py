@@ -0,0 +1,100 @@
+"""
+Tests of the work queue shared by pilot jobs, GridTools.workqueue.
+"""
+import os
+import time
+
+from GridTools import workqueue
+
+
+def make_queue(tmp_path, monkeypatch, units):
+    """
+    Returns a queue of 'units' in a local directory.
+    """
+    monkeypatch.chdir(tmp_path)
+    queue = workqueue.WorkQueue(str(tmp_path / "queue"))
+    queue.create(units)
+    return queue
+
+
+def test_claim_each_unit_once(tmp_path, monkeypatch):
+    make_queue(tmp_path, monkeypatch, [10, 11, 12])
+    # Pilots only share the queue's directory
+    pilots = [workqueue.WorkQueue(str(tmp_path / "queue")) for idx in range(4)]
+    claimed = [pilot.claim() for pilot in pilots]
+    assert claimed == [10, 11, 12, None]
+    assert sorted(os.listdir(str(tmp_path / "queue" / "claimed"))) == ["10", "11", "12"]
+
+
+def test_claim_from_start(tmp_path, monkeypatch):
+    queue = make_queue(tmp_path, monkeypatch, [10, 11, 12])
+    assert queue.claim(start = 2) == 12
+    assert queue.claim(start = 5) == 10
+    assert queue.claim(start = 2) == 11
+
+
+def test_done_units_are_skipped(tmp_path, monkeypatch):
+    queue = make_queue(tmp_path, monkeypatch, [10, 11])
+    queue.set_done(10)
+    assert queue.claim() == 11
+    assert queue.claim() is None
+
+
+def test_lapsed_claim_is_taken_over(tmp_path, monkeypatch):
+    queue = make_queue(tmp_path, monkeypatch, [10, 11])
+    now = time.time()
+    # The pilot of unit 10 dies, its claim lapsing at its deadline
+    assert queue.claim(expiry = now - 1) == 10
+    assert queue.claim(start = 1, expiry = now + 100) == 11
+    assert queue.get_claims() == {"10" : (0, int(now - 1)), "11" : (0, int(now + 100))}
+
+    assert queue.claim(expiry = now + 200) == 10
+    assert queue.get_claims()["10"] == (1, int(now + 200))
+    assert sorted(os.listdir(str(tmp_path / "queue" / "claimed"))) == ["10", "10.1", "11"]
+    # Live claims and completed units are never taken over
+    queue.set_done(11)
+    assert queue.claim() is None
+
+
+def test_claim_without_lease_has_lapsed(tmp_path, monkeypatch):
+    queue = make_queue(tmp_path, monkeypatch, [10])
+    os.mkdir(str(tmp_path / "queue" / "claimed" / "10"))
+    assert queue.get_claims() == {"10" : (0, 0)}
+    assert queue.claim() == 10
+    assert queue.get_claims()["10"][0] == 1
+
+
+def test_create_again_keeps_claims(tmp_path, monkeypatch):
+    queue = make_queue(tmp_path, monkeypatch, [10, 11])
+    assert queue.claim() == 10
+    queue.set_done(10)
+    workqueue.WorkQueue(str(tmp_path / "queue")).create([10, 11, 12])
+    queue = workqueue.WorkQueue(str(tmp_path / "queue"))
+    assert queue.get_units() == [10, 11, 12]
+    assert queue.claim() == 11
+
+
+class FakeJob():
+
+
+    def __init__(self, job_number):
+        self.job_number = job_number
+
+
+def test_run_pilot(tmp_path, monkeypatch):
+    make_queue(tmp_path, monkeypatch, [10, 11, 12])
+    runs = []
+    monkeypatch.setattr(workqueue, "run_unit", lambda job, processes, events, chunk_events, merge: runs.append(job.job_number))
+
+    job = FakeJob(1)
+    assert workqueue.run_pilot(job, 2, 100, str(tmp_path / "queue"), time.time() + 100) == [11, 12, 10]
+    assert runs == [11, 12, 10]
+    assert sorted(os.listdir(str(tmp_path / "queue" / "done"))) == ["10", "11", "12"]
+    # Claims last until the grace period after the deadline
+    assert all(lapses > time.time() + workqueue.LEASE_GRACE for attempt, lapses in workqueue.WorkQueue(str(tmp_path / "queue")).get_claims().values())
+
+
+def test_run_pilot_stops_at_deadline(tmp_path, monkeypatch):
+    make_queue(tmp_path, monkeypatch, [10, 11])
+    monkeypatch.setattr(workqueue, "run_unit", lambda job, processes, events, chunk_events, merge: None)
+    assert workqueue.run_pilot(FakeJob(0), 2, 100, str(tmp_path / "queue"), time.time() - 1) == []
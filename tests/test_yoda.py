@@ -0,0 +1,208 @@
+"""
+Tests of the in-process YODA merging of GridTools.yoda.
+"""
+import numpy
+import pytest
+
+from GridTools import yoda
+
+
+HISTO = """BEGIN YODA_HISTO1D_V2 /TEST/h
+Path: /TEST/h
+ScaledBy: 1.0
+Title: 
+Type: Histo1D
+---
+# Mean: 1.000000e+00
+# Area: %(sumw)s
+# ID	 ID	 sumw	 sumw2	 sumwx	 sumwx2	 numEntries
+Total   	Total   	%(sumw)s	%(sumw2)s	%(sumw)s	%(sumw)s	%(n)s
+Underflow	Underflow	0.0	0.0	0.0	0.0	0
+Overflow	Overflow	0.0	0.0	0.0	0.0	0
+# xlow	 xhigh	 sumw	 sumw2	 sumwx	 sumwx2	 numEntries
+0.0	1.0	%(bin0)s	%(sumw2)s	0.0	0.0	%(n)s
+1.0	2.0	%(bin1)s	0.0	%(bin1)s	%(bin1)s	%(n)s
+END YODA_HISTO1D_V2
+
+BEGIN YODA_SCATTER2D_V2 /TEST/s
+Path: /TEST/s
+Title: 
+Type: Scatter2D
+---
+# xval	 xerr-	 xerr+	 yval	 yerr-	 yerr+
+0.5	0.5	0.5	%(bin0)s	%(err)s	%(err)s
+END YODA_SCATTER2D_V2
+
+"""
+
+
+def write_histo(path, sumw, n, err):
+    """
+    Writes a YODA file holding a histogram with a total weight 'sumw' over two bins
+    and a scatter of one point with value sumw and errors 'err'.
+    """
+    with open(str(path), "w") as yoda_file:
+        yoda_file.write(HISTO % {"sumw" : sumw, "sumw2" : sumw ** 2, "n" : n, "err" : err,
+                                 "bin0" : sumw / 2.0, "bin1" : sumw / 2.0})
+    return str(path)
+
+
+def make_files(tmp_path, weights):
+    """
+    Writes a file per weight in 'weights' and returns their names.
+    """
+    return [write_histo(tmp_path / ("run_%s.yoda" % idx), weight, idx + 1, 3.0) for idx, weight in enumerate(weights)]
+
+
+def test_read_histogram(tmp_path):
+    aos = yoda.read(make_files(tmp_path, [4.0])[0])
+    assert list(aos) == ["/TEST/h", "/TEST/s"]
+    histo = aos["/TEST/h"]
+    assert histo.type == "Histo1D"
+    assert histo.edges[0] == ("Total", "Total")
+    assert histo.edges[-1] == ("1.0", "2.0")
+    assert histo.values.shape == (5, 5)
+    assert histo.values[0, 0] == 4.0
+
+
+def test_merge_averages_histograms(tmp_path):
+    output = str(tmp_path / "merged.yoda")
+    yoda.merge_files(make_files(tmp_path, [2.0, 4.0, 6.0]), output)
+    histo = yoda.read(output)["/TEST/h"]
+    # sumw averaged, sumw2 scaled by 1/N^2 and numEntries summed
+    numpy.testing.assert_allclose(histo.values[0], [4.0, (4.0 + 16.0 + 36.0) / 9.0, 4.0, 4.0, 6.0])
+    assert dict(histo.annotations)["ScaledBy"] == repr(1.0 / 3)
+    assert "# Area: 4.000000e+00" in histo.layout
+
+
+def test_merge_averages_scatters(tmp_path):
+    output = str(tmp_path / "merged.yoda")
+    yoda.merge_files(make_files(tmp_path, [2.0, 4.0]), output)
+    scatter = yoda.read(output)["/TEST/s"]
+    # Values averaged, errors added in quadrature and scaled by 1/N (held squared)
+    assert scatter.values[0, 0] == 1.5
+    numpy.testing.assert_allclose(scatter.values[0, 1:], [4.5, 4.5], rtol = 1e-6)
+
+
+def test_stack_sums_histograms(tmp_path):
+    output = str(tmp_path / "stacked.yoda")
+    yoda.merge_files(make_files(tmp_path, [2.0, 4.0]), output, stack = True)
+    histo = yoda.read(output)["/TEST/h"]
+    numpy.testing.assert_allclose(histo.values[0], [6.0, 20.0, 6.0, 6.0, 3.0])
+
+
+def test_partial_merge_records_merged_files(tmp_path):
+    partial = str(tmp_path / "partial.yoda")
+    yoda.merge_files(make_files(tmp_path, [2.0, 4.0, 6.0]), partial, partial = True)
+    with open(partial) as partial_file:
+        assert "%s: 3" % yoda.MERGED_FILES in partial_file.read()
+    aos = yoda.read(partial)
+    assert aos["/TEST/h"].nfiles == 3
+    assert yoda.MERGED_FILES not in dict(aos["/TEST/h"].annotations)
+    assert aos["/TEST/h"].values[0, 0] == 12.0
+
+
+def test_partial_merges_match_full_merge(tmp_path):
+    files = make_files(tmp_path, [1.0, 2.0, 3.0, 5.0, 8.0])
+    full = str(tmp_path / "full.yoda")
+    yoda.merge_files(files, full)
+
+    partials = [str(tmp_path / "partial_0.yoda"), str(tmp_path / "partial_1.yoda")]
+    yoda.merge_files(files[:2], partials[0], partial = True)
+    yoda.merge_files(files[2:], partials[1], partial = True)
+    from_partials = str(tmp_path / "from_partials.yoda")
+    yoda.merge_files(partials, from_partials)
+
+    with open(full) as full_file, open(from_partials) as partials_file:
+        assert full_file.read() == partials_file.read()
+
+
+def test_parallel_merge_matches_serial_merge(tmp_path):
+    files = make_files(tmp_path, [1.0, 2.0, 3.0, 5.0, 8.0])
+    serial = str(tmp_path / "serial.yoda")
+    parallel = str(tmp_path / "parallel.yoda")
+    yoda.merge_files(files, serial)
+    yoda.merge_files(files, parallel, processes = 2)
+
+    with open(serial) as serial_file, open(parallel) as parallel_file:
+        assert serial_file.read() == parallel_file.read()
+
+
+def test_gzipped_files(tmp_path):
+    output = str(tmp_path / "merged.yoda.gz")
+    yoda.merge_files(make_files(tmp_path, [2.0, 4.0]), output)
+    assert yoda.read(output)["/TEST/h"].values[0, 0] == 3.0
+
+
+HISTO2D = """BEGIN YODA_HISTO2D_V2 /TEST/h2
+Path: /TEST/h2
+Title: 
+Type: Histo2D
+---
+# Mean: (5.000000e-01, 5.000000e-01)
+# Volume: %(sumw)s
+# ID	 ID	 sumw	 sumw2	 sumwx	 sumwx2	 sumwy	 sumwy2	 sumwxy	 numEntries
+Total   	Total   	%(sumw)s	%(sumw)s	%(half)s	%(half)s	%(half)s	%(half)s	%(half)s	2
+# 2D outflow persistency not currently supported until API is stable
+# xlow	 xhigh	 ylow	 yhigh	 sumw	 sumw2	 sumwx	 sumwx2	 sumwy	 sumwy2	 sumwxy	 numEntries
+0.0	1.0	0.0	1.0	%(half)s	%(half)s	%(half)s	%(half)s	%(half)s	%(half)s	%(half)s	1
+1.0	2.0	0.0	1.0	%(half)s	%(half)s	%(half)s	%(half)s	%(half)s	%(half)s	%(half)s	1
+END YODA_HISTO2D_V2
+
+"""
+
+
+def write_histo2d(path, sumw):
+    """
+    Writes a YODA file holding a 2D histogram with a total weight 'sumw' over two bins.
+    """
+    with open(str(path), "w") as yoda_file:
+        yoda_file.write(HISTO2D % {"sumw" : sumw, "half" : sumw / 2.0})
+    return str(path)
+
+
+def test_read_histogram2d(tmp_path):
+    histo = yoda.read(write_histo2d(tmp_path / "run.yoda", 2.0))["/TEST/h2"]
+    # The Total row has two labels in place of the four edges of the bins
+    assert histo.edges == [("Total", "Total"), ("0.0", "1.0", "0.0", "1.0"), ("1.0", "2.0", "0.0", "1.0")]
+    assert histo.values.shape == (3, 8)
+    assert histo.values[0, 0] == 2.0
+
+
+def test_merge_histogram2d(tmp_path):
+    files = [write_histo2d(tmp_path / "run_0.yoda", 2.0), write_histo2d(tmp_path / "run_1.yoda", 4.0)]
+    output = str(tmp_path / "merged.yoda")
+    yoda.merge_files(files, output)
+    with open(output) as merged_file:
+        lines = merged_file.read().splitlines()
+    assert "# Volume: 3.000000e+00" in lines
+    rows = [line.split("\t") for line in lines if line and not line.startswith(("#", "BEGIN", "END")) and ": " not in line and line != "---"]
+    assert [len(row) for row in rows] == [10, 12, 12]
+
+    histo = yoda.read(output)["/TEST/h2"]
+    numpy.testing.assert_allclose(histo.values[0], [3.0, 1.5, 1.5, 1.5, 1.5, 1.5, 1.5, 4.0])
+    numpy.testing.assert_allclose(histo.values[1], [1.5, 0.75, 1.5, 1.5, 1.5, 1.5, 1.5, 2.0])
+
+
+def test_mismatched_rows_fail(tmp_path):
+    path = write_histo2d(tmp_path / "run.yoda", 2.0)
+    with open(path) as yoda_file:
+        text = yoda_file.read().replace("0.0\t1.0\t0.0\t1.0\t", "0.0\t1.0\t0.0\t", 1)
+    with open(path, "w") as yoda_file:
+        yoda_file.write(text)
+    with pytest.raises(ValueError):
+        yoda.read(path)
+
+
+def test_merge_adds_scaled_by(tmp_path):
+    files = [write_histo2d(tmp_path / "run_0.yoda", 2.0), write_histo2d(tmp_path / "run_1.yoda", 4.0)]
+    output = str(tmp_path / "merged.yoda")
+    yoda.merge_files(files, output)
+    annotations = yoda.read(output)["/TEST/h2"].annotations
+    # As scaleW adds it, in order of key
+    assert [key for key, value in annotations] == ["Path", "ScaledBy", "Title", "Type"]
+    assert dict(annotations)["ScaledBy"] == repr(0.5)
+
+    stacked = str(tmp_path / "stacked.yoda")
+    yoda.merge_files(files, stacked, stack = True)
+    assert "ScaledBy" not in dict(yoda.read(stacked)["/TEST/h2"].annotations)